@@ -1,15 +1,110 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, Response, stream_with_context
 from flask_cors import CORS
-from models import Movies, Actor, setup_db
+from sqlalchemy.orm.exc import StaleDataError
+from models import Movies, Actor, Casting, setup_db
 import sys
 from auth.auth import AuthError, requires_auth
+from pagination import Listing, parse_date
+from jsonutil import format_date, jsonify
+from bulk import BULK_MAX_RECORDS, bulk_create, bulk_delete, bulk_report, \
+    bulk_update, delete_targets, unconfirmed_delete
+from export import export_rows
+from cache import response_cache
+from search import SEARCH_TABLES, search
+from metrics import registry
+from routing import read_only, stick_to_primary
+from instrumentation import instrument
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'fsnd-nes.us.auth0.com')
 ALGORITHMS = os.environ.get("JWT_TOKEN_ENCRYPTION_ALGORITHMS", ['RS256'])
-API_AUDIENCE = os.environ('AUTH0_JWT_API_AUDIENCE', 'casting-agency-api')
-CLIENT_ID = os.environ('AUTH0_CLIENT_ID', 'JGmjaRutW3eW63rA0wbPCDUoon5sJX72')
-CALLBACK_URL = os.environ('CALLBACK_URL', "http://localhost:5000/")
+API_AUDIENCE = os.environ.get('AUTH0_JWT_API_AUDIENCE', 'casting-agency-api')
+CLIENT_ID = os.environ.get('AUTH0_CLIENT_ID',
+                           'JGmjaRutW3eW63rA0wbPCDUoon5sJX72')
+CALLBACK_URL = os.environ.get('CALLBACK_URL', "http://localhost:5000/")
+
+movies_listing = Listing(
+    Movies,
+    default_fields=['id', 'release_year', 'title'],
+    filters={
+        'release_year_min': ('release_year', 'min', int),
+        'release_year_max': ('release_year', 'max', int),
+        'title_prefix': ('title', 'prefix', str),
+        'title_contains': ('title', 'contains', str),
+    },
+    includes={'actors': Casting.actors_of})
+actors_listing = Listing(
+    Actor,
+    default_fields=['id', 'name', 'date_of_birth', 'gender'],
+    filters={
+        'gender': ('gender', 'eq', str),
+        'date_of_birth_min': ('date_of_birth', 'min', parse_date),
+        'date_of_birth_max': ('date_of_birth', 'max', parse_date),
+    },
+    formatters={'date_of_birth': format_date},
+    includes={'movies': Casting.movies_of})
+
+# tables the responses depend on for each ?include=
+MOVIE_INCLUDES = {'actors': ('casting', 'actors')}
+ACTOR_INCLUDES = {'movies': ('casting', 'movies')}
+# every table the movie / actor read endpoints may read
+MOVIE_TABLES = ('movies', 'casting', 'actors')
+ACTOR_TABLES = ('actors', 'casting', 'movies')
+
+
+def get_includes(allowed):
+    """
+    reads the comma separated ?include= related rows of a by-id request
+    aborts with 400 on names other than allowed
+    """
+    includes = [name for name in request.args.get('include', '').split(',')
+                if name]
+    if any(name not in allowed for name in includes):
+        abort(400)
+    return includes
+
+
+def if_match_versions():
+    """
+    optimistic locking of PATCH and DELETE: with an If-Match header the
+    write only goes through on a version of the row the client read,
+    the UPDATE / DELETE matches on it and a StaleDataError becomes a 412
+    returns the versions listed, None without the header or with "*"
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    # the ETag of a GET by id is "<version>-<hash>", other tags are no
+    # version, they match no row
+    versions = [tag.split('-')[0] for tag in request.if_match.as_set()]
+    return [int(version) for version in versions if version.isdigit()]
+
+
+def rejected_update(model, row_id, status, message):
+    """
+    the error of a PATCH that changes nothing, a 404 when the row does not
+    exist as the update is the lookup otherwise
+    """
+    if model.version_of(row_id) is None:
+        abort(404)
+    return jsonify({
+        "success": False,
+        "error": status,
+        "message": message
+    }), status
+
+
+def versioned(response, row):
+    """the ETag of a PATCH response is the new version of the row"""
+    response.set_etag(str(row.version))
+    return response
+
+
+def wants_full_list():
+    """
+    legacy clients of POST /movies and POST /actors can still ask for the
+    whole table in the response with ?full_list=true
+    """
+    return request.args.get('full_list', '').lower() in ('1', 'true', 'yes')
 
 
 def create_app(test_config=None):
@@ -17,6 +112,7 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    instrument(app)
 
     @app.route("/authorization/url", methods=["GET"])
     def generate_auth_url():
@@ -44,27 +140,74 @@ def create_app(test_config=None):
         # Allow specific requests methods (GET, POST, PATCH, DELETE, OPTIONS)
         response.headers.add('Access-Control-Allow-Methods',
                              'GET,PATCH,POST,DELETE,OPTIONS')
-        return response
+        return stick_to_primary(response)
 
     @app.route('/')
     def welcome():
         return 'Welcome to the Casting Agency app'
 
+    @app.route('/metrics')
+    def metrics():
+        """
+        GET /metrics
+        the metrics of this worker process in the prometheus text format
+        """
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.route('/search')
+    @response_cache.cached(SEARCH_TABLES)
+    @read_only(*SEARCH_TABLES)
+    def search_catalog():
+        """
+        GET /search?q=<str>&type=<movie|actor>&limit=<int>&after=<cursor>
+        returns status code 200 and json {"success": True, "results":
+        results, "next_cursor": cursor, "truncated": truncated}
+        where results is a page of the movies and actors matching every
+        word of q (the last one as a prefix), best match first, and
+        truncated tells that only part of the matches were ranked
+        or appropriate status code indicating reason for failure
+        """
+        try:
+            results, next_cursor, truncated = search(request.args)
+            return jsonify({
+                'success': True,
+                'results': results,
+                'next_cursor': next_cursor,
+                'truncated': truncated,
+            }), 200
+        except ValueError:
+            abort(400)
+        except Exception:
+            print(sys.exc_info())
+            abort(500)
+
     @app.route('/movies')
+    @response_cache.cached('movies', includes=MOVIE_INCLUDES)
+    @read_only(*MOVIE_TABLES)
     def get_movies():
         """
-        GET /movies
-        returns status code 200 and json {"success": True, "movie": movies}
-        where movies is the list of movies
+        GET /movies?limit=<int>&after=<cursor>
+            &release_year_min=<int>&release_year_max=<int>
+            &title_prefix=<str>&title_contains=<str>
+            &sort=<field,-field>&fields=<field,field>
+        returns status code 200 and json {"success": True, "movie": movies,
+        "next_cursor": cursor}
+        where movies is a page of at most limit movies matching the filters,
+        ordered by the sort fields (- for descending) then id, holding only
+        the requested fields, and next_cursor is the value of after for the
+        next page or null on the last page
         or appropriate status code indicating reason for failure
         """
         try:
-            movies = list(map(Movies.short, Movies.query.all()))
+            movies, next_cursor = movies_listing.page(request.args)
             return jsonify({
                 'success': True,
                 'movie': movies,
+                'next_cursor': next_cursor,
             }), 200
-
+        except ValueError:
+            abort(400)
         except Exception:
             print(sys.exc_info())
             abort(500)
@@ -73,14 +216,16 @@ def create_app(test_config=None):
     @requires_auth('post:movies')
     def create_movie(jwt):
         """
-            POST /movies
+            POST /movies?full_list=<bool>
             it should create a new row in the movies table
             it should require the 'post:movies' permission
             it should contain the movie.long() data representation
-        returns status code 200 and json {"success": True, "movies":
-        movie} where
-        drink an array containing only the newly created
-         drink or appropriate status code indicating reason for failure
+        returns status code 200 and json {"success": True, "movie":
+        movie, "created": id} where
+        movie an array containing only the newly created
+         movie or appropriate status code indicating reason for failure
+        with full_list=true movie contains every movie (legacy response,
+         costs a read of the whole table)
         """
         try:
             data = request.get_json()
@@ -88,30 +233,136 @@ def create_app(test_config=None):
                            duration=data.get('duration', None),
                            release_year=data.get('release_year', None))
             movie.insert()
-            movies = list(map(Movies.long, Movies.query.all()))
+            if wants_full_list():
+                movies = list(map(Movies.long, Movies.query.all()))
+            else:
+                movies = [movie.long()]
             return jsonify({
                 'success': True,
                 'movie': movies,
-
+                'created': movie.id,
             }), 200
         except Exception:
             print(sys.exc_info())
             abort(422)
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def create_movies_bulk(jwt):
+        """
+        POST /movies/bulk
+            it should create a row in the movies table for every valid
+            movie of the json array body, in a single transaction
+            it should require the 'post:movies' permission
+        returns status code 200 and json {"success": True, "created": n,
+        "failed": n, "results": results} where results holds
+        {"index": i, "id": id} or {"index": i, "error": reason} for every
+        movie of the body, in order
+        or appropriate status code indicating reason for failure
+        """
+        data = request.get_json()
+        if not isinstance(data, list) or not data or \
+                len(data) > BULK_MAX_RECORDS:
+            abort(400)
+        try:
+            return jsonify(bulk_report(bulk_create(Movies, data))), 200
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def update_movies_bulk(jwt):
+        """
+        PATCH /movies
+            it should update every valid movie of the json array body
+            [{"id": id, "fields": {...}, "version": version}] (version
+            is optional, as If-Match) with set-based statements in a single
+            transaction
+            it should require the 'patch:movies' permission, once
+        returns status code 200 and json {"success": True, "updated": n,
+        "failed": n, "results": {id: {"version": version} or
+        {"error": reason}}} for every id of the body
+        or 400 on a record without an id or a repeated id
+        """
+        try:
+            report = bulk_update(Movies, request.get_json())
+        except ValueError:
+            abort(400)
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+        return jsonify(report), 200
+
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies_bulk(jwt):
+        """
+        DELETE /movies
+            it should delete the movies of the json body {"ids": [id]}
+            or matching {"filter": {parameter: value}}, with the filter
+            parameters of GET /movies, in a single transaction
+            a filter delete needs "confirm": <number of matching rows>,
+            without it is a dry run returning {"dry_run": True, "matched":
+            n}, with another number a 412
+            it should require the 'delete:movies' permission, once
+        returns status code 200 and json {"success": True, "deleted": n,
+        "failed": n, "results": {id: {"deleted": True} or
+        {"error": reason}}}
+        or 400 on a malformed body or a filter matching more than
+        BULK_MAX_RECORDS movies
+        """
+        data = request.get_json()
+        try:
+            ids = delete_targets(Movies, movies_listing, data)
+        except ValueError:
+            abort(400)
+        unconfirmed = unconfirmed_delete(data, ids)
+        if unconfirmed:
+            body, status = unconfirmed
+            return jsonify(body), status
+        try:
+            return jsonify(bulk_delete(Movies, ids)), 200
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies-id')
+    @read_only('movies')
+    def export_movies(jwt):
+        """
+        GET /movies/export
+        streams every movie as newline delimited json, one movie per line
+        """
+        return Response(stream_with_context(export_rows(Movies)),
+                        mimetype='application/x-ndjson')
+
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth("get:movies-id")
+    @response_cache.cached('movies', includes=MOVIE_INCLUDES,
+                           row_version=lambda movie_id:
+                           Movies.version_of(movie_id))
+    @read_only(*MOVIE_TABLES)
     def get_movie_by_id(jwt, movie_id):
         """
-        GET /movies/<int:movie_id>
+        GET /movies/<int:movie_id>?include=actors
         get the movie by id
+        with include=actors the movie has the list of its actors, with
+        their role and billing order
         """
+        includes = get_includes(['actors'])
         try:
             movie = Movies.query.filter_by(id=movie_id).one_or_none()
             if not movie:
                 abort(404)
+            result = movie.long()
+            if 'actors' in includes:
+                # one query of plain rows for the whole cast
+                result['actors'] = Casting.actors_of([movie_id])[movie_id]
             return jsonify({
                 "success": True,
-                "movie": movie.long()
+                "movie": result
             }), 200
         except Exception:
             print(sys.exc_info())
@@ -126,31 +377,34 @@ def create_app(test_config=None):
         """
 
         data = request.get_json()
-        movie = Movies.query.filter_by(id=movie_id).one_or_none()
-        if not movie:
-            abort(404)
         if not data:
-            abort(422)
+            return rejected_update(Movies, movie_id, 422, 'unprocessable')
         # check if none of the fields is there to raise an error
         if not any(item in data.keys() for item in
                    ['title',
                     'release_year', 'duration']):
-            abort(400)
+            return rejected_update(Movies, movie_id, 400, 'bad request')
+        values = {field: data[field] for field in
+                  ('title', 'duration', 'release_year')
+                  if data.get(field, None)}
+        if not values:
+            return rejected_update(Movies, movie_id, 400,
+                                   'no field to update')
         try:
-            if data.get('title', None):
-                movie.title = data['title']
-            if data.get('duration', None):
-                movie.duration = data['duration']
-            if data.get('release_year', None):
-                movie.release_year = data['release_year']
-            movie.update()
-            return jsonify({
-                "success": True,
-                "movie": movie.long()
-            }), 200
+            # one UPDATE ... RETURNING, the movie is not loaded first
+            movie = Movies.update_by_id(movie_id, values,
+                                        if_match_versions())
+        except StaleDataError:
+            abort(412)
         except Exception:
             print(sys.exc_info())
             abort(422)
+        if movie is None:
+            abort(404)
+        return versioned(jsonify({
+            "success": True,
+            "movie": Movies.long_of(movie)
+        }), movie), 200
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
@@ -165,33 +419,100 @@ def create_app(test_config=None):
          where id is the id of the deleted record
             or appropriate status code indicating reason for failure
         """
-        movie = Movies.query.filter_by(id=movie_id).one_or_none()
-        if not movie:
+        try:
+            deleted = Movies.delete_by_id(movie_id, if_match_versions())
+        except StaleDataError:
+            abort(412)
+        except Exception:
+            abort(422)
+        if not deleted:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'delete': movie_id,
+        })
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth('patch:movies')
+    def cast_actor(jwt, movie_id):
+        """
+        POST /movies/<int:movie_id>/actors
+            it should cast the actor_id of the body in the movie, with an
+            optional role and billing_order
+            it should require the 'patch:movies' permission
+        returns status code 200 and json {"success": True, "casting":
+        casting}
+        or 404 if the movie or the actor does not exist, 422 if the actor
+        is already cast in the movie
+        """
+        data = request.get_json()
+        if not data or not isinstance(data.get('actor_id'), int):
+            abort(400)
+        if Movies.query.get(movie_id) is None or \
+                Actor.query.get(data['actor_id']) is None:
             abort(404)
         try:
-            movie.delete()
+            casting = Casting(movie_id=movie_id, actor_id=data['actor_id'],
+                              role=data.get('role'),
+                              billing_order=data.get('billing_order'))
+            casting.insert()
             return jsonify({
                 'success': True,
-                'delete': movie_id,
+                'casting': casting.long(),
+            }), 200
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def uncast_actor(jwt, movie_id, actor_id):
+        """
+        DELETE /movies/<int:movie_id>/actors/<int:actor_id>
+            it should remove the actor from the cast of the movie
+            it should require the 'patch:movies' permission
+        returns status code 200 and json {"success": True, "delete":
+        actor_id}
+        or 404 if the actor is not cast in the movie
+        """
+        casting = Casting.query.get((movie_id, actor_id))
+        if not casting:
+            abort(404)
+        try:
+            casting.delete()
+            return jsonify({
+                'success': True,
+                'delete': actor_id,
             })
         except Exception:
             abort(422)
 
     @app.route('/actors')
+    @response_cache.cached('actors', includes=ACTOR_INCLUDES)
+    @read_only(*ACTOR_TABLES)
     def get_actors():
         """
-        GET /actors
-        returns status code 200 and json {"success": True, "actors": actors}
-        where actors is the list of actors
+        GET /actors?limit=<int>&after=<cursor>&gender=<str>
+            &date_of_birth_min=<YYYY-MM-DD>&date_of_birth_max=<YYYY-MM-DD>
+            &sort=<field,-field>&fields=<field,field>
+        returns status code 200 and json {"success": True, "actor": actors,
+        "next_cursor": cursor}
+        where actors is a page of at most limit actors matching the filters,
+        ordered by the sort fields (- for descending) then id, holding only
+        the requested fields, and next_cursor is the value of after for the
+        next page or null on the last page
         or appropriate status code indicating reason for failure
         """
         try:
-            actors = list(map(Actor.long, Actor.query.all()))
+            actors, next_cursor = actors_listing.page(request.args)
             return jsonify({
                 'success': True,
                 'actor': actors,
+                'next_cursor': next_cursor,
             }), 200
-
+        except ValueError:
+            abort(400)
         except Exception:
             print(sys.exc_info())
             abort(500)
@@ -200,45 +521,154 @@ def create_app(test_config=None):
     @requires_auth('post:actors')
     def create_actor(jwt):
         """
-            POST /actors
+            POST /actors?full_list=<bool>
             it should create a new row in the actors table
             it should require the 'post:actors' permission
             it should contain the actor.long() data representation
         returns status code 200 and json {"success": True, "actor":
-         actor} where
+         actor, "created": id} where
         actor an array containing only the newly created
          actor or appropriate status code indicating reason for failure
+        with full_list=true actor contains every actor (legacy response,
+         costs a read of the whole table)
         """
         try:
             data = request.get_json()
 
+            date_of_birth = data.get('date_of_birth', None)
             actor = Actor(name=data.get('name', None),
                           gender=data.get('gender', None),
-                          date_of_birth=data.get('date_of_birth', None))
+                          date_of_birth=date_of_birth and
+                          parse_date(date_of_birth))
             actor.insert()
-            actors = list(map(Actor.long, Actor.query.all()))
+            if wants_full_list():
+                actors = list(map(Actor.long, Actor.query.all()))
+            else:
+                actors = [actor.long()]
             return jsonify({
                 'success': True,
                 'actor': actors,
-
+                'created': actor.id,
             }), 200
         except Exception:
             abort(422)
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def create_actors_bulk(jwt):
+        """
+        POST /actors/bulk
+            it should create a row in the actors table for every valid
+            actor of the json array body, in a single transaction
+            it should require the 'post:actors' permission
+        returns status code 200 and json {"success": True, "created": n,
+        "failed": n, "results": results} where results holds
+        {"index": i, "id": id} or {"index": i, "error": reason} for every
+        actor of the body, in order
+        or appropriate status code indicating reason for failure
+        """
+        data = request.get_json()
+        if not isinstance(data, list) or not data or \
+                len(data) > BULK_MAX_RECORDS:
+            abort(400)
+        try:
+            return jsonify(bulk_report(bulk_create(Actor, data))), 200
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def update_actors_bulk(jwt):
+        """
+        PATCH /actors
+            it should update every valid actor of the json array body
+            [{"id": id, "fields": {...}, "version": version}] (version
+            is optional, as If-Match) with set-based statements in a single
+            transaction
+            it should require the 'patch:actors' permission, once
+        returns status code 200 and json {"success": True, "updated": n,
+        "failed": n, "results": {id: {"version": version} or
+        {"error": reason}}} for every id of the body
+        or 400 on a record without an id or a repeated id
+        """
+        try:
+            report = bulk_update(Actor, request.get_json())
+        except ValueError:
+            abort(400)
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+        return jsonify(report), 200
+
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actors_bulk(jwt):
+        """
+        DELETE /actors
+            it should delete the actors of the json body {"ids": [id]}
+            or matching {"filter": {parameter: value}}, with the filter
+            parameters of GET /actors, in a single transaction
+            a filter delete needs "confirm": <number of matching rows>,
+            without it is a dry run returning {"dry_run": True, "matched":
+            n}, with another number a 412
+            it should require the 'delete:actors' permission, once
+        returns status code 200 and json {"success": True, "deleted": n,
+        "failed": n, "results": {id: {"deleted": True} or
+        {"error": reason}}}
+        or 400 on a malformed body or a filter matching more than
+        BULK_MAX_RECORDS actors
+        """
+        data = request.get_json()
+        try:
+            ids = delete_targets(Actor, actors_listing, data)
+        except ValueError:
+            abort(400)
+        unconfirmed = unconfirmed_delete(data, ids)
+        if unconfirmed:
+            body, status = unconfirmed
+            return jsonify(body), status
+        try:
+            return jsonify(bulk_delete(Actor, ids)), 200
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors-id')
+    @read_only('actors')
+    def export_actors(jwt):
+        """
+        GET /actors/export
+        streams every actor as newline delimited json, one actor per line
+        """
+        return Response(stream_with_context(export_rows(Actor)),
+                        mimetype='application/x-ndjson')
+
     @app.route('/actors/<int:actor_id>', methods=['GET'])
     @requires_auth("get:actors-id")
+    @response_cache.cached('actors', includes=ACTOR_INCLUDES,
+                           row_version=lambda actor_id:
+                           Actor.version_of(actor_id))
+    @read_only(*ACTOR_TABLES)
     def get_actor_by_id(jwt, actor_id):
         """
-        GET /actors/<int:actor_id>
+        GET /actors/<int:actor_id>?include=movies
         get the actors by id
+        with include=movies the actor has the list of their movies, with
+        their role and billing order
         """
+        includes = get_includes(['movies'])
         try:
             actor = Actor.query.filter_by(id=actor_id).one_or_none()
             if not actor:
                 abort(404)
+            result = actor.long()
+            if 'movies' in includes:
+                result['movies'] = Casting.movies_of([actor_id])[actor_id]
             return jsonify({
                 "success": True,
-                "actor": actor.long()
+                "actor": result
             }), 200
         except Exception:
             print(sys.exc_info())
@@ -252,30 +682,38 @@ def create_app(test_config=None):
         to update the movie by id
         """
         data = request.get_json()
-        actor = Actor.query.filter_by(id=actor_id).one_or_none()
-        if not actor:
-            abort(404)
+        if not data:
+            return rejected_update(Actor, actor_id, 422, 'unprocessable')
         # check if none of the fields is there to raise an error
         if not any(item in data.keys() for item in
                    ['name',
                     'gender', 'date_of_birth']):
+            return rejected_update(Actor, actor_id, 400, 'bad request')
+        try:
+            date_of_birth = data.get('date_of_birth', None) and \
+                parse_date(data['date_of_birth'])
+        except (TypeError, ValueError):
             abort(400)
+        values = {field: data[field] for field in ('name', 'gender')
+                  if data.get(field, None)}
+        if date_of_birth:
+            values['date_of_birth'] = date_of_birth
+        if not values:
+            return rejected_update(Actor, actor_id, 400,
+                                   'no field to update')
         try:
-            if data.get('name', None):
-                actor.name = data['name']
-            if data.get('gender', None):
-                actor.gender = data['gender']
-            # todo: reading these fields in correct format
-            if data.get('date_of_birth', None):
-                actor.date_of_birth = data['date_of_birth']
-            actor.update()
-            return jsonify({
-                "success": True,
-                "actor": actor.long()
-            }), 200
+            actor = Actor.update_by_id(actor_id, values, if_match_versions())
+        except StaleDataError:
+            abort(412)
         except Exception:
             print(sys.exc_info())
             abort(500)
+        if actor is None:
+            abort(404)
+        return versioned(jsonify({
+            "success": True,
+            "actor": Actor.long_of(actor)
+        }), actor), 200
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
@@ -290,17 +728,18 @@ def create_app(test_config=None):
          where id is the id of the deleted record
             or appropriate status code indicating reason for failure
         """
-        actor = Actor.query.filter_by(id=actor_id).one_or_none()
-        if not actor:
-            abort(404)
         try:
-            actor.delete()
-            return jsonify({
-                'success': True,
-                'delete': actor_id,
-            })
+            deleted = Actor.delete_by_id(actor_id, if_match_versions())
+        except StaleDataError:
+            abort(412)
         except Exception:
             abort(422)
+        if not deleted:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'delete': actor_id,
+        })
 
     # Error Handling
     @app.errorhandler(422)
@@ -327,6 +766,14 @@ def create_app(test_config=None):
             "message": "bad request"
         }), 400
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
     @app.errorhandler(500)
     def server_error(error):
         return jsonify({
@@ -0,0 +1,86 @@
+"""
+ASGI entry point, the app of app.py (same routes, error handlers and auth)
+served from an event loop
+
+    uvicorn asgi:app
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+Flask 1.1 and SQLAlchemy 1.3 are synchronous: the wsgi middleware of
+uvicorn hands each request to a thread pool sized to the database
+connection pool, and the lifespan keeps the jwks keys fresh in the
+background so no request waits for auth0
+"""
+import asyncio
+import os
+
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from app import app as wsgi_app
+from auth import auth
+from models import DB_POOL_SIZE, DB_MAX_OVERFLOW, db, replicas
+
+# requests running at once per process, more threads would only wait for
+# a database connection
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS',
+                                  DB_POOL_SIZE + DB_MAX_OVERFLOW))
+# seconds between two checks of the age of the jwks keys
+JWKS_REFRESH_INTERVAL = int(os.environ.get('JWKS_REFRESH_INTERVAL', 60))
+
+
+def server_port_as_str(wsgi_app):
+    '''
+    uvicorn 0.13 puts SERVER_PORT in the environ as an int, werkzeug joins
+    it to SERVER_NAME as a str for the requests without a Host header
+    '''
+    def wrapper(environ, start_response):
+        environ['SERVER_PORT'] = str(environ['SERVER_PORT'])
+        return wsgi_app(environ, start_response)
+    return wrapper
+
+
+class Lifespan:
+    '''
+    Lifespan
+    ASGI application passing the http requests to a WSGIMiddleware and
+    refreshing the jwks keys from startup to shutdown.
+    '''
+
+    def __init__(self, http_app):
+        self.http_app = http_app
+        self.jwks_refresh = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            await self.http_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.jwks_refresh = asyncio.ensure_future(
+                    self.refresh_jwks())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.jwks_refresh is not None:
+                    self.jwks_refresh.cancel()
+                self.http_app.executor.shutdown(wait=True)
+                db.get_engine().dispose()
+                replicas.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def refresh_jwks(self):
+        '''refetches the jwks keys once half their ttl is gone'''
+        loop = asyncio.get_event_loop()
+        while True:
+            # urlopen blocks, it runs on the default executor so the
+            # request threads are not taken
+            await loop.run_in_executor(None, auth.key_provider.refresh,
+                                       auth.key_provider.ttl / 2)
+            await asyncio.sleep(JWKS_REFRESH_INTERVAL)
+
+
+app = Lifespan(WSGIMiddleware(server_port_as_str(wsgi_app),
+                              workers=ASGI_THREADS))
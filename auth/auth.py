@@ -1,6 +1,10 @@
 import os
 import json
-from flask import request
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
@@ -8,7 +12,30 @@ from urllib.request import urlopen
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'fsnd-nes.us.auth0.com')
 ALGORITHMS = os.environ.get("JWT_TOKEN_ENCRYPTION_ALGORITHMS", ['RS256'])
-API_AUDIENCE = os.environ('AUTH0_JWT_API_AUDIENCE', 'casting-agency-api')
+API_AUDIENCE = os.environ.get('AUTH0_JWT_API_AUDIENCE', 'casting-agency-api')
+# where the signing keys come from: auth0 (the jwks url, refetched),
+# jwks-file (a jwks document read once) or local (the public key of the
+# local issuer key, for tests and air-gapped deployments)
+AUTH_KEY_PROVIDER = os.environ.get('AUTH_KEY_PROVIDER', 'auth0')
+JWKS_FILE = os.environ.get('JWKS_FILE', 'jwks.json')
+LOCAL_ISSUER_KEY = os.environ.get('LOCAL_ISSUER_KEY', 'local_issuer.pem')
+# the jwks url can point to a local file (file:///path/jwks.json)
+# or a stub server when testing
+JWKS_URL = os.environ.get('JWKS_URL',
+                          f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# seconds the fetched keys are considered fresh
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+# seconds expired keys may still be served while auth0 is unreachable
+JWKS_STALE_TTL = int(os.environ.get('JWKS_STALE_TTL', 86400))
+# minimum seconds between refreshes triggered by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# bounds of the verified token cache
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES',
+                                             10000))
+TOKEN_CACHE_MAX_BYTES = int(os.environ.get('TOKEN_CACHE_MAX_BYTES',
+                                           16 * 1024 * 1024))
 
 
 # AuthError Exception
@@ -56,31 +83,309 @@ def get_token_auth_header():
     return token
 
 
+class JWKSCache:
+    '''
+    JWKSCache
+    In-process store of the signing keys published at the jwks url.
+    Keys are refetched once they are older than `ttl` or when a token
+    carries a kid we have not seen. Only one thread fetches at a time,
+    and expired keys keep being served for `stale_ttl` seconds if the
+    fetch fails.
+    '''
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, stale_ttl=JWKS_STALE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        '''downloads and parses the jwks document'''
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def _age(self):
+        if self._fetched_at is None:
+            return None
+        return time.monotonic() - self._fetched_at
+
+    def refresh(self, max_age=0):
+        '''
+        refetches the keys unless another thread already did so while we
+        were waiting for the lock (single-flight)
+        returns True if usable keys are available afterwards
+        '''
+        with self._lock:
+            age = self._age()
+            if age is not None and age < max_age:
+                return True
+            usable = age is not None and age < self.ttl + self.stale_ttl
+            if usable and self._failed_at is not None and \
+                    time.monotonic() - self._failed_at < \
+                    self.min_refresh_interval:
+                # auth0 failed us recently, do not hammer it
+                return True
+            try:
+                jwks = self.fetch()
+                self.fetch_count += 1
+                self._keys = {key['kid']: key for key in jwks['keys']}
+                self._fetched_at = time.monotonic()
+                self._failed_at = None
+                return True
+            except Exception:
+                # keep serving the keys we have until they get too old
+                self._failed_at = time.monotonic()
+                return usable
+
+    def get_key(self, kid):
+        '''returns the jwk matching kid or None'''
+        age = self._age()
+        if age is None or age >= self.ttl:
+            if age is not None and age < self.ttl + self.stale_ttl \
+                    and self._lock.locked():
+                # stale while revalidate: another request is already
+                # fetching, answer from the keys we have meanwhile
+                pass
+            elif not self.refresh(max_age=self.ttl):
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the signing keys.'
+                }, 503)
+        key = self._keys.get(kid)
+        if key is None and self._age() >= self.min_refresh_interval:
+            # the keys may have been rotated since the last fetch
+            self.refresh(max_age=self.min_refresh_interval)
+            key = self._keys.get(kid)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._failed_at = None
+
+
+class StaticJWKS:
+    '''
+    StaticJWKS
+    Signing keys of a jwks document known up front (a file or the local
+    issuer), never refetched.
+    Answers like JWKSCache so either can verify the tokens.
+    '''
+
+    def __init__(self, jwks):
+        self.ttl = JWKS_CACHE_TTL
+        self.fetch_count = 0
+        self._keys = {key['kid']: key for key in jwks['keys']}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as jwks_file:
+            return cls(json.load(jwks_file))
+
+    def refresh(self, max_age=0):
+        return True
+
+    def get_key(self, kid):
+        '''returns the jwk matching kid or None'''
+        return self._keys.get(kid)
+
+    def clear(self):
+        pass
+
+
+def make_key_provider(name=AUTH_KEY_PROVIDER):
+    '''the key store AUTH_KEY_PROVIDER names'''
+    if name == 'auth0':
+        return JWKSCache(JWKS_URL)
+    if name == 'jwks-file':
+        return StaticJWKS.from_file(JWKS_FILE)
+    if name == 'local':
+        from .issuer import LocalIssuer
+        return StaticJWKS(LocalIssuer.from_key_file(LOCAL_ISSUER_KEY).jwks())
+    raise ValueError(f'unknown AUTH_KEY_PROVIDER {name}')
+
+
+key_provider = make_key_provider()
+
+
+def permission_grants(permission):
+    '''
+    the grants that allow permission, wildcards ('*', '*:movies',
+    'delete:*') and the parents of its resource included:
+    'patch:movies' also allows 'patch:movies/casting'
+    '''
+    action, _, resource = permission.partition(':')
+    grants = {'*', '*:*', f'{action}:*'}
+    parts = resource.split('/')
+    for depth in range(1, len(parts) + 1):
+        parent = '/'.join(parts[:depth])
+        grants.update((f'{action}:{parent}', f'*:{parent}'))
+    return frozenset(grants)
+
+
+class Requirement:
+    '''
+    Requirement
+    The permissions a route asks for, all_of them and at least one of
+    any_of, compiled once when the route is declared.
+    Checking a token is a few set lookups per permission whatever the
+    size of its permissions claim.
+    '''
+
+    def __init__(self, all_of=(), any_of=()):
+        self.all_of = [permission_grants(name) for name in all_of]
+        self.any_of = [permission_grants(name) for name in any_of]
+
+    def allows(self, permissions):
+        '''permissions is the frozenset of the permissions claim'''
+        return all(not permissions.isdisjoint(grants)
+                   for grants in self.all_of) and \
+            (not self.any_of or any(not permissions.isdisjoint(grants)
+                                    for grants in self.any_of))
+
+
+def compile_permissions(payload):
+    '''the permissions claim as a frozenset, None if the token has none'''
+    if 'permissions' not in payload:
+        return None
+    return frozenset(payload['permissions'])
+
+
+class TokenCache:
+    '''
+    TokenCache
+    Bounded LRU of already verified tokens, keyed by the sha256 of the
+    token so the raw bearer tokens are never kept around. The compiled
+    permissions are kept next to the payload.
+    An entry is dropped once the token reaches its `exp` claim, and the
+    least recently used entries are evicted when either `max_entries`
+    or the estimated `max_bytes` is exceeded.
+    '''
+
+    # rough per entry overhead of the dict, the key and the tuple
+    ENTRY_OVERHEAD = 200
+    # bytes per permission of the compiled set
+    SET_SLOT = 40
+
+    def __init__(self, max_entries=TOKEN_CACHE_MAX_ENTRIES,
+                 max_bytes=TOKEN_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def lookup(self, token):
+        '''returns the cached (payload, permissions) of token or None'''
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[3]
+
+    def get(self, token):
+        '''returns the cached payload of token or None'''
+        entry = self.lookup(token)
+        return entry and entry[0]
+
+    def put(self, token, payload, permissions=None):
+        '''caches the verified payload until the token expires'''
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)) or \
+                expires_at <= time.time():
+            return
+        if permissions is None:
+            permissions = compile_permissions(payload)
+        key = self.digest(token)
+        # the set holds the strings of the payload, only its table counts
+        size = len(json.dumps(payload)) + len(key) + self.ENTRY_OVERHEAD + \
+            self.SET_SLOT * len(permissions or ())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (payload, expires_at, size, permissions)
+            self.size += size
+            while len(self._entries) > self.max_entries or \
+                    self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry[2]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+token_cache = TokenCache()
+
+
 def check_permissions(permission, payload):
     """check permission in payload"""
+    check_requirement(Requirement(all_of=[permission]),
+                      compile_permissions(payload))
+
+    # if conditions pass return true
+    return True
+
+
+def check_requirement(requirement, permissions):
+    """checks the compiled permissions of a token against a route"""
     # Ensures that there is permissions field in the payload
-    if 'permissions' not in payload:
+    if permissions is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 401)
 
-    # Ensures that the specific permission exists
-    if permission not in payload['permissions']:
+    # Ensures that the required permissions are granted
+    if not requirement.allows(permissions):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
         }, 401)
 
-    # if conditions pass return true
-    return True
-
 
 def verify_decode_jwt(token):
     '''Verifies and decodes the jwt from the given token'''
 
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -89,15 +394,15 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = key_provider.get_key(unverified_header['kid'])
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -147,14 +452,35 @@ def verify_decode_jwt(token):
 '''
 
 
-def requires_auth(permission=''):
-    'Authentication decorator function'
+def requires_auth(permission='', all_of=(), any_of=()):
+    '''
+    Authentication decorator function
+    the token needs permission, every permission of all_of and one of
+    any_of, wildcard grants included (see permission_grants)
+    '''
+    requirement = Requirement(
+        all_of=([permission] if permission or not (all_of or any_of)
+                else []) + list(all_of),
+        any_of=any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            started = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                entry = token_cache.lookup(token)
+                if entry is None:
+                    payload = verify_decode_jwt(token)
+                    entry = payload, compile_permissions(payload)
+                    token_cache.put(token, *entry)
+                payload, permissions = entry
+                # permissions are checked on every request, cached or not
+                check_requirement(requirement, permissions)
+            finally:
+                # reported in the Server-Timing header and the metrics
+                g.auth_seconds = g.get('auth_seconds', 0) + \
+                    time.perf_counter() - started
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,103 @@
+import base64
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import rsa
+from jose import jwt
+
+from .auth import AUTH0_DOMAIN, API_AUDIENCE
+
+# permissions of the auth0 roles, see the Roles section of the README
+CASTING_ASSISTANT = ['get:actors-id', 'get:movies-id']
+CASTING_DIRECTOR = CASTING_ASSISTANT + [
+    'post:actors', 'delete:actors', 'patch:actors', 'patch:movies']
+EXECUTIVE_PRODUCER = CASTING_DIRECTOR + ['post:movies', 'delete:movies']
+ROLE_PERMISSIONS = {
+    'assistant': CASTING_ASSISTANT,
+    'director': CASTING_DIRECTOR,
+    'producer': EXECUTIVE_PRODUCER,
+}
+
+
+def b64_uint(value):
+    '''an rsa integer as the base64url string of a jwk'''
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+class LocalIssuer:
+    '''
+    LocalIssuer
+    Signs tokens shaped like the auth0 ones (issuer, audience, permissions)
+    with its own rsa key, and publishes the public key as a jwks document,
+    so the api verifies them without auth0
+    '''
+
+    def __init__(self, kid='local-key', private_key=None, bits=2048,
+                 issuer=f'https://{AUTH0_DOMAIN}/', audience=API_AUDIENCE):
+        if private_key is None:
+            _, private_key = rsa.newkeys(bits)
+        self.private_key = private_key
+        self.kid = kid
+        self.issuer = issuer
+        self.audience = audience
+
+    @classmethod
+    def from_key_file(cls, path, kid='local-key', bits=2048):
+        '''
+        the issuer of the pem private key at path, generated and written
+        there on first use so the api and the minting side share it
+        '''
+        try:
+            with open(path, 'rb') as key_file:
+                private_key = rsa.PrivateKey.load_pkcs1(key_file.read())
+        except FileNotFoundError:
+            _, private_key = rsa.newkeys(bits)
+            # written aside (mode 0600) then linked in place, a worker
+            # starting at the same time reads a whole key, never half one
+            descriptor, written = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                with os.fdopen(descriptor, 'wb') as key_file:
+                    key_file.write(private_key.save_pkcs1())
+                os.link(written, path)
+            except FileExistsError:
+                # another worker linked its key first, use that one
+                return cls.from_key_file(path, kid, bits)
+            finally:
+                os.remove(written)
+        return cls(kid=kid, private_key=private_key)
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': b64_uint(self.private_key.n),
+            'e': b64_uint(self.private_key.e),
+        }]}
+
+    def write_jwks(self, path):
+        '''writes the jwks document, serve it with JWKS_URL=file://path'''
+        with open(path, 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+
+    def mint(self, role='producer', permissions=None, ttl=3600, **claims):
+        '''a signed token holding the permissions of role'''
+        now = int(time.time())
+        payload = {
+            'iss': self.issuer,
+            'sub': f'local|{role}-{uuid.uuid4().hex[:8]}',
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': list(ROLE_PERMISSIONS[role]
+                                if permissions is None else permissions),
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_key.save_pkcs1().decode(),
+                          algorithm='RS256', headers={'kid': self.kid})
@@ -0,0 +1,64 @@
+"""
+Insert latency of POST /movies as the movies table grows
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/bench_create.py
+
+the handler is called without the auth decorator so only the insert
+and the response serialization are measured
+"""
+import os
+import sys
+import time
+import uuid
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from app import app  # noqa: E402
+from models import Movies, db  # noqa: E402
+from schema import upgrade_schema  # noqa: E402
+
+TABLE_SIZES = [0, 1000, 5000, 20000]
+INSERTS = 50
+
+
+def seed(count):
+    '''grows the movies table by count rows'''
+    rows = [{'title': f'seed {uuid.uuid4()}', 'duration': 90,
+             'release_year': 2000} for _ in range(count)]
+    if rows:
+        db.session.execute(Movies.__table__.insert(), rows)
+        db.session.commit()
+
+
+def time_inserts(view, query_string):
+    timings = []
+    for _ in range(INSERTS):
+        body = {'title': f'bench {uuid.uuid4()}', 'duration': 120,
+                'release_year': 2021}
+        with app.test_request_context('/movies' + query_string,
+                                      method='POST', json=body):
+            start = time.perf_counter()
+            view({})
+            timings.append(time.perf_counter() - start)
+    return median(timings) * 1000
+
+
+def main():
+    view = app.view_functions['create_movie'].__wrapped__
+    with app.app_context():
+        upgrade_schema(app, db)
+        print(f'{"rows":>8} {"created only ms":>16} {"full_list ms":>14}')
+        seeded = Movies.query.count()
+        for size in TABLE_SIZES:
+            seed(max(size - seeded, 0))
+            seeded = Movies.query.count()
+            created_only = time_inserts(view, '')
+            full_list = time_inserts(view, '?full_list=true')
+            seeded = Movies.query.count()
+            print(f'{seeded:>8} {created_only:>16.2f} {full_list:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
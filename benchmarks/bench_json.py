@@ -0,0 +1,110 @@
+"""
+Throughput of the json response path on large lists of actors
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/bench_json.py
+
+compares building Actor.long() dicts from model objects (strftime per row)
+and encoding them with flask.jsonify, with building them from result
+tuples (cached date formatting) and encoding them with jsonutil.jsonify
+under every encoder installed (orjson, ujson, json)
+prints the response bytes per second of each
+"""
+import os
+import random
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from flask import jsonify as flask_jsonify  # noqa: E402
+
+import jsonutil  # noqa: E402
+from app import app  # noqa: E402
+from models import Actor, db  # noqa: E402
+from schema import upgrade_schema  # noqa: E402
+
+ROW_COUNTS = [1000, 10000, 100000]
+ROUNDS = 5
+SEED_CHUNK = 10000
+
+
+def seed(count, start):
+    for offset in range(0, count, SEED_CHUNK):
+        db.session.execute(Actor.__table__.insert(), [{
+            'name': f'actor {number}',
+            'gender': random.choice('MF'),
+            'date_of_birth': date(random.randint(1930, 2005),
+                                  random.randint(1, 12),
+                                  random.randint(1, 28)),
+        } for number in range(start + offset,
+                              start + min(offset + SEED_CHUNK, count))])
+        db.session.commit()
+
+
+def model_path(limit):
+    '''the path of the handlers before: model objects and flask.jsonify'''
+    actors = [{
+        'id': actor.id,
+        'name': actor.name,
+        'date_of_birth': actor.date_of_birth.strftime('%B %d, %Y'),
+        'gender': actor.gender,
+    } for actor in Actor.query.order_by(Actor.id).limit(limit)]
+    return flask_jsonify({'success': True, 'actor': actors})
+
+
+def tuple_path(limit, dumps):
+    '''result tuples, cached date formatting and the fast encoder'''
+    jsonutil.dumps = dumps
+    actors = [{
+        'id': actor_id,
+        'name': name,
+        'date_of_birth': jsonutil.format_date(date_of_birth),
+        'gender': gender,
+    } for actor_id, name, date_of_birth, gender in Actor.query
+        .with_entities(Actor.id, Actor.name, Actor.date_of_birth,
+                       Actor.gender).order_by(Actor.id).limit(limit)]
+    return jsonutil.jsonify({'success': True, 'actor': actors})
+
+
+def throughput(build):
+    '''median MB/s of building the response, and its size'''
+    rates = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        size = len(build().get_data())
+        rates.append(size / (time.perf_counter() - start) / 1e6)
+    return sorted(rates)[len(rates) // 2], size
+
+
+def main():
+    random.seed(0)
+    paths = [('model + flask.jsonify', model_path)]
+    for name in ('orjson', 'ujson', 'json'):
+        try:
+            dumps = jsonutil.make_dumps(name)
+        except ImportError:
+            print(f'{name} is not installed, skipped', file=sys.stderr)
+            continue
+        paths.append((f'tuples + {name}',
+                      lambda limit, dumps=dumps: tuple_path(limit, dumps)))
+    default_dumps = jsonutil.dumps
+
+    with app.app_context():
+        upgrade_schema(app, db)
+        print(f'{"rows":>7} {"path":>22} {"MB/s":>8} {"bytes":>10}')
+        seeded = Actor.query.count()
+        for count in ROW_COUNTS:
+            seed(max(count - seeded, 0), seeded)
+            seeded = max(seeded, count)
+            for label, path in paths:
+                # every path starts with a cold date cache
+                jsonutil.format_date.cache_clear()
+                rate, size = throughput(lambda: path(count))
+                print(f'{count:>7} {label:>22} {rate:>8.1f} {size:>10}')
+    jsonutil.dumps = default_dumps
+
+
+if __name__ == '__main__':
+    sys.exit(main())
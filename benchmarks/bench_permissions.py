@@ -0,0 +1,46 @@
+"""
+Cost of a permission check as the permissions claim of a token grows
+
+    python benchmarks/bench_permissions.py
+
+compares the list scan of the raw claim with the check of the claim
+compiled into a set (what requires_auth does with a cached token), for a
+permission granted at the end of the claim and one that is not granted
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from auth.auth import Requirement, compile_permissions  # noqa: E402
+
+CLAIM_SIZES = [10, 100, 1000, 10000]
+CHECKS = 20000
+
+
+def claim(size):
+    '''size tenant permissions followed by the ones of the api'''
+    return [f'get:tenant-{number}/movies' for number in range(size)] + \
+        ['get:movies-id', 'patch:movies']
+
+
+def main():
+    print(f'{"claim":>7} {"permission":>14} {"list scan us":>13} '
+          f'{"compiled us":>12}')
+    for size in CLAIM_SIZES:
+        payload = {'permissions': claim(size)}
+        permissions = compile_permissions(payload)
+        for name in ('patch:movies', 'delete:movies'):
+            requirement = Requirement(all_of=[name])
+            scan = timeit.timeit(
+                lambda: name in payload['permissions'], number=CHECKS)
+            compiled = timeit.timeit(
+                lambda: requirement.allows(permissions), number=CHECKS)
+            print(f'{size:>7} {name:>14} {scan / CHECKS * 1e6:>13.3f} '
+                  f'{compiled / CHECKS * 1e6:>12.3f}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
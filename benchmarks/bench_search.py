@@ -0,0 +1,69 @@
+"""
+Latency of GET /search as the catalog grows
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/bench_search.py
+
+the migrations run first so on postgresql the tsvector columns and their
+GIN indexes exist, on sqlite the in-process index is built before timing
+"""
+import os
+import random
+import sys
+import time
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from app import app  # noqa: E402
+from models import Movies, db  # noqa: E402
+from schema import upgrade_schema  # noqa: E402
+from search import search  # noqa: E402
+
+TABLE_SIZES = [10000, 100000, 1000000]
+SEARCHES = 50
+SEED_CHUNK = 10000
+WORDS = ['night', 'star', 'return', 'empire', 'lost', 'city', 'dark',
+         'river', 'king', 'summer', 'ghost', 'last', 'silent', 'red',
+         'winter', 'road', 'island', 'storm', 'garden', 'house']
+
+
+def seed(count, start):
+    '''grows the movies table by count rows of random three word titles'''
+    for offset in range(0, count, SEED_CHUNK):
+        rows = [{'title': f'{" ".join(random.sample(WORDS, 3))} {number}',
+                 'duration': 90, 'release_year': 2000}
+                for number in range(start + offset,
+                                    start + min(offset + SEED_CHUNK, count))]
+        db.session.execute(Movies.__table__.insert(), rows)
+        db.session.commit()
+
+
+def time_searches(query):
+    timings = []
+    for _ in range(SEARCHES):
+        start = time.perf_counter()
+        search({'q': query, 'limit': 20})
+        timings.append(time.perf_counter() - start)
+    return median(timings) * 1000, max(timings) * 1000
+
+
+def main():
+    random.seed(0)
+    with app.app_context():
+        upgrade_schema(app, db)
+        print(f'{"rows":>8} {"query":>12} {"median ms":>10} {"max ms":>8}')
+        seeded = Movies.query.count()
+        for size in TABLE_SIZES:
+            seed(max(size - seeded, 0), seeded)
+            seeded = Movies.query.count()
+            # first search builds the sqlite index, not timed
+            search({'q': 'warmup'})
+            for query in ('ghost', 'sil', 'dark river', 'red wint'):
+                median_ms, max_ms = time_searches(query)
+                print(f'{seeded:>8} {query:>12} {median_ms:>10.2f} '
+                      f'{max_ms:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
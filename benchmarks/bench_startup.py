@@ -0,0 +1,94 @@
+"""
+Import time of the app and time to the first response of a fresh server
+
+    DATABASE_URL=postgresql://localhost/casting \
+        python benchmarks/bench_startup.py --workers 1,4
+
+prints the median time to import app.py and manage.py in a new
+interpreter, then starts gunicorn with and without --preload for every
+worker count and prints the time until it answers GET / (no database)
+and GET /movies (the first connection and query)
+run `python manage.py init_db` on the database first
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from statistics import median
+from urllib.error import URLError
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 8121
+IMPORT_SCRIPT = '''
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+'''
+
+
+def import_time(module, runs):
+    '''median seconds to import module in a new interpreter'''
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)],
+            cwd=ROOT, check=True, capture_output=True, text=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return median(timings)
+
+
+def wait_for(url, started, timeout=30):
+    '''seconds from started until url answers 200'''
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except (URLError, OSError):
+            time.sleep(0.005)
+    raise RuntimeError(f'{url} did not answer')
+
+
+def first_responses(workers, preload):
+    env = dict(os.environ, GUNICORN_PRELOAD='true' if preload else 'false',
+               RESPONSE_CACHE_URL='none', WEB_CONCURRENCY=str(workers))
+    url = f'http://127.0.0.1:{PORT}'
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        ['gunicorn', 'app:app', '--bind', f'127.0.0.1:{PORT}'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        welcome = wait_for(url + '/', started)
+        movies = wait_for(url + '/movies?limit=1', started)
+    finally:
+        process.terminate()
+        process.wait()
+    return welcome, movies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', default='1,4')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in ('app', 'manage'):
+        print(f'import {module:<7} {import_time(module, args.runs):.3f} s')
+    print(f'{"workers":>7} {"preload":>8} {"GET / s":>8} '
+          f'{"GET /movies s":>14}')
+    for workers in map(int, args.workers.split(',')):
+        for preload in (True, False):
+            runs = [first_responses(workers, preload)
+                    for _ in range(args.runs)]
+            print(f'{workers:>7} {str(preload):>8} '
+                  f'{median(run[0] for run in runs):>8.3f} '
+                  f'{median(run[1] for run in runs):>14.3f}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Throughput and latency of the sync (gunicorn app:app) and the async
+(asgi:app under uvicorn workers) servers side by side
+
+    DATABASE_URL=postgresql://localhost/casting \
+        python benchmarks/loadtest.py --concurrency 16,64,256 --duration 10
+
+starts both servers with the same number of workers (or targets running
+ones with --sync-url / --async-url), then keeps --concurrency requests in
+flight against each for --duration seconds and prints the requests per
+second, the p50 / p99 latency and the errors
+the servers run without the response cache unless RESPONSE_CACHE_URL is
+set, so every request reaches the database, and without worker recycling
+(GUNICORN_MAX_REQUESTS)
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from auth.issuer import LocalIssuer  # noqa: E402
+
+SERVERS = {
+    'sync': ['gunicorn', 'app:app', '--workers', '{workers}',
+             '--bind', '127.0.0.1:{port}'],
+    'async': ['gunicorn', 'asgi:app', '--workers', '{workers}',
+              '--worker-class', '{worker_class}',
+              '--bind', '127.0.0.1:{port}'],
+}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def start_server(mode, port, workers, worker_class, env=None):
+    command = [part.format(port=port, workers=workers,
+                           worker_class=worker_class)
+               for part in SERVERS[mode]]
+    env = dict(os.environ, **(env or {}))
+    env.setdefault('RESPONSE_CACHE_URL', 'none')
+    # a recycled uvicorn worker resets its keep-alive connections
+    env.setdefault('GUNICORN_MAX_REQUESTS', '0')
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            urlopen(url + '/', timeout=1).close()
+            return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f'the {mode} server did not start')
+
+
+async def read_response(reader):
+    '''
+    reads an http/1.1 response, chunked or not
+    returns its status and headers (lower case names)
+    '''
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, value = line.decode('latin1').split(':', 1)
+        headers[name.strip().lower()] = value.strip().lower()
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, headers
+
+
+def encode_request(method, path, host, token, body=None):
+    lines = [f'{method} {path} HTTP/1.1', f'Host: {host}',
+             f'Authorization: Bearer {token}']
+    data = b''
+    if body is not None:
+        data = json.dumps(body).encode()
+        lines += ['Content-Type: application/json',
+                  f'Content-Length: {len(data)}']
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + data
+
+
+async def client(url, paths, token, deadline, latencies, errors):
+    '''one request in flight at a time, over a keep-alive connection'''
+    parts = urlsplit(url)
+    connection = None
+    turn = 0
+    while time.perf_counter() < deadline:
+        path = paths[turn % len(paths)]
+        turn += 1
+        request = encode_request('GET', path, parts.netloc, token)
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(
+                    parts.hostname, parts.port)
+            reader, writer = connection
+            writer.write(request)
+            status, headers = await read_response(reader)
+            close = headers.get('connection') == 'close'
+            if status >= 500:
+                errors.append(status)
+            else:
+                latencies.append(time.perf_counter() - start)
+        except (OSError, ValueError, IndexError,
+                asyncio.IncompleteReadError):
+            errors.append('connection')
+            close = True
+        if close and connection is not None:
+            connection[1].close()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+async def run_load(url, paths, token, concurrency, duration):
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(client(url, paths, token, deadline, latencies,
+                                  errors)
+                           for _ in range(concurrency)))
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--concurrency', default='16,64,256')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--path', action='append', dest='paths',
+                        help='request path, repeat for a mix '
+                             '(default /movies?limit=20)')
+    parser.add_argument('--token', default=os.environ.get('TOKEN'),
+                        help='bearer token of running servers, the servers '
+                             'started here accept a local one')
+    # UvicornWorker is faster but needs uvloop and httptools
+    parser.add_argument('--async-worker',
+                        default='uvicorn.workers.UvicornH11Worker')
+    parser.add_argument('--sync-url')
+    parser.add_argument('--async-url')
+    args = parser.parse_args()
+    paths = args.paths or ['/movies?limit=20']
+
+    env = {}
+    if not args.token:
+        issuer = LocalIssuer()
+        env = {'AUTH_KEY_PROVIDER': 'jwks-file',
+               'JWKS_FILE': tempfile.mktemp(suffix='.json')}
+        issuer.write_jwks(env['JWKS_FILE'])
+        args.token = issuer.mint('producer', ttl=24 * 3600)
+
+    processes = []
+    urls = {}
+    try:
+        for port, mode in enumerate(('sync', 'async'), 8101):
+            urls[mode] = getattr(args, f'{mode}_url')
+            if not urls[mode]:
+                process, urls[mode] = start_server(
+                    mode, port, args.workers, args.async_worker, env)
+                processes.append(process)
+
+        print(f'{"server":>6} {"clients":>8} {"req/s":>9} {"p50 ms":>8} '
+              f'{"p99 ms":>8} {"errors":>7}')
+        for concurrency in map(int, args.concurrency.split(',')):
+            for mode in ('sync', 'async'):
+                latencies, errors = asyncio.run(run_load(
+                    urls[mode], paths, args.token, concurrency,
+                    args.duration))
+                if not latencies:
+                    print(f'{mode:>6} {concurrency:>8} {"-":>9} {"-":>8} '
+                          f'{"-":>8} {len(errors):>7}')
+                    continue
+                print(f'{mode:>6} {concurrency:>8} '
+                      f'{len(latencies) / args.duration:>9.1f} '
+                      f'{percentile(latencies, 0.5) * 1000:>8.1f} '
+                      f'{percentile(latencies, 0.99) * 1000:>8.1f} '
+                      f'{len(errors):>7}')
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if env:
+            os.remove(env['JWKS_FILE'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,17 @@
+"""
+schema of the benchmark databases, made by the migrations as
+`python manage.py db upgrade` makes it, so the indexes, the search
+columns and the triggers are the ones the api runs with
+"""
+import os
+
+from flask_migrate import Migrate, upgrade
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'migrations')
+
+
+def upgrade_schema(app, db):
+    '''runs the pending migrations on the database of app, in its context'''
+    Migrate(app, db, directory=MIGRATIONS)
+    upgrade(directory=MIGRATIONS)
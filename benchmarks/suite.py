@@ -0,0 +1,436 @@
+"""
+Benchmark suite of every route of the api, with a regression check
+
+    DATABASE_URL=sqlite:////tmp/bench.db python benchmarks/suite.py \
+        --scale 1k --concurrency 16 --duration 5
+
+seeds the database with synthetic movies, actors and castings up to the
+scale (1k, 100k or 1m movies and actors), starts the api with a local
+token issuer (no auth0 access needed), then drives each route in turn at
+the given concurrency and prints the requests per second, the p50, p95
+and p99 latency, the SQL statements per request (from the Server-Timing
+header) and the errors
+
+the results are compared with benchmarks/baseline.json: the suite exits
+with status 1 when a route lost more than --tolerance of its throughput,
+grew its p99 latency by more than --latency-tolerance, runs more
+statements or fails where it used to succeed
+--update-baseline stores the results as the new baseline
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from auth.issuer import LocalIssuer  # noqa: E402
+from loadtest import percentile, read_response, encode_request, \
+    start_server  # noqa: E402
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+SEED_CHUNK = 10000
+# movies and actors (a tenth of the scale) the DELETE routes remove,
+# topped up on every run
+DELETE_FRACTION = 10
+# actors cast in each seeded movie
+CAST_SIZE = 3
+# routes whose responses are the whole table run with fewer clients
+EXPORT_CONCURRENCY = 2
+WORDS = ['night', 'star', 'return', 'empire', 'lost', 'city', 'dark',
+         'river', 'king', 'summer', 'ghost', 'last', 'silent', 'red',
+         'winter', 'road', 'island', 'storm', 'garden', 'house']
+
+
+def seed(rows):
+    '''
+    grows the movies and actors tables to rows each, casts CAST_SIZE
+    actors in every new movie and adds the rows the DELETE routes remove
+    returns the ids the routes draw from
+    '''
+    from app import app
+    from models import db, Movies, Actor, Casting
+    from schema import upgrade_schema
+
+    pool_size = rows // DELETE_FRACTION
+    with app.app_context():
+        upgrade_schema(app, db)
+        movies = Movies.query.filter(~Movies.title.like('victim %')).count()
+        actors = Actor.query.filter(~Actor.name.like('victim %')).count()
+        for start in range(movies, rows, SEED_CHUNK):
+            db.session.execute(Movies.__table__.insert(), [{
+                'title': f'{" ".join(random.sample(WORDS, 2))} {number}',
+                'duration': random.randint(80, 200),
+                'release_year': random.randint(1950, 2021),
+            } for number in range(start, min(start + SEED_CHUNK, rows))])
+            db.session.commit()
+        for start in range(actors, rows, SEED_CHUNK):
+            db.session.execute(Actor.__table__.insert(), [{
+                'name': f'{random.choice(WORDS).title()} {number}',
+                'gender': random.choice('MF'),
+                'date_of_birth': date(random.randint(1930, 2005),
+                                      random.randint(1, 12),
+                                      random.randint(1, 28)),
+            } for number in range(start, min(start + SEED_CHUNK, rows))])
+            db.session.commit()
+
+        movie_ids = [movie_id for movie_id, in Movies.query
+                     .with_entities(Movies.id)
+                     .filter(~Movies.title.like('victim %'))
+                     .order_by(Movies.id)]
+        actor_ids = [actor_id for actor_id, in Actor.query
+                     .with_entities(Actor.id)
+                     .filter(~Actor.name.like('victim %'))
+                     .order_by(Actor.id)]
+        cast = {movie_id for movie_id, in Casting.query
+                .with_entities(Casting.movie_id).distinct()}
+        uncast = [movie_id for movie_id in movie_ids if movie_id not in cast]
+        for start in range(0, len(uncast), SEED_CHUNK):
+            db.session.execute(Casting.__table__.insert(), [{
+                'movie_id': movie_id,
+                'actor_id': actor_ids[(index + offset) % len(actor_ids)],
+                'role': f'role {offset}',
+                'billing_order': offset,
+            } for index, movie_id in enumerate(uncast[start:
+                                                      start + SEED_CHUNK],
+                                               start)
+                for offset in range(CAST_SIZE)])
+            db.session.commit()
+
+        victims = {}
+        for model, column, values in (
+                (Movies, 'title', {'duration': 90, 'release_year': 2000}),
+                (Actor, 'name', {'gender': 'F',
+                                 'date_of_birth': date(1980, 1, 1)})):
+            victim = getattr(model, column).like('victim %')
+            missing = pool_size - model.query.filter(victim).count()
+            if missing > 0:
+                db.session.execute(model.__table__.insert(), [
+                    dict(values, **{column: f'victim {number}'})
+                    for number in range(missing)])
+                db.session.commit()
+            victims[model.__tablename__] = [
+                row_id for row_id, in model.query.with_entities(model.id)
+                .filter(victim)]
+        castings = [(movie_id, actor_id) for movie_id, actor_id
+                    in Casting.query.with_entities(Casting.movie_id,
+                                                   Casting.actor_id)
+                    .limit(pool_size)]
+    return movie_ids, actor_ids, victims, castings
+
+
+def routes(movie_ids, actor_ids, victims, castings):
+    '''
+    (name, request factory, concurrency cap) of every route of app.py
+    a factory returns (method, path, body) or None once its pool is used up
+    '''
+    def unique():
+        return f'{random.choice(WORDS)} {time.time()} {random.random()}'
+
+    def movie():
+        return {'title': f'bench {unique()}', 'duration': 120,
+                'release_year': random.randint(1950, 2021)}
+
+    def actor():
+        return {'name': f'bench {unique()}', 'gender': 'F',
+                'date_of_birth': '1980-01-01'}
+
+    def pool(items):
+        items = iter(items)
+        return lambda: next(items, None)
+
+    def batches(items, size=10):
+        return [items[start:start + size]
+                for start in range(0, len(items) - size + 1, size)]
+
+    # half of the victims go to the single deletes, half to the bulk ones
+    movie_half = len(victims['movies']) // 2
+    actor_half = len(victims['actors']) // 2
+    movie_victims = pool(victims['movies'][:movie_half])
+    actor_victims = pool(victims['actors'][:actor_half])
+    movie_victim_batches = pool(batches(victims['movies'][movie_half:]))
+    actor_victim_batches = pool(batches(victims['actors'][actor_half:]))
+    uncast = pool(castings)
+    # a movie and a random actor, already cast now and then (422)
+    new_casts = pool((movie_id, random.choice(actor_ids))
+                     for movie_id in movie_ids)
+
+    def some_movie():
+        return random.choice(movie_ids)
+
+    def some_actor():
+        return random.choice(actor_ids)
+
+    def then(item, build):
+        return None if item is None else build(item)
+
+    return [
+        ('GET /', lambda: ('GET', '/', None), None),
+        ('GET /authorization/url',
+         lambda: ('GET', '/authorization/url', None), None),
+        ('GET /metrics', lambda: ('GET', '/metrics', None), None),
+        ('GET /search',
+         lambda: ('GET', f'/search?q={random.choice(WORDS)[:3]}', None),
+         None),
+        ('GET /movies', lambda: ('GET', '/movies?limit=20', None), None),
+        ('GET /movies?after',
+         lambda: ('GET', f'/movies?limit=20&after={some_movie()}', None),
+         None),
+        ('GET /movies?sort&filter',
+         lambda: ('GET', '/movies?limit=20&sort=-release_year'
+                  f'&release_year_min={random.randint(1950, 2021)}', None),
+         None),
+        ('GET /movies?include',
+         lambda: ('GET', '/movies?limit=20&include=actors', None), None),
+        ('GET /movies/<id>',
+         lambda: ('GET', f'/movies/{some_movie()}', None), None),
+        ('GET /movies/<id>?include',
+         lambda: ('GET', f'/movies/{some_movie()}?include=actors', None),
+         None),
+        ('POST /movies', lambda: ('POST', '/movies', movie()), None),
+        ('POST /movies/bulk',
+         lambda: ('POST', '/movies/bulk', [movie() for _ in range(10)]),
+         None),
+        ('PATCH /movies',
+         lambda: ('PATCH', '/movies', [
+             {'id': movie_id, 'fields': {
+                 'duration': random.randint(80, 200)}}
+             for movie_id in random.sample(movie_ids, 10)]), None),
+        ('PATCH /movies/<id>',
+         lambda: ('PATCH', f'/movies/{some_movie()}',
+                  {'duration': random.randint(80, 200)}), None),
+        ('DELETE /movies/<id>',
+         lambda: then(movie_victims(),
+                      lambda movie_id: ('DELETE', f'/movies/{movie_id}',
+                                        None)), None),
+        ('DELETE /movies',
+         lambda: then(movie_victim_batches(),
+                      lambda ids: ('DELETE', '/movies', {'ids': ids})),
+         None),
+        ('POST /movies/<id>/actors',
+         lambda: then(new_casts(), lambda pair: (
+             'POST', f'/movies/{pair[0]}/actors',
+             {'actor_id': pair[1], 'role': 'bench'})), None),
+        ('DELETE /movies/<id>/actors/<id>',
+         lambda: then(uncast(), lambda pair: (
+             'DELETE', f'/movies/{pair[0]}/actors/{pair[1]}', None)), None),
+        ('GET /movies/export',
+         lambda: ('GET', '/movies/export', None), EXPORT_CONCURRENCY),
+        ('GET /actors', lambda: ('GET', '/actors?limit=20', None), None),
+        ('GET /actors?include',
+         lambda: ('GET', '/actors?limit=20&include=movies', None), None),
+        ('GET /actors/<id>',
+         lambda: ('GET', f'/actors/{some_actor()}', None), None),
+        ('POST /actors', lambda: ('POST', '/actors', actor()), None),
+        ('POST /actors/bulk',
+         lambda: ('POST', '/actors/bulk', [actor() for _ in range(10)]),
+         None),
+        ('PATCH /actors',
+         lambda: ('PATCH', '/actors', [
+             {'id': actor_id, 'fields': {'gender': random.choice('MF')}}
+             for actor_id in random.sample(actor_ids, 10)]), None),
+        ('PATCH /actors/<id>',
+         lambda: ('PATCH', f'/actors/{some_actor()}',
+                  {'gender': random.choice('MF')}), None),
+        ('DELETE /actors/<id>',
+         lambda: then(actor_victims(),
+                      lambda actor_id: ('DELETE', f'/actors/{actor_id}',
+                                        None)), None),
+        ('DELETE /actors',
+         lambda: then(actor_victim_batches(),
+                      lambda ids: ('DELETE', '/actors', {'ids': ids})),
+         None),
+        ('GET /actors/export',
+         lambda: ('GET', '/actors/export', None), EXPORT_CONCURRENCY),
+    ]
+
+
+def statements(headers):
+    '''the SQL statement count of the Server-Timing header'''
+    for timing in headers.get('server-timing', '').split(','):
+        if timing.strip().startswith('db;'):
+            return int(timing.split('desc="')[1].split(' ')[0])
+    return None
+
+
+async def client(url, token, make_request, deadline, results):
+    parts = urlsplit(url)
+    connection = None
+    while time.perf_counter() < deadline:
+        request = make_request()
+        if request is None:
+            break
+        method, path, body = request
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(
+                    parts.hostname, parts.port)
+            reader, writer = connection
+            writer.write(encode_request(method, path, parts.netloc, token,
+                                        body))
+            status, headers = await read_response(reader)
+            close = headers.get('connection') == 'close'
+            if status >= 400:
+                results['errors'] += 1
+            else:
+                results['latencies'].append(time.perf_counter() - start)
+                count = statements(headers)
+                if count is not None:
+                    results['statements'].append(count)
+        except (OSError, ValueError, IndexError,
+                asyncio.IncompleteReadError):
+            results['errors'] += 1
+            close = True
+        if close and connection is not None:
+            connection[1].close()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+async def drive(url, token, make_request, concurrency, duration):
+    results = {'latencies': [], 'statements': [], 'errors': 0}
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(client(url, token, make_request, deadline,
+                                  results) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies = results['latencies']
+    if not latencies:
+        return {'requests': 0, 'errors': results['errors']}
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statements': round(sum(results['statements']) /
+                            len(results['statements']), 2)
+        if results['statements'] else None,
+        'errors': results['errors'],
+    }
+
+
+def regressions(results, baseline, tolerance, latency_tolerance):
+    '''descriptions of the routes that got worse than the baseline'''
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or not before.get('requests'):
+            continue
+        if not result.get('requests'):
+            found.append(f'{name}: every request failed')
+            continue
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            found.append(f'{name}: {result["rps"]} req/s, '
+                         f'baseline {before["rps"]}')
+        if result['p99_ms'] > before['p99_ms'] * (1 + latency_tolerance):
+            found.append(f'{name}: p99 {result["p99_ms"]} ms, '
+                         f'baseline {before["p99_ms"]}')
+        if result['statements'] is not None and \
+                before.get('statements') is not None and \
+                result['statements'] > before['statements'] + 0.5:
+            found.append(f'{name}: {result["statements"]} statements, '
+                         f'baseline {before["statements"]}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds per route')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--server', choices=('sync', 'async'),
+                        default='sync')
+    parser.add_argument('--async-worker',
+                        default='uvicorn.workers.UvicornH11Worker')
+    parser.add_argument('--route', action='append', dest='routes',
+                        help='only the routes starting with this name')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed throughput loss')
+    # tail latency is the noisiest figure on a shared machine
+    parser.add_argument('--latency-tolerance', type=float, default=0.5,
+                        help='allowed p99 latency growth')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f'seeding {args.scale} rows', file=sys.stderr)
+    pools = seed(SCALES[args.scale])
+
+    issuer = LocalIssuer()
+    jwks_path = tempfile.mktemp(suffix='.json')
+    issuer.write_jwks(jwks_path)
+    token = issuer.mint('producer', ttl=24 * 3600)
+    process, url = start_server(args.server, 8111, args.workers,
+                                args.async_worker,
+                                env={'AUTH_KEY_PROVIDER': 'jwks-file',
+                                     'JWKS_FILE': jwks_path,
+                                     'SERVER_TIMING': 'true'})
+    results = {}
+    try:
+        print(f'{"route":<34} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+              f'{"p99 ms":>8} {"stmts":>6} {"errors":>6}')
+        for name, make_request, cap in routes(*pools):
+            if args.routes and not any(name.startswith(prefix)
+                                       for prefix in args.routes):
+                continue
+            concurrency = min(args.concurrency, cap or args.concurrency)
+            result = asyncio.run(drive(url, token, make_request,
+                                       concurrency, args.duration))
+            results[name] = result
+            if not result['requests']:
+                print(f'{name:<34} {"-":>8} {"-":>8} {"-":>8} {"-":>8} '
+                      f'{"-":>6} {result["errors"]:>6}')
+                continue
+            print(f'{name:<34} {result["rps"]:>8.1f} '
+                  f'{result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f} '
+                  f'{result["p99_ms"]:>8.2f} '
+                  f'{result["statements"] if result["statements"] is not None else "-":>6} '  # noqa: E501
+                  f'{result["errors"]:>6}')
+    finally:
+        process.terminate()
+        process.wait()
+        os.remove(jwks_path)
+
+    key = f'{args.scale}/{args.server}/c{args.concurrency}'
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({key: results}, output, indent=2)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    if args.update_baseline:
+        baselines[key] = dict(baselines.get(key, {}), **results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print(f'baseline {key} updated', file=sys.stderr)
+        return 0
+    if key not in baselines:
+        print(f'no baseline for {key}, run with --update-baseline',
+              file=sys.stderr)
+        return 0
+    found = regressions(results, baselines[key], args.tolerance,
+                        args.latency_tolerance)
+    for regression in found:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+import os
+
+from models import Movies
+from pagination import parse_date
+
+# largest number of records accepted by a bulk request
+BULK_MAX_RECORDS = int(os.environ.get('BULK_MAX_RECORDS', 10000))
+# titles looked up per query when checking for duplicates
+LOOKUP_CHUNK_SIZE = 1000
+
+
+def parse_positive_int(value):
+    '''accepts ints and digit strings such as "1971"'''
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, str):
+        value = value.strip()
+        if not value.isdigit():
+            raise ValueError
+    if not isinstance(value, (int, str)) or int(value) <= 0:
+        raise ValueError
+    return int(value)
+
+
+def parse_text(value, max_length):
+    if not isinstance(value, str) or not value.strip() or \
+            len(value) > max_length:
+        raise ValueError
+    return value
+
+
+def validate_fields(data, parsers, partial):
+    if not isinstance(data, dict):
+        return None, 'record must be an object'
+    values = {}
+    for field, parse in parsers:
+        if data.get(field) is None:
+            if partial:
+                continue
+            return None, f'{field} is required'
+        try:
+            values[field] = parse(data[field])
+        except (TypeError, ValueError):
+            return None, f'{field} is invalid'
+    if not values:
+        return None, 'no field to update'
+    return values, None
+
+
+def validate_movie(data, partial=False):
+    '''
+    validate_movie(data)
+        returns (values, None) with the columns of a movies row
+        or (None, error) describing the first invalid field
+        with partial the fields are optional, as in an update
+    '''
+    return validate_fields(data, (('title', lambda v: parse_text(v, 180)),
+                                  ('duration', parse_positive_int),
+                                  ('release_year', parse_positive_int)),
+                           partial)
+
+
+def validate_actor(data, partial=False):
+    '''
+    validate_actor(data)
+        returns (values, None) with the columns of an actors row
+        or (None, error) describing the first invalid field
+        with partial the fields are optional, as in an update
+    '''
+    return validate_fields(data, (('name', lambda v: parse_text(v, 256)),
+                                  ('gender', lambda v: parse_text(v, 256)),
+                                  ('date_of_birth', parse_date)),
+                           partial)
+
+
+def existing_titles(titles):
+    '''returns the subset of titles already stored in the movies table'''
+    titles = list(titles)
+    found = set()
+    for start in range(0, len(titles), LOOKUP_CHUNK_SIZE):
+        chunk = titles[start:start + LOOKUP_CHUNK_SIZE]
+        found.update(title for title, in Movies.query
+                     .with_entities(Movies.title)
+                     .filter(Movies.title.in_(chunk)))
+    return found
+
+
+def title_owners(titles):
+    '''{title: id} of the titles of titles already stored'''
+    titles = list(titles)
+    owners = {}
+    for start in range(0, len(titles), LOOKUP_CHUNK_SIZE):
+        chunk = titles[start:start + LOOKUP_CHUNK_SIZE]
+        owners.update(Movies.query.with_entities(Movies.title, Movies.id)
+                      .filter(Movies.title.in_(chunk)))
+    return owners
+
+
+def bulk_create(model, records):
+    '''
+    bulk_create(Movies, records)
+        validates every record in one pass, then inserts the valid ones in
+        a single transaction
+        returns the per record report, in the order of records:
+        {"index": i, "id": id} or {"index": i, "error": reason}
+    '''
+    validate = validate_movie if model is Movies else validate_actor
+    results = []
+    valid = []
+    for index, data in enumerate(records):
+        values, error = validate(data)
+        if error:
+            results.append({'index': index, 'error': error})
+        else:
+            results.append({'index': index})
+            valid.append((index, values))
+
+    if model is Movies:
+        taken = existing_titles({values['title'] for _, values in valid})
+        seen = set()
+        unique = []
+        for index, values in valid:
+            if values['title'] in taken:
+                results[index]['error'] = 'title already exists'
+            elif values['title'] in seen:
+                results[index]['error'] = 'duplicate title in request'
+            else:
+                seen.add(values['title'])
+                unique.append((index, values))
+        valid = unique
+
+    ids = model.insert_many([values for _, values in valid])
+    for (index, _), new_id in zip(valid, ids):
+        results[index]['id'] = new_id
+    return results
+
+
+def bulk_report(results):
+    failed = sum(1 for result in results if 'error' in result)
+    return {
+        'success': True,
+        'created': len(results) - failed,
+        'failed': failed,
+        'results': results,
+    }
+
+
+def parse_ids(values):
+    '''a list of distinct ids, raises ValueError otherwise'''
+    if not isinstance(values, list) or not values or \
+            len(values) > BULK_MAX_RECORDS:
+        raise ValueError('ids must be a list of 1 to BULK_MAX_RECORDS ids')
+    ids = [parse_positive_int(value) for value in values]
+    if len(set(ids)) != len(ids):
+        raise ValueError('duplicate id in request')
+    return ids
+
+
+def bulk_update(model, records):
+    '''
+    bulk_update(Movies, [{"id": 3, "fields": {"title": "Up"}, "version": 2}])
+        validates the fields of every record, then updates the valid ones
+        with set-based statements in a single transaction, a record with
+        a version only applies to the row at that version
+        returns the response body, its results hold {"version": new
+        version} or {"error": reason} for every id
+        raises ValueError when a record has no id or an id is repeated
+    '''
+    if not isinstance(records, list) or \
+            any(not isinstance(record, dict) for record in records):
+        raise ValueError('records must be objects')
+    ids = parse_ids([record.get('id') for record in records])
+    validate = validate_movie if model is Movies else validate_actor
+    results = {}
+    changes = {}
+    for row_id, record in zip(ids, records):
+        values, error = validate(record.get('fields'), partial=True)
+        version = record.get('version')
+        if not error and version is not None:
+            try:
+                version = parse_positive_int(version)
+            except (TypeError, ValueError):
+                error = 'version is invalid'
+        if error:
+            results[row_id] = {'error': error}
+        else:
+            changes[row_id] = (values, version)
+
+    if model is Movies:
+        titles = [values['title'] for values, _ in changes.values()
+                  if 'title' in values]
+        owners = title_owners(set(titles))
+        seen = set()
+        for row_id, (values, _) in list(changes.items()):
+            title = values.get('title')
+            if title is None:
+                continue
+            if owners.get(title, row_id) != row_id:
+                results[row_id] = {'error': 'title already exists'}
+            elif title in seen:
+                results[row_id] = {'error': 'duplicate title in request'}
+            else:
+                seen.add(title)
+                continue
+            del changes[row_id]
+
+    updated, stale = model.update_many(changes)
+    for row_id in changes:
+        if row_id in updated:
+            results[row_id] = {'version': updated[row_id]}
+        elif row_id in stale:
+            results[row_id] = {'error': 'version conflict'}
+        else:
+            results[row_id] = {'error': 'not found'}
+    return write_report('updated', ids, results)
+
+
+def delete_targets(model, listing, data):
+    '''
+    delete_targets(Movies, movies_listing, {"ids": [3, 4]})
+    delete_targets(Movies, movies_listing,
+                   {"filter": {"release_year_max": 1930}})
+        the ids a bulk delete names, or that match the filter parameters
+        of the list endpoint, with one query
+        raises ValueError on a malformed body, an empty filter or one
+        matching more than BULK_MAX_RECORDS rows
+    '''
+    if not isinstance(data, dict) or ('ids' in data) == ('filter' in data):
+        raise ValueError('either ids or filter is required')
+    if 'ids' in data:
+        return parse_ids(data['ids'])
+    filters = data['filter']
+    if not isinstance(filters, dict) or not filters or \
+            any(name not in listing.filters for name in filters):
+        raise ValueError('unknown or empty filter')
+    # title_contains "" (or " ") would match the whole table
+    if any(isinstance(value, str) and not value.strip()
+           for value in filters.values()):
+        raise ValueError('empty filter value')
+    confirm = data.get('confirm')
+    if confirm is not None and (isinstance(confirm, bool) or
+                                not isinstance(confirm, int)):
+        raise ValueError('confirm must be the number of matching rows')
+    try:
+        clauses = listing.filter_clauses(filters)
+    except TypeError:
+        raise ValueError('filter value is invalid')
+    # a filter of nulls would match the whole table
+    if not clauses:
+        raise ValueError('unknown or empty filter')
+    ids = [row_id for row_id, in model.query.with_entities(model.id)
+           .filter(*clauses).order_by(model.id).limit(BULK_MAX_RECORDS + 1)]
+    if len(ids) > BULK_MAX_RECORDS:
+        raise ValueError('filter matches more than BULK_MAX_RECORDS rows')
+    return ids
+
+
+def unconfirmed_delete(data, ids):
+    '''
+    unconfirmed_delete({"filter": {...}, "confirm": 3}, [4, 7, 9])
+        a filter delete only goes through with "confirm" set to the
+        number of rows it matches
+        returns None when it can go through, otherwise the response body
+        and status: a dry run (200) without confirm, a 412 when the rows
+        matching changed since
+    '''
+    if 'filter' not in data or data.get('confirm') == len(ids):
+        return None
+    if data.get('confirm') is None:
+        return {'success': True, 'dry_run': True, 'matched': len(ids)}, 200
+    return {
+        'success': False,
+        'error': 412,
+        'message': 'confirm does not match',
+        'matched': len(ids),
+    }, 412
+
+
+def bulk_delete(model, ids):
+    '''
+    bulk_delete(Movies, [3, 4])
+        deletes the rows with set-based statements in a single transaction
+        returns the response body, its results hold {"deleted": true} or
+        {"error": reason} for every id
+    '''
+    deleted = model.delete_many(ids)
+    return write_report('deleted', ids, {
+        row_id: {'deleted': True} if row_id in deleted
+        else {'error': 'not found'} for row_id in ids})
+
+
+def write_report(done, ids, results):
+    '''the response body of a bulk update or delete, ids in order'''
+    failed = sum(1 for result in results.values() if 'error' in result)
+    return {
+        'success': True,
+        done: len(ids) - failed,
+        'failed': failed,
+        # json object keys are strings
+        'results': {str(row_id): results[row_id] for row_id in ids},
+    }
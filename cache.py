@@ -0,0 +1,253 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timezone
+from functools import wraps
+
+from flask import current_app, request
+
+from changes import DATABASE_ROW, table_changes
+
+# memory:// (per process lru), redis://host:port/db (shared between the
+# workers), local:// (in process stand-in of the shared backend for tests)
+# or none to disable the cache; the REDIS_URL of a redis add-on by default
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL') or \
+    os.environ.get('REDIS_URL') or 'memory://'
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_MAX_ENTRIES = int(
+    os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+
+
+class LRUBackend:
+    '''
+    LRUBackend
+    Bounded in-process store, entries are private to the worker process
+    '''
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LocalRedis:
+    '''
+    LocalRedis
+    In-process stand-in for the few redis client calls RedisBackend makes
+    '''
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._values.get(name)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._values[name]
+                return None
+            return entry[0]
+
+    def set(self, name, value, ex=None):
+        expires_at = time.monotonic() + ex if ex else None
+        with self._lock:
+            self._values[name] = (value, expires_at)
+
+    def flushdb(self):
+        with self._lock:
+            self._values.clear()
+
+
+class RedisBackend:
+    '''
+    RedisBackend
+    Store shared by every worker, a body stored by one worker is served
+    by all of them
+    '''
+
+    def __init__(self, client, prefix='casting:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+def make_backend(url):
+    '''builds the backend named by RESPONSE_CACHE_URL'''
+    if url == 'none':
+        return None
+    if url.startswith('memory://'):
+        return LRUBackend()
+    if url.startswith('local://'):
+        return RedisBackend(LocalRedis())
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE_URL needs the redis package')
+        return RedisBackend(redis.Redis.from_url(url))
+    raise ValueError(f'unsupported RESPONSE_CACHE_URL {url}')
+
+
+class ResponseCache:
+    '''
+    ResponseCache
+    Keeps the serialized body of successful GET responses.
+    Keys embed the write counters of the tables (changes.py), kept by the
+    database, so a write of any worker or process makes every cached
+    response of the table unreachable.
+    The same counters give the ETag of the responses, so conditional
+    requests are answered by any worker without running the view.
+    '''
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.started = int(time.time())
+
+    def versions(self, tables):
+        '''
+        the version of the tables, joined in one string, and the
+        timestamp of their last write
+        '''
+        changes = table_changes([DATABASE_ROW] + list(tables))
+        version = '.'.join(str(version) for version, _ in changes.values())
+        return version, max(changes[table][1] for table in tables) or \
+            self.started
+
+    def last_modified(self, tables):
+        '''timestamp of the last write to the tables'''
+        return self.versions(tables)[1]
+
+    def etag(self, tables, version):
+        '''strong etag of the current request url at the tables version'''
+        seed = f'{",".join(tables)}:{version}:{self.request_key()}'
+        return hashlib.sha1(seed.encode()).hexdigest()
+
+    @staticmethod
+    def is_not_modified(etag, last_modified):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        since = request.if_modified_since
+        if since is not None:
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return last_modified <= since.timestamp()
+        return False
+
+    @staticmethod
+    def request_key():
+        # the same query parameters in another order are the same response
+        args = '&'.join(f'{name}={value}' for name, value
+                        in sorted(request.args.items(multi=True)))
+        return f'{request.path}?{args}'
+
+    def get_response(self, tables, version, f, *args, **kwargs):
+        key = f'response:{",".join(tables)}:{version}:{self.request_key()}'
+        body = self.backend.get(key)
+        if body is not None:
+            self.hits += 1
+            response = current_app.response_class(
+                body, status=200, mimetype='application/json')
+            response.headers['X-Cache'] = 'HIT'
+            return response
+        self.misses += 1
+        response = current_app.make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            self.backend.set(key, response.get_data(), self.ttl)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    def cached(self, table, includes=None, row_version=None):
+        '''
+        cached('movies', includes={'actors': ('casting', 'actors')})
+            decorator of a view whose response only depends on the rows of
+            table (or a tuple of tables), of the tables listed for the
+            ?include= values the request uses, and on the request url
+            answers If-None-Match / If-Modified-Since requests with a 304
+            when the tables did not change, otherwise serves the cached body
+            put it below requires_auth so the permissions are still checked
+            row_version(**view_kwargs) of a by-id view is the version of its
+            row, None when missing: the ETag starts with it ("3-<hash>") so
+            it is accepted by the If-Match of a PATCH / DELETE of the row
+        '''
+        includes = includes or {}
+
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.backend is None:
+                    return f(*args, **kwargs)
+                tables = [table] if isinstance(table, str) else list(table)
+                for name in request.args.get('include', '').split(','):
+                    tables += [related for related in includes.get(name, ())
+                               if related not in tables]
+                # read the version before the rows, a write committing in
+                # between leaves the stored body under an outdated key
+                version, last_modified = self.versions(tables)
+                etag = self.etag(tables, version)
+                if row_version is not None:
+                    current = row_version(**kwargs)
+                    if current is None:
+                        # the view answers the 404, never a 304
+                        return f(*args, **kwargs)
+                    etag = f'{current}-{etag}'
+                if self.is_not_modified(etag, last_modified):
+                    self.not_modified += 1
+                    response = current_app.response_class(status=304)
+                else:
+                    response = self.get_response(tables, version, f,
+                                                 *args, **kwargs)
+                if response.status_code in (200, 304):
+                    response.set_etag(etag)
+                    response.last_modified = last_modified
+                    # clients must revalidate, which is cheap
+                    response.cache_control.no_cache = True
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+response_cache = ResponseCache(make_backend(RESPONSE_CACHE_URL))
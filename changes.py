@@ -0,0 +1,72 @@
+"""
+per table change counters kept by the database
+
+every insert, update and delete of a tracked table bumps the version of
+its row of table_changes in the same transaction, from a trigger, so the
+writes of every worker, of manage.py and of plain SQL are all counted
+"""
+import random
+
+import sqlalchemy as sa
+from flask import current_app
+
+TRACKED_TABLES = ('movies', 'actors', 'casting')
+# row whose version, random and never bumped, tells a database from
+# another one made later, whose counters start over
+DATABASE_ROW = 'database'
+
+table_changes_table = sa.table('table_changes', sa.column('name'),
+                               sa.column('version'),
+                               sa.column('modified_at'))
+
+# unix time of the write, in seconds
+NOW = {
+    'postgresql': 'CAST(extract(epoch FROM now()) AS bigint)',
+    'sqlite': "CAST((julianday('now') - 2440587.5) * 86400 AS INTEGER)",
+}
+
+
+def trigger_statements(dialect, table):
+    '''
+    trigger_statements('sqlite', 'movies')
+        the statements (re)creating the triggers counting the writes of
+        table, one bump per statement on postgresql, per row on sqlite
+    '''
+    bump = f'UPDATE table_changes SET version = version + 1, ' \
+        f'modified_at = {NOW[dialect]} WHERE name = '
+    if dialect == 'postgresql':
+        return [
+            f'CREATE OR REPLACE FUNCTION table_changes_bump() '
+            f'RETURNS trigger AS $$ BEGIN {bump}TG_TABLE_NAME; '
+            f'RETURN NULL; END $$ LANGUAGE plpgsql',
+            f'DROP TRIGGER IF EXISTS {table}_changes ON {table}',
+            f'CREATE TRIGGER {table}_changes AFTER INSERT OR UPDATE OR '
+            f'DELETE ON {table} FOR EACH STATEMENT '
+            f'EXECUTE FUNCTION table_changes_bump()',
+        ]
+    return [f'CREATE TRIGGER IF NOT EXISTS {table}_changes_{event} '
+            f'AFTER {event} ON {table} BEGIN {bump}\'{table}\'; END'
+            for event in ('INSERT', 'UPDATE', 'DELETE')]
+
+
+def initial_counters():
+    '''the table_changes rows of a new database'''
+    return [{'name': DATABASE_ROW, 'version': random.randrange(2 ** 31),
+             'modified_at': 0}] + [
+        {'name': table, 'version': 0, 'modified_at': 0}
+        for table in TRACKED_TABLES]
+
+
+def table_changes(tables):
+    '''
+    table_changes(['movies', 'actors'])
+        {table: (version, unix time of the last write)} read in one
+        query, (0, 0) for a table without counter
+    '''
+    session = current_app.extensions['sqlalchemy'].db.session
+    rows = {name: (version, modified_at) for name, version, modified_at
+            in session.execute(sa.select([
+                table_changes_table.c.name, table_changes_table.c.version,
+                table_changes_table.c.modified_at]).where(
+                table_changes_table.c.name.in_(list(tables))))}
+    return {table: rows.get(table, (0, 0)) for table in tables}
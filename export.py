@@ -0,0 +1,33 @@
+import json
+import os
+
+from sqlalchemy import select
+
+from models import db
+
+# rows pulled from the server side cursor at a time
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 1000))
+
+
+def export_rows(model, fetch_size=EXPORT_FETCH_SIZE):
+    '''
+    export_rows(Movies)
+        yields every row of the model table as a line of json, ordered by id
+        rows are read through a server side cursor (stream_results) in
+        batches of fetch_size, so memory use does not depend on the size
+        of the table
+    '''
+    table = model.__table__
+    # the replica of a read only request, otherwise the primary
+    connection = db.session.get_bind().connect().execution_options(
+        stream_results=True)
+    try:
+        result = connection.execute(select([table]).order_by(table.c.id))
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield json.dumps(dict(row), default=str) + '\n'
+    finally:
+        connection.close()
@@ -0,0 +1,37 @@
+"""
+gunicorn settings, read by `gunicorn app:app` from the working directory
+
+every worker keeps its own connection pool, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections
+"""
+import os
+
+bind = f'0.0.0.0:{os.environ.get("PORT", 5000)}'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# load the app once in the master, the workers fork from it instead of
+# each importing it and connecting at the same time on deploy
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in \
+    ('1', 'true', 'yes')
+# restart the workers in turn rather than all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+
+def when_ready(server):
+    # the master opened connections while loading the app, they must not
+    # be shared with the workers
+    if not server.cfg.preload_app:
+        return
+    from models import db, replicas
+    db.get_engine().dispose()
+    replicas.dispose()
+
+
+def post_fork(server, worker):
+    # a fresh pool per worker, whatever the master left in its own
+    # without preload the worker has not loaded the app yet
+    if not server.cfg.preload_app:
+        return
+    from models import db, replicas
+    db.get_engine().dispose()
+    replicas.dispose()
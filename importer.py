@@ -0,0 +1,201 @@
+import csv
+import io
+import json
+import os
+import resource
+import time
+from itertools import islice
+
+from sqlalchemy import bindparam
+
+from models import db, Movies
+from bulk import validate_movie, validate_actor, existing_titles
+
+# records parsed, validated and loaded at a time
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 5000))
+CONFLICT_POLICIES = ('skip', 'upsert')
+# invalid records kept in the report
+MAX_REPORTED_ERRORS = 20
+
+COLUMNS = {
+    'movies': ['title', 'duration', 'release_year'],
+    'actors': ['name', 'gender', 'date_of_birth'],
+}
+STAGING_TYPES = {
+    'movies': 'title varchar(180), duration integer, release_year integer',
+    'actors': 'name varchar(256), gender varchar, date_of_birth date',
+}
+
+
+def detect_format(path):
+    '''csv or ndjson from the file extension'''
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+def read_records(path, file_format):
+    '''
+    read_records(path, 'csv')
+        yields (line number, record) from a csv file with a header row or
+        a newline delimited json file, one line at a time
+        a line that is not valid json yields a None record
+    '''
+    with open(path, newline='') as source:
+        if file_format == 'csv':
+            reader = csv.DictReader(source)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError:
+                    yield line_number, None
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def dedupe_titles(rows, on_conflict):
+    '''
+    keeps one row per title within a chunk: the first one when skipping
+    duplicates, the last one when upserting
+    '''
+    by_title = {}
+    for row in rows:
+        if on_conflict == 'upsert' or row['title'] not in by_title:
+            by_title[row['title']] = row
+    return list(by_title.values())
+
+
+def load_batched(model, rows, on_conflict):
+    '''
+    loads a chunk with executemany statements, for backends without COPY
+    returns the number of rows written
+    '''
+    table = model.__table__
+    if model is not Movies:
+        db.session.execute(table.insert(), rows)
+        return len(rows)
+    rows = dedupe_titles(rows, on_conflict)
+    taken = existing_titles(row['title'] for row in rows)
+    new_rows = [row for row in rows if row['title'] not in taken]
+    if new_rows:
+        db.session.execute(table.insert(), new_rows)
+    written = len(new_rows)
+    if on_conflict == 'upsert' and taken:
+        updates = [dict(row, match_title=row['title'])
+                   for row in rows if row['title'] in taken]
+        db.session.execute(
+            table.update()
+            .where(table.c.title == bindparam('match_title'))
+            .values(duration=bindparam('duration'),
+                    release_year=bindparam('release_year'),
+                    # an If-Match of the version read before is stale now
+                    version=table.c.version + 1),
+            updates)
+        written += len(updates)
+    return written
+
+
+def load_copy(model, rows, on_conflict):
+    '''
+    loads a chunk with postgresql COPY into a temporary staging table,
+    then moves the rows to the model table with a single INSERT ... SELECT
+    that skips or updates the movies whose title already exists
+    returns the number of rows written
+    '''
+    name = model.__tablename__
+    columns = COLUMNS[name]
+    staging = f'import_{name}'
+    db.session.execute(
+        f'CREATE TEMP TABLE IF NOT EXISTS {staging} '
+        f'(seq serial, {STAGING_TYPES[name]}) ON COMMIT DELETE ROWS')
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f'COPY {staging} ({", ".join(columns)}) FROM STDIN WITH CSV', buffer)
+
+    column_list = ', '.join(columns)
+    if model is not Movies:
+        result = db.session.execute(
+            f'INSERT INTO {name} ({column_list}) '
+            f'SELECT {column_list} FROM {staging}')
+        return result.rowcount
+    # one row per title, ON CONFLICT can not touch the same row twice
+    order = 'DESC' if on_conflict == 'upsert' else 'ASC'
+    conflict = 'DO NOTHING' if on_conflict == 'skip' else \
+        'DO UPDATE SET duration = EXCLUDED.duration, ' \
+        'release_year = EXCLUDED.release_year, ' \
+        'version = movies.version + 1'
+    result = db.session.execute(
+        f'INSERT INTO movies ({column_list}) '
+        f'SELECT DISTINCT ON (title) {column_list} FROM {staging} '
+        f'ORDER BY title, seq {order} '
+        f'ON CONFLICT (title) {conflict}')
+    return result.rowcount
+
+
+def import_file(model, path, file_format=None, on_conflict='skip',
+                chunk_size=IMPORT_CHUNK_SIZE):
+    '''
+    import_file(Movies, 'movies.csv')
+        streams the records of a csv or ndjson file into the model table,
+        chunk_size records at a time, each chunk in its own transaction
+        movies whose title already exists are skipped or updated according
+        to on_conflict
+        returns a report with the counts, the throughput and the peak rss
+    '''
+    if on_conflict not in CONFLICT_POLICIES:
+        raise ValueError(f'on_conflict must be one of {CONFLICT_POLICIES}')
+    validate = validate_movie if model is Movies else validate_actor
+    load = load_copy if db.engine.dialect.name == 'postgresql' \
+        else load_batched
+    report = {'read': 0, 'written': 0, 'skipped': 0, 'invalid': 0,
+              'errors': []}
+    start = time.perf_counter()
+
+    records = read_records(path, file_format or detect_format(path))
+    for chunk in chunked(records, chunk_size):
+        rows = []
+        for line_number, record in chunk:
+            values, error = validate(record) if record is not None \
+                else (None, 'line is not valid json')
+            if error:
+                report['invalid'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append({'line': line_number,
+                                             'error': error})
+            else:
+                rows.append(values)
+        report['read'] += len(chunk)
+        if rows:
+            try:
+                written = load(model, rows, on_conflict)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            report['written'] += written
+            report['skipped'] += len(rows) - written
+
+    elapsed = time.perf_counter() - start
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['read'] / elapsed) \
+        if elapsed else 0
+    # ru_maxrss is in kilobytes on linux
+    report['peak_rss_mb'] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
@@ -0,0 +1,115 @@
+import os
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import registry
+
+# send the Server-Timing header with the db, auth and total durations
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() in \
+    ('1', 'true', 'yes')
+
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time to build the response',
+    labelnames=('method', 'endpoint'))
+requests_total = registry.counter(
+    'http_requests_total', 'Requests answered',
+    labelnames=('method', 'endpoint', 'status'))
+request_statements = registry.histogram(
+    'http_request_db_statements', 'SQL statements run per request',
+    buckets=STATEMENT_BUCKETS, labelnames=('method', 'endpoint'))
+request_db_time = registry.histogram(
+    'http_request_db_seconds', 'Time spent in SQL statements per request',
+    labelnames=('method', 'endpoint'))
+request_auth_time = registry.histogram(
+    'http_request_auth_seconds', 'Time spent verifying the bearer token',
+    labelnames=('method', 'endpoint'))
+response_size = registry.histogram(
+    'http_response_size_bytes', 'Size of the response body',
+    buckets=SIZE_BUCKETS, labelnames=('method', 'endpoint'))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+
+def finish_statement(conn):
+    elapsed = time.perf_counter() - conn.info['statement_started'].pop()
+    # statements of every engine (primary and replicas) count, outside
+    # a request (migrations, manage.py) there is nothing to add them to
+    if has_app_context() and 'db_statements' in g:
+        g.db_statements += 1
+        g.db_seconds += elapsed
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context,
+                  executemany):
+    finish_statement(conn)
+
+
+@event.listens_for(Engine, 'handle_error')
+def failed_statement(context):
+    # a statement that raised never reaches after_cursor_execute, its
+    # start would stay on the pooled connection
+    connection = context.connection
+    if connection is not None and connection.info.get('statement_started'):
+        finish_statement(connection)
+
+
+def start_request():
+    g.request_started = time.perf_counter()
+    g.db_statements = 0
+    g.db_seconds = 0.0
+
+
+def server_timing(total):
+    '''the Server-Timing header value, durations in milliseconds'''
+    timings = [f'db;dur={g.db_seconds * 1000:.2f};'
+               f'desc="{g.db_statements} statements"']
+    if 'auth_seconds' in g:
+        timings.append(f'auth;dur={g.auth_seconds * 1000:.2f}')
+    timings.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(timings)
+
+
+def record_request(response):
+    '''
+    records the latency, statements, db and auth time and size of the
+    response under its endpoint
+    the statements a streamed body runs after this point are not counted
+    '''
+    if 'request_started' not in g:
+        return response
+    total = time.perf_counter() - g.request_started
+    labels = (request.method, request.endpoint or 'unmatched')
+    request_duration.labels(*labels).observe(total)
+    requests_total.labels(*labels, response.status_code).inc()
+    request_statements.labels(*labels).observe(g.db_statements)
+    request_db_time.labels(*labels).observe(g.db_seconds)
+    if 'auth_seconds' in g:
+        request_auth_time.labels(*labels).observe(g.auth_seconds)
+    if response.content_length is not None:
+        response_size.labels(*labels).observe(response.content_length)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(total)
+    return response
+
+
+def instrument(app):
+    '''
+    instrument(app)
+        records per endpoint latency, SQL statement count and time, token
+        verification time and response size of every request of app,
+        served by GET /metrics and in a Server-Timing header
+    '''
+    app.before_request(start_request)
+    app.after_request(record_request)
+    return app
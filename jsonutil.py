@@ -0,0 +1,84 @@
+import json
+import os
+from functools import lru_cache
+
+from flask import current_app
+from flask.json import JSONEncoder
+
+# encoder of the api responses: orjson, ujson or json, defaults to the
+# fastest one installed
+JSON_BACKEND = os.environ.get('JSON_BACKEND')
+# distinct dates whose formatted string is kept, birth dates repeat a lot
+DATE_FORMAT_CACHE_SIZE = int(os.environ.get('DATE_FORMAT_CACHE_SIZE',
+                                            65536))
+
+# values json has no type for (dates, uuids) are encoded like flask does
+_flask_default = JSONEncoder().default
+_stdlib_encoder = json.JSONEncoder(separators=(',', ':'),
+                                   default=_flask_default)
+
+
+def _stdlib_dumps(data):
+    return _stdlib_encoder.encode(data).encode()
+
+
+def make_dumps(name):
+    '''
+    the data -> utf-8 bytes function of the named encoder
+    raises ImportError when it is not installed
+    '''
+    if name == 'orjson':
+        import orjson
+
+        def dumps(data):
+            return orjson.dumps(data, default=_flask_default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return dumps
+    if name == 'ujson':
+        import ujson
+
+        def dumps(data):
+            try:
+                return ujson.dumps(data, ensure_ascii=False).encode()
+            except TypeError:
+                # ujson knows no dates, such payloads go the slow way
+                return _stdlib_dumps(data)
+        return dumps
+    if name == 'json':
+        return _stdlib_dumps
+    raise ValueError(f'unknown JSON_BACKEND {name}')
+
+
+def default_backend():
+    for name in ('orjson', 'ujson'):
+        try:
+            make_dumps(name)
+            return name
+        except ImportError:
+            pass
+    return 'json'
+
+
+backend = JSON_BACKEND or default_backend()
+dumps = make_dumps(backend)
+
+
+def jsonify(*args, **kwargs):
+    '''
+    flask.jsonify through the fast encoder, compact and with the keys in
+    the order the handler built them
+    '''
+    if args and kwargs:
+        raise TypeError('jsonify() takes either args or kwargs, not both')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return current_app.response_class(
+        dumps(data) + b'\n', mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+@lru_cache(maxsize=DATE_FORMAT_CACHE_SIZE)
+def format_date(value):
+    '''a date as "March 09, 1950", computed once per distinct date'''
+    return value.strftime("%B %d, %Y")
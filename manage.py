@@ -1,14 +1,96 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+import json
+import sys
 
-from app import app
-from models import db
+from flask import Flask
+from flask_script import Command, Manager, Option
+from flask_migrate import Migrate, MigrateCommand, upgrade
 
+from auth.auth import LOCAL_ISSUER_KEY
+from auth.issuer import ROLE_PERMISSIONS, LocalIssuer
+from models import db, setup_db, Movies, Actor
+from export import export_rows
+from importer import CONFLICT_POLICIES, IMPORT_CHUNK_SIZE, import_file
+
+# the commands need the models, not the routes, auth and caches of app.py
+app = Flask(__name__)
+setup_db(app)
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+MODELS = {'movies': Movies, 'actors': Actor}
+
+
+class InitDbCommand(Command):
+    """Create or bring the schema up to date with the migrations"""
+
+    def run(self):
+        # the baseline revision keeps the tables of a database made by
+        # db.create_all, the later ones add what it lacks
+        upgrade()
+
+
+manager.add_command('init_db', InitDbCommand())
+
+
+@manager.option('-t', '--table', dest='table', required=True,
+                choices=sorted(MODELS), help='table to export')
+@manager.option('-o', '--output', dest='output', default='-',
+                help='file to write, defaults to stdout')
+def export(table, output):
+    """Export a table as newline delimited json"""
+    out = sys.stdout if output == '-' else open(output, 'w')
+    try:
+        for line in export_rows(MODELS[table]):
+            out.write(line)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+class ImportCommand(Command):
+    """Import a csv or newline delimited json file into a table"""
+
+    option_list = (
+        Option('-t', '--table', dest='table', required=True,
+               choices=sorted(MODELS), help='table to load'),
+        Option('-f', '--file', dest='path', required=True,
+               help='csv file with a header row or ndjson file'),
+        Option('--format', dest='file_format', choices=['csv', 'ndjson'],
+               help='defaults to the file extension'),
+        Option('--on-conflict', dest='on_conflict', default='skip',
+               choices=CONFLICT_POLICIES,
+               help='what to do with movies whose title already exists'),
+        Option('--chunk-size', dest='chunk_size', type=int,
+               default=IMPORT_CHUNK_SIZE),
+    )
+
+    def run(self, table, path, file_format, on_conflict, chunk_size):
+        report = import_file(MODELS[table], path, file_format=file_format,
+                             on_conflict=on_conflict, chunk_size=chunk_size)
+        print(json.dumps(report, indent=2))
+
+
+manager.add_command('import', ImportCommand())
+
+
+@manager.option('-r', '--role', dest='role', default='producer',
+                choices=sorted(ROLE_PERMISSIONS),
+                help='assistant, director or producer')
+@manager.option('--ttl', dest='ttl', type=int, default=3600,
+                help='seconds the token is valid')
+@manager.option('-k', '--key', dest='key', default=LOCAL_ISSUER_KEY,
+                help='pem private key, created if missing')
+@manager.option('--jwks', dest='jwks', default=None,
+                help='also write the public key as a jwks document')
+def mint_token(role, ttl, key, jwks):
+    """Print a bearer token of the role signed by the local key"""
+    issuer = LocalIssuer.from_key_file(key)
+    if jwks:
+        issuer.write_jwks(jwks)
+    print(issuer.mint(role, ttl=ttl))
+
 
 if __name__ == '__main__':
     manager.run()
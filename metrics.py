@@ -0,0 +1,170 @@
+import threading
+from bisect import bisect_left
+
+# upper bounds in seconds of the latency histograms
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+    '''{"endpoint": "get_movies"} as {endpoint="get_movies"}'''
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels.items())
+    return f'{{{pairs}}}'
+
+
+class Counter:
+    '''
+    Counter
+    Value that only goes up, such as a number of requests
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name + format_labels(self.labels), self.value
+
+
+class Gauge:
+    '''
+    Gauge
+    Value read when the metrics are collected, from a callable
+    '''
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if value is not None:
+            yield self.name, value
+
+
+class Histogram:
+    '''
+    Histogram
+    Counts observations, such as durations in seconds, per bucket
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS,
+                 labels=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield self.name + '_bucket' + format_labels(
+                dict(self.labels, le=bound)), cumulative
+        yield self.name + '_bucket' + format_labels(
+            dict(self.labels, le='+Inf')), self.count
+        yield self.name + '_sum' + format_labels(self.labels), self.sum
+        yield self.name + '_count' + format_labels(self.labels), self.count
+
+
+class Family:
+    '''
+    Family
+    Counters or histograms of the same name told apart by labels, such as
+    one latency histogram per endpoint
+    '''
+
+    def __init__(self, metric_class, name, documentation, labelnames,
+                 **options):
+        self.metric_class = metric_class
+        self.kind = metric_class.kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.options = options
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        '''the metric of the label values, created on first use'''
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self.metric_class(
+                    self.name, self.documentation,
+                    labels=dict(zip(self.labelnames, values)),
+                    **self.options))
+        return child
+
+    def samples(self):
+        for child in list(self.children.values()):
+            yield from child.samples()
+
+
+class Registry:
+    '''
+    Registry
+    The metrics of the process, rendered in the prometheus text format
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # registering a name again returns the existing metric
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        if labelnames:
+            return self.register(Family(Counter, name, documentation,
+                                        labelnames))
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name, documentation, read):
+        return self.register(Gauge(name, documentation, read))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS,
+                  labelnames=()):
+        if labelnames:
+            return self.register(Family(Histogram, name, documentation,
+                                        labelnames, buckets=buckets))
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {value}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -79,6 +79,10 @@ def run_migrations_online():
     )
 
     with connectable.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            # batch operations copy a table and drop the old one, with
+            # foreign keys on the DROP would cascade to the casting rows
+            connection.execute('PRAGMA foreign_keys=OFF')
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
@@ -0,0 +1,145 @@
+"""
+operations for the migrations of big tables that keep the api writable
+
+    from migrations.helpers import backfill, create_index_concurrently
+
+on postgresql an index is built with CREATE INDEX CONCURRENTLY instead
+of holding a write lock on the table for the whole build, an UPDATE of
+every row is split in batches committed one by one, and schema changes
+give up after MIGRATION_LOCK_TIMEOUT rather than queue every query of
+the table behind them; on other databases they are plain operations
+"""
+import os
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from alembic import op
+
+# milliseconds a schema change waits for its table lock before failing,
+# the queries arriving meanwhile would wait behind it
+MIGRATION_LOCK_TIMEOUT = int(os.environ.get('MIGRATION_LOCK_TIMEOUT', 5000))
+# rows updated per committed batch of a backfill
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 5000))
+
+
+def is_postgresql():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def index_exists(table, name):
+    return any(index['name'] == name for index in
+               sa.inspect(op.get_bind()).get_indexes(table))
+
+
+@contextmanager
+def outside_transaction():
+    '''
+    commits the migration transaction so far and runs the block in
+    autocommit, as CONCURRENTLY and per batch commits need
+    '''
+    if is_postgresql():
+        with op.get_context().autocommit_block():
+            yield
+    else:
+        yield
+
+
+@contextmanager
+def lock_timeout(milliseconds=MIGRATION_LOCK_TIMEOUT):
+    '''
+    with lock_timeout():
+        op.add_column(...)
+    fails the statements of the block that wait for a lock longer than
+    milliseconds, retry the migration when the table is quieter
+    '''
+    if not is_postgresql():
+        yield
+        return
+    op.execute(f'SET lock_timeout = {int(milliseconds)}')
+    try:
+        yield
+    finally:
+        op.execute('RESET lock_timeout')
+
+
+def index_validity(name):
+    '''True, False for an interrupted concurrent build, None if absent'''
+    return op.get_bind().execute(sa.text(
+        'SELECT i.indisvalid FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name'),
+        name=name).scalar()
+
+
+def create_index_concurrently(name, table, columns, **kwargs):
+    '''
+    create_index_concurrently('ix_movies_duration', 'movies', ['duration'])
+        builds the index while the table stays writable, does nothing if
+        it exists and rebuilds one left invalid by an interrupted build
+    '''
+    if not is_postgresql():
+        if not index_exists(table, name):
+            op.create_index(name, table, columns, **kwargs)
+        return
+    with outside_transaction():
+        valid = index_validity(name)
+        if valid:
+            return
+        if valid is False:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        with lock_timeout():
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True, **kwargs)
+
+
+def drop_index_concurrently(name, table):
+    if not is_postgresql():
+        if index_exists(table, name):
+            op.drop_index(name, table_name=table)
+        return
+    with outside_transaction(), lock_timeout():
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def backfill(table, assignments, where, batch_size=MIGRATION_BATCH_SIZE,
+             key='id'):
+    '''
+    backfill('movies', 'slug = lower(title)', 'slug IS NULL')
+        runs the UPDATE batch_size rows at a time in key order, each
+        batch committed on its own on postgresql so its row locks are
+        released before the next one; where must stop matching the rows
+        once they are updated
+        returns the number of rows updated
+    '''
+    statement = sa.text(
+        f'UPDATE {table} SET {assignments} WHERE {key} IN '
+        f'(SELECT {key} FROM {table} WHERE {where} '
+        f'ORDER BY {key} LIMIT {int(batch_size)})')
+    updated = 0
+    with outside_transaction():
+        while True:
+            count = op.get_bind().execute(statement).rowcount
+            updated += count
+            if count < batch_size:
+                return updated
+
+
+def set_not_null(table, column):
+    '''
+    set_not_null('movies', 'slug')
+        on postgresql a NOT VALID check constraint is validated without
+        blocking writes first, so SET NOT NULL does not scan the table
+        under its exclusive lock
+    '''
+    if not is_postgresql():
+        with op.batch_alter_table(table) as batch:
+            batch.alter_column(column, nullable=False)
+        return
+    constraint = f'{table}_{column}_not_null'
+    # each statement commits, the brief exclusive locks are not held
+    # through the validation
+    with outside_transaction(), lock_timeout():
+        op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {constraint} '
+                   f'CHECK ({column} IS NOT NULL) NOT VALID')
+        op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}')
+        op.alter_column(table, column, nullable=False)
+        op.drop_constraint(constraint, table)
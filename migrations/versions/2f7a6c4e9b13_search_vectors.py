@@ -0,0 +1,72 @@
+"""full text search vectors of the movie titles and actor names
+
+Revision ID: 2f7a6c4e9b13
+Revises: 8c3d9e1f6a20
+Create Date: 2026-10-18 14:05:41.730562
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from migrations.helpers import backfill, create_index_concurrently, \
+    drop_index_concurrently, is_postgresql, lock_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = '2f7a6c4e9b13'
+down_revision = '8c3d9e1f6a20'
+branch_labels = None
+depends_on = None
+
+# table: searched column, see search.py
+SEARCH_COLUMNS = {
+    'movies': 'title',
+    'actors': 'name',
+}
+
+
+def vector_of(column):
+    return f"to_tsvector('simple', coalesce({column}, ''))"
+
+
+def upgrade():
+    # other databases search with the in-process index of search.py
+    if not is_postgresql():
+        return
+    # a GENERATED ... STORED column would rewrite the whole table under an
+    # exclusive lock; a nullable column is only a catalog change, a trigger
+    # fills it on the writes from now on and the existing rows are
+    # backfilled in batches while the table stays writable
+    for table, column in SEARCH_COLUMNS.items():
+        with lock_timeout():
+            op.add_column(table, sa.Column(
+                'search_vector', postgresql.TSVECTOR()))
+            op.execute(
+                f'CREATE OR REPLACE FUNCTION {table}_search_vector() '
+                f'RETURNS trigger '
+                f'AS $$ BEGIN '
+                f'NEW.search_vector := {vector_of("NEW." + column)}; '
+                f'RETURN NEW; END $$ LANGUAGE plpgsql')
+            # every insert, including the bulk and COPY loads, and the
+            # updates of the searched column
+            op.execute(
+                f'CREATE TRIGGER {table}_search_vector BEFORE INSERT OR '
+                f'UPDATE OF {column} ON {table} FOR EACH ROW '
+                f'EXECUTE FUNCTION {table}_search_vector()')
+    for table, column in SEARCH_COLUMNS.items():
+        backfill(table, f'search_vector = {vector_of(column)}',
+                 'search_vector IS NULL')
+        create_index_concurrently(f'ix_{table}_search_vector', table,
+                                  ['search_vector'], postgresql_using='gin')
+
+
+def downgrade():
+    if not is_postgresql():
+        return
+    for table in reversed(list(SEARCH_COLUMNS)):
+        drop_index_concurrently(f'ix_{table}_search_vector', table)
+        with lock_timeout():
+            op.execute(f'DROP TRIGGER {table}_search_vector ON {table}')
+            op.execute(f'DROP FUNCTION {table}_search_vector()')
+            op.drop_column(table, 'search_vector')
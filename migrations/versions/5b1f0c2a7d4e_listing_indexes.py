@@ -0,0 +1,52 @@
+"""indexes backing the filters and sorts of the list endpoints
+
+Revision ID: 5b1f0c2a7d4e
+Revises: e234b8e8f2fe
+Create Date: 2026-10-18 10:12:03.418211
+
+"""
+from alembic import op
+
+from migrations.helpers import create_index_concurrently, \
+    drop_index_concurrently, is_postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1f0c2a7d4e'
+down_revision = 'e234b8e8f2fe'
+branch_labels = None
+depends_on = None
+
+# indexes declared on the models, db.create_all may already have made them
+INDEXES = [
+    ('ix_movies_release_year', 'movies', ['release_year']),
+    ('ix_actors_name', 'actors', ['name']),
+    ('ix_actors_gender', 'actors', ['gender']),
+    ('ix_actors_date_of_birth', 'actors', ['date_of_birth']),
+]
+
+
+def upgrade():
+    # built concurrently on postgresql, the tables stay writable
+    for name, table, columns in INDEXES:
+        create_index_concurrently(name, table, columns)
+
+    if is_postgresql():
+        # title_prefix: LIKE 'abc%' can only use a text_pattern_ops btree
+        # under a non C collation
+        create_index_concurrently(
+            'ix_movies_title_pattern', 'movies', ['title'],
+            postgresql_ops={'title': 'text_pattern_ops'})
+        # title_contains: LIKE '%abc%' needs a trigram index
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        create_index_concurrently(
+            'ix_movies_title_trgm', 'movies', ['title'],
+            postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if is_postgresql():
+        drop_index_concurrently('ix_movies_title_trgm', 'movies')
+        drop_index_concurrently('ix_movies_title_pattern', 'movies')
+    for name, table, _ in reversed(INDEXES):
+        drop_index_concurrently(name, table)
@@ -0,0 +1,40 @@
+"""casting association between movies and actors
+
+Revision ID: 8c3d9e1f6a20
+Revises: 5b1f0c2a7d4e
+Create Date: 2026-10-18 11:40:27.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3d9e1f6a20'
+down_revision = '5b1f0c2a7d4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all may already have created it
+    if 'casting' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'casting',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('role', sa.String(length=256), nullable=True),
+        sa.Column('billing_order', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_casting_actor_id', 'casting', ['actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_casting_actor_id', table_name='casting')
+    op.drop_table('casting')
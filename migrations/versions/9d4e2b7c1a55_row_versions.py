@@ -0,0 +1,43 @@
+"""version column of movies and actors
+
+Revision ID: 9d4e2b7c1a55
+Revises: 2f7a6c4e9b13
+Create Date: 2026-10-18 16:05:12.408311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.helpers import lock_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4e2b7c1a55'
+down_revision = '2f7a6c4e9b13'
+branch_labels = None
+depends_on = None
+
+TABLES = ('movies', 'actors')
+
+
+def existing_columns(table):
+    return {column['name'] for column in
+            sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    # a constant default is only written to the catalog on postgresql 11+,
+    # the existing rows read it without the table being rewritten
+    for table in TABLES:
+        if 'version' in existing_columns(table):
+            continue
+        with lock_timeout():
+            op.add_column(table, sa.Column('version', sa.Integer(),
+                                           nullable=False,
+                                           server_default='1'))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column('version')
@@ -0,0 +1,85 @@
+"""write counters of the movies, actors and casting tables
+
+Revision ID: c3a8f5d2e7b1
+Revises: 9d4e2b7c1a55
+Create Date: 2026-10-18 20:14:37.112904
+
+"""
+import random
+
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.helpers import is_postgresql, lock_timeout
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a8f5d2e7b1'
+down_revision = '9d4e2b7c1a55'
+branch_labels = None
+depends_on = None
+
+TABLES = ('movies', 'actors', 'casting')
+EVENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def bump(now):
+    return f'UPDATE table_changes SET version = version + 1, ' \
+        f'modified_at = {now} WHERE name = '
+
+
+def upgrade():
+    # db.create_all may already have created it, with its triggers
+    if 'table_changes' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'table_changes',
+            sa.Column('name', sa.String(length=64), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False,
+                      server_default='0'),
+            sa.Column('modified_at', sa.Integer(), nullable=False,
+                      server_default='0'),
+            sa.PrimaryKeyConstraint('name')
+        )
+    # the random version of the database row tells this database from one
+    # made later, whose counters start over
+    for name, version in [('database', random.randrange(2 ** 31))] + \
+            [(table, 0) for table in TABLES]:
+        op.execute(sa.text(
+            'INSERT INTO table_changes (name, version, modified_at) '
+            'SELECT :name, :version, 0 WHERE NOT EXISTS '
+            '(SELECT 1 FROM table_changes WHERE name = :name)')
+            .bindparams(name=name, version=version))
+    # the triggers bump the counter in the transaction of the write, a
+    # reader never sees a new version before the rows it stands for
+    if is_postgresql():
+        op.execute(
+            'CREATE OR REPLACE FUNCTION table_changes_bump() '
+            'RETURNS trigger AS $$ BEGIN '
+            + bump('CAST(extract(epoch FROM now()) AS bigint)') +
+            'TG_TABLE_NAME; RETURN NULL; END $$ LANGUAGE plpgsql')
+        for table in TABLES:
+            with lock_timeout():
+                op.execute(f'DROP TRIGGER IF EXISTS {table}_changes '
+                           f'ON {table}')
+                op.execute(f'CREATE TRIGGER {table}_changes AFTER INSERT '
+                           f'OR UPDATE OR DELETE ON {table} FOR EACH '
+                           f'STATEMENT EXECUTE FUNCTION table_changes_bump()')
+        return
+    now = "CAST((julianday('now') - 2440587.5) * 86400 AS INTEGER)"
+    for table in TABLES:
+        for event in EVENTS:
+            op.execute(f'CREATE TRIGGER IF NOT EXISTS {table}_changes_'
+                       f'{event} AFTER {event} ON {table} BEGIN '
+                       f"{bump(now)}'{table}'; END")
+
+
+def downgrade():
+    for table in TABLES:
+        if is_postgresql():
+            op.execute(f'DROP TRIGGER IF EXISTS {table}_changes ON {table}')
+        else:
+            for event in EVENTS:
+                op.execute(f'DROP TRIGGER IF EXISTS {table}_changes_{event}')
+    if is_postgresql():
+        op.execute('DROP FUNCTION IF EXISTS table_changes_bump()')
+    op.drop_table('table_changes')
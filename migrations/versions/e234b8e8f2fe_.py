@@ -1,7 +1,7 @@
-"""empty message
+"""movies and actors tables
 
 Revision ID: e234b8e8f2fe
-Revises: 
+Revises:
 Create Date: 2021-03-05 17:12:44.515326
 
 """
@@ -17,8 +17,30 @@ depends_on = None
 
 
 def upgrade():
-    pass
+    # databases set up before the migrations got their tables from
+    # db.create_all, the revisions after this one add what they lack
+    existing = sa.inspect(op.get_bind()).get_table_names()
+    if 'movies' not in existing:
+        op.create_table(
+            'movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('release_year', sa.Integer(), nullable=False),
+            sa.Column('duration', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=180), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('title')
+        )
+    if 'actors' not in existing:
+        op.create_table(
+            'actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=256), nullable=False),
+            sa.Column('gender', sa.String(), nullable=False),
+            sa.Column('date_of_birth', sa.Date(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
 
 
 def downgrade():
-    pass
+    op.drop_table('actors')
+    op.drop_table('movies')
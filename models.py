@@ -1,26 +1,338 @@
 
-from sqlalchemy import Column, String, Date, Integer
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Date, Integer, ForeignKey, exc, \
+    case, event, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import QueuePool
 import os
+import sqlite3
+import time
+from datetime import date
+from changes import TRACKED_TABLES, initial_counters, trigger_statements
+from jsonutil import format_date
+from metrics import registry
+from routing import RoutingSQLAlchemy, DATABASE_REPLICA_URLS, replicas
 
 database_path = os.environ['DATABASE_URL']
+# rows per multi-row INSERT statement of insert_many
+INSERT_BATCH_SIZE = int(os.environ.get('INSERT_BATCH_SIZE', 1000))
+# rows per set-based UPDATE / DELETE statement of update_many, delete_many
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 1000))
 
-db = SQLAlchemy()
+# connections kept open per worker process, and opened on top of them
+# under load, multiply by the gunicorn workers to get the database total
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+# seconds after which a connection is replaced, below the server and
+# load balancer idle timeouts
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# test connections on checkout, drops the dead ones after a failover
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in \
+    ('1', 'true', 'yes')
 
+db = RoutingSQLAlchemy()
 
-def setup_db(app, database_path=database_path):
+pool_wait = registry.histogram(
+    'db_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection of the pool')
+pool_timeouts = registry.counter(
+    'db_pool_checkout_timeouts_total',
+    'Checkouts that gave up after DB_POOL_TIMEOUT')
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    TimedQueuePool
+    QueuePool recording how long each checkout waited for a connection,
+    opening a new overflow connection included
+    '''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_timeouts.inc()
+            raise
+        finally:
+            pool_wait.observe(time.perf_counter() - start)
+
+
+def pool_status(name):
+    '''reads a QueuePool counter of the current engine, None on other pools'''
+    def read():
+        status = getattr(db.get_engine().pool, name, None)
+        # SingletonThreadPool (sqlite://) has a plain int size
+        return status() if callable(status) else None
+    return read
+
+
+registry.gauge('db_pool_size', 'Connections the pool keeps open',
+               pool_status('size'))
+registry.gauge('db_pool_checked_out', 'Connections in use',
+               pool_status('checkedout'))
+registry.gauge('db_pool_checked_in', 'Idle connections of the pool',
+               pool_status('checkedin'))
+registry.gauge('db_pool_overflow', 'Connections open above the pool size',
+               pool_status('overflow'))
+
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    '''
+    sqlite leaves foreign keys unchecked unless asked on every connection,
+    the casting rows of a deleted movie or actor would stay behind
+    (ON DELETE CASCADE, passive_deletes)
+    '''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def engine_options(database_path):
+    '''
+    engine_options(database_path)
+        the SQLALCHEMY_ENGINE_OPTIONS of the database
+    '''
+    if database_path.startswith('sqlite'):
+        # sqlite keeps its own pools, one connection per thread or none
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+def setup_db(app, database_path=database_path,
+             replica_urls=DATABASE_REPLICA_URLS):
     '''
     setup_db(app)
         binds a flask application and a SQLAlchemy service
+        the read only views read from replica_urls when given
+        nothing connects to the database until the first query, the
+        schema is made by `python manage.py init_db` (or db upgrade)
     '''
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    replicas.dispose()
+    replicas.configure(replica_urls, engine_options)
     db.app = app
     db.init_app(app)
-    db.create_all()
 
 
-class Movies(db.Model):
+def bulk_insert(table, rows):
+    '''
+    bulk_insert(table, rows)
+        inserts rows (a list of column dicts) in batches of multi-row
+        INSERT statements within the current transaction
+        returns the new ids in the order of rows
+    '''
+    ids = []
+    if db.engine.dialect.name == 'postgresql':
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            chunk = rows[start:start + INSERT_BATCH_SIZE]
+            result = db.session.execute(
+                table.insert().values(chunk).returning(table.c.id))
+            ids.extend(row[0] for row in result)
+    else:
+        # without RETURNING the ids are only known one row at a time
+        for row in rows:
+            result = db.session.execute(table.insert().values(row))
+            ids.append(result.inserted_primary_key[0])
+    return ids
+
+
+def raise_if_stale(table, row_id, versions):
+    '''
+    called when a write matched no row, raises StaleDataError if the row
+    exists at another version, the one extra query of the failure path
+    '''
+    if versions is not None and db.session.execute(
+            select([table.c.id]).where(table.c.id == row_id)).first():
+        raise StaleDataError(f'{table.name} {row_id} is not at version '
+                             f'{versions}')
+
+
+def update_row(table, row_id, values, versions=None):
+    '''
+    update_row(Movies.__table__, 3, {'title': 'Up'}, versions=[2])
+        updates the row and bumps its version with a single UPDATE ...
+        RETURNING within the current transaction, the row is not read
+        first; with versions it only matches the row at one of them
+        returns the updated row, None when no row has the id
+        raises StaleDataError when the row is at another version
+    '''
+    condition = table.c.id == row_id
+    if versions is not None:
+        condition &= table.c.version.in_(versions)
+    statement = table.update().where(condition).values(
+        version=table.c.version + 1, **values)
+    if db.engine.dialect.name == 'postgresql':
+        row = db.session.execute(statement.returning(*table.c)).first()
+    else:
+        # without RETURNING the row is read back in the same transaction
+        row = None
+        if db.session.execute(statement).rowcount:
+            row = db.session.execute(
+                select([table]).where(table.c.id == row_id)).first()
+    if row is None:
+        raise_if_stale(table, row_id, versions)
+    return row
+
+
+def delete_row(table, row_id, versions=None):
+    '''
+    delete_row(Movies.__table__, 3, versions=[2])
+        deletes the row with a single DELETE within the current
+        transaction, its casting rows go with it (ON DELETE CASCADE)
+        returns False when no row has the id
+        raises StaleDataError when the row is at another version
+    '''
+    condition = table.c.id == row_id
+    if versions is not None:
+        condition &= table.c.version.in_(versions)
+    if db.session.execute(table.delete().where(condition)).rowcount:
+        return True
+    raise_if_stale(table, row_id, versions)
+    return False
+
+
+def existing_versions(table, ids):
+    '''{id: version} of the rows of ids that exist'''
+    return {row_id: version for row_id, version in db.session.execute(
+        select([table.c.id, table.c.version]).where(table.c.id.in_(ids)))}
+
+
+def update_rows(table, changes):
+    '''
+    update_rows(Movies.__table__, {3: ({'title': 'Up'}, 2), 4: ({...}, None)})
+        updates many rows, each with its own values and bumping its
+        version, with one UPDATE ... SET column = CASE id WHEN ... END per
+        WRITE_BATCH_SIZE rows within the current transaction; a row with
+        a version (not None) is only updated at that version
+        returns ({id: new version} of the updated rows, ids of the rows
+        left alone as they are at another version), the other ids do not
+        exist
+    '''
+    updated = {}
+    stale = set()
+    ids = list(changes)
+    for start in range(0, len(ids), WRITE_BATCH_SIZE):
+        chunk = ids[start:start + WRITE_BATCH_SIZE]
+        columns = {column for row_id in chunk
+                   for column in changes[row_id][0]}
+        values = {column: case(
+            {row_id: changes[row_id][0][column] for row_id in chunk
+             if column in changes[row_id][0]},
+            value=table.c.id, else_=table.c[column]) for column in columns}
+        versions = {row_id: changes[row_id][1] for row_id in chunk
+                    if changes[row_id][1] is not None}
+        condition = table.c.id.in_(chunk)
+        if versions:
+            condition &= table.c.version == case(
+                versions, value=table.c.id, else_=table.c.version)
+        statement = table.update().where(condition).values(
+            version=table.c.version + 1, **values)
+        if db.engine.dialect.name == 'postgresql':
+            found = {row_id: version for row_id, version in
+                     db.session.execute(statement.returning(
+                         table.c.id, table.c.version))}
+            missed = [row_id for row_id in chunk if row_id not in found]
+            # only a failure costs a query, telling stale from missing
+            before = existing_versions(table, missed) if missed else {}
+        else:
+            # without RETURNING the rows and versions are read first
+            before = existing_versions(table, chunk)
+            db.session.execute(statement)
+            found = {row_id: version + 1
+                     for row_id, version in before.items()
+                     if versions.get(row_id, version) == version}
+        updated.update(found)
+        stale.update(row_id for row_id in before if row_id not in found)
+    return updated, stale
+
+
+def delete_rows(table, ids):
+    '''
+    delete_rows(Movies.__table__, [3, 4])
+        deletes the rows with one DELETE per WRITE_BATCH_SIZE ids within
+        the current transaction, their casting rows go with them
+        returns the set of the deleted ids, the others do not exist
+    '''
+    deleted = set()
+    ids = list(ids)
+    for start in range(0, len(ids), WRITE_BATCH_SIZE):
+        chunk = ids[start:start + WRITE_BATCH_SIZE]
+        statement = table.delete().where(table.c.id.in_(chunk))
+        if db.engine.dialect.name == 'postgresql':
+            deleted.update(row_id for row_id, in db.session.execute(
+                statement.returning(table.c.id)))
+        else:
+            deleted.update(existing_versions(table, chunk))
+            db.session.execute(statement)
+    return deleted
+
+
+class RowWrites:
+    '''
+    RowWrites
+    Set-based writes of the rows of a table by id, each one in its own
+    transaction, and the version of a row, shared by Movies and Actor
+    '''
+
+    @classmethod
+    def _write(cls, write, *args):
+        # write(table, *args) of the helpers above, committed or rolled back
+        try:
+            result = write(cls.__table__, *args)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return result
+
+    @classmethod
+    def version_of(cls, row_id):
+        '''the version of the row, None when no row has the id'''
+        return db.session.query(cls.version).filter(
+            cls.id == row_id).scalar()
+
+    @classmethod
+    def insert_many(cls, rows):
+        '''the new ids, see bulk_insert'''
+        return cls._write(bulk_insert, rows)
+
+    @classmethod
+    def update_by_id(cls, row_id, values, versions=None):
+        '''the updated row, None when missing, see update_row'''
+        return cls._write(update_row, row_id, values, versions)
+
+    @classmethod
+    def delete_by_id(cls, row_id, versions=None):
+        '''False when missing, see delete_row'''
+        return cls._write(delete_row, row_id, versions)
+
+    @classmethod
+    def update_many(cls, changes):
+        '''see update_rows, all the rows in one transaction'''
+        return cls._write(update_rows, changes)
+
+    @classmethod
+    def delete_many(cls, ids):
+        '''see delete_rows, all the rows in one transaction'''
+        return cls._write(delete_rows, ids)
+
+
+class Movies(RowWrites, db.Model):
     '''
     Movies
     Have title and release year
@@ -28,9 +340,17 @@ class Movies(db.Model):
     __tablename__ = 'movies'
 
     id = Column(Integer, primary_key=True)
-    release_year = db.Column(Integer, nullable=False)
+    release_year = db.Column(Integer, nullable=False, index=True)
     duration = db.Column(Integer, nullable=False)
     title = Column(String(180), nullable=False, unique=True)
+    # bumped by every UPDATE, which only matches the row at the version
+    # it was read with (optimistic locking), see If-Match in app.py
+    version = Column(Integer, nullable=False, server_default='1')
+    # casting rows go with the movie (ON DELETE CASCADE)
+    cast = relationship('Casting', back_populates='movie',
+                        order_by='Casting.billing_order',
+                        cascade='all, delete-orphan', passive_deletes=True)
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, title, release_year, duration):
         self.title = title
@@ -56,11 +376,17 @@ class Movies(db.Model):
         }
 
     def long(self):
+        return self.long_of(self)
+
+    @staticmethod
+    def long_of(row):
+        '''long() of a result row of the table, or of a movie'''
         return {
-            'id': self.id,
-            'release_year': self.release_year,
-            'duration': self.duration,
-            'title': self.title
+            'id': row.id,
+            'release_year': row.release_year,
+            'duration': row.duration,
+            'title': row.title,
+            'version': row.version
         }
 
     def __repr__(self):
@@ -71,16 +397,21 @@ class Movies(db.Model):
                     for col in row.__table__.columns.keys())
 
 
-class Actor(db.Model):
+class Actor(RowWrites, db.Model):
     '''
     Actor
     Have name and dob
     '''
     __tablename__ = 'actors'
     id = Column(Integer, primary_key=True)
-    name = Column(String(256), nullable=False)
-    gender = Column(String(), nullable=False)
-    date_of_birth = Column(Date, nullable=False)
+    name = Column(String(256), nullable=False, index=True)
+    gender = Column(String(), nullable=False, index=True)
+    date_of_birth = Column(Date, nullable=False, index=True)
+    version = Column(Integer, nullable=False, server_default='1')
+    roles = relationship('Casting', back_populates='actor',
+                         order_by='Casting.billing_order',
+                         cascade='all, delete-orphan', passive_deletes=True)
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, name, gender, date_of_birth):
         self.name = name
@@ -105,11 +436,17 @@ class Actor(db.Model):
         }
 
     def long(self):
+        return self.long_of(self)
+
+    @staticmethod
+    def long_of(row):
+        '''long() of a result row of the table, or of an actor'''
         return {
-            "id": self.id,
-            "name": self.name,
-            "date_of_birth": self.date_of_birth.strftime("%B %d, %Y"),
-            "gender": self.gender
+            "id": row.id,
+            "name": row.name,
+            "date_of_birth": format_date(row.date_of_birth),
+            "gender": row.gender,
+            "version": row.version
         }
 
     def __repr__(self):
@@ -118,3 +455,112 @@ class Actor(db.Model):
     def row2dict(row):
         return dict((col, getattr(row, col))
                     for col in row.__table__.columns.keys())
+
+
+class TableChange(db.Model):
+    '''
+    TableChange
+    Write counter of a table, bumped by the triggers of changes.py
+    '''
+    __tablename__ = 'table_changes'
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, server_default='0')
+    modified_at = Column(Integer, nullable=False, server_default='0')
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def create_change_triggers(target, connection, **kwargs):
+    '''db.create_all counts the writes as the migrations make it do'''
+    dialect = connection.dialect.name
+    if dialect not in ('postgresql', 'sqlite'):
+        return
+    for row in initial_counters():
+        connection.execute(text(
+            'INSERT INTO table_changes (name, version, modified_at) '
+            'SELECT :name, :version, :modified_at WHERE NOT EXISTS '
+            '(SELECT 1 FROM table_changes WHERE name = :name)'), **row)
+    for table in TRACKED_TABLES:
+        for statement in trigger_statements(dialect, table):
+            connection.execute(text(statement))
+
+
+class Casting(db.Model):
+    '''
+    Casting
+    Have the role an actor plays in a movie and their billing order
+    '''
+    __tablename__ = 'casting'
+    movie_id = Column(Integer, ForeignKey('movies.id', ondelete='CASCADE'),
+                      primary_key=True)
+    actor_id = Column(Integer, ForeignKey('actors.id', ondelete='CASCADE'),
+                      primary_key=True, index=True)
+    role = Column(String(256))
+    billing_order = Column(Integer)
+    movie = relationship('Movies', back_populates='cast')
+    actor = relationship('Actor', back_populates='roles')
+
+    def __init__(self, movie_id, actor_id, role=None, billing_order=None):
+        self.movie_id = movie_id
+        self.actor_id = actor_id
+        self.role = role
+        self.billing_order = billing_order
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+    def long(self):
+        return {
+            'movie_id': self.movie_id,
+            'actor_id': self.actor_id,
+            'role': self.role,
+            'billing_order': self.billing_order
+        }
+
+    @classmethod
+    def actors_of(cls, movie_ids):
+        '''
+        actors_of(movie_ids)
+            loads the cast of many movies with one query
+            returns {movie id: [actor with role and billing order]}
+        '''
+        return cls._group(cls.movie_id, Actor, (
+            ('id', Actor.id), ('name', Actor.name),
+            ('date_of_birth', Actor.date_of_birth),
+            ('gender', Actor.gender), ('version', Actor.version)),
+            movie_ids)
+
+    @classmethod
+    def movies_of(cls, actor_ids):
+        '''
+        movies_of(actor_ids)
+            loads the movies of many actors with one query
+            returns {actor id: [movie with role and billing order]}
+        '''
+        return cls._group(cls.actor_id, Movies, (
+            ('id', Movies.id), ('release_year', Movies.release_year),
+            ('title', Movies.title)), actor_ids)
+
+    @classmethod
+    def _group(cls, key, related, fields, ids):
+        # plain result tuples turned into the long / short form of the
+        # related row plus role and billing order, no Casting objects built
+        grouped = {id: [] for id in ids}
+        if not ids:
+            return grouped
+        names = [name for name, _ in fields] + ['role', 'billing_order']
+        rows = db.session.query(
+            key, *[column for _, column in fields], cls.role,
+            cls.billing_order) \
+            .join(related) \
+            .filter(key.in_(ids)) \
+            .order_by(key, cls.billing_order)
+        for group_id, *values in rows:
+            grouped[group_id].append({
+                name: format_date(value) if isinstance(value, date)
+                else value for name, value in zip(names, values)})
+        return grouped
@@ -0,0 +1,202 @@
+import base64
+import json
+import os
+from datetime import date, datetime
+
+from sqlalchemy import and_, or_
+
+# page size used when the client does not send a limit
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+# largest page a client can ask for
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+
+
+def parse_date(value):
+    '''accepts date objects and YYYY-MM-DD strings such as "1950-03-9"'''
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def encode_cursor(values):
+    '''opaque cursor holding the sort key of the last row of a page'''
+    values = [value.isoformat() if isinstance(value, date) else value
+              for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+class Listing:
+    '''
+    Listing
+    Describes the list endpoint of a model: the fields a client can select
+    (`fields=`) and sort on (`sort=`), the default fields, the filters
+    as {query parameter: (column, operator, parser)} and the related rows
+    a client can embed (`include=`) as {name: loader}, where a loader
+    takes the ids of a page and returns {id: related rows} with a single
+    query
+    '''
+
+    OPERATORS = {
+        'eq': lambda column, value: column == value,
+        'min': lambda column, value: column >= value,
+        'max': lambda column, value: column <= value,
+        'prefix': lambda column, value:
+            column.startswith(value, autoescape=True),
+        'contains': lambda column, value:
+            column.contains(value, autoescape=True),
+    }
+
+    def __init__(self, model, default_fields, filters, formatters=None,
+                 includes=None):
+        self.model = model
+        self.columns = {column.name: getattr(model, column.name)
+                        for column in model.__table__.columns}
+        self.default_fields = default_fields
+        self.filters = filters
+        self.formatters = formatters or {}
+        self.includes = includes or {}
+
+    def parse_includes(self, value):
+        includes = [name for name in (value or '').split(',') if name]
+        if any(name not in self.includes for name in includes):
+            raise ValueError('unknown include')
+        return includes
+
+    def parse_fields(self, value):
+        if not value:
+            return list(self.default_fields)
+        fields = [field.strip() for field in value.split(',')]
+        if not fields or any(field not in self.columns for field in fields):
+            raise ValueError('unknown field')
+        return list(dict.fromkeys(fields))
+
+    def parse_sort(self, value):
+        '''returns [(field, descending)] ending with the id tie-breaker'''
+        keys = []
+        for field in (value.split(',') if value else []):
+            field = field.strip()
+            descending = field.startswith('-')
+            field = field.lstrip('-')
+            if field not in self.columns:
+                raise ValueError('unknown sort field')
+            if field == 'id':
+                keys.append((field, descending))
+                return keys
+            keys.append((field, descending))
+        keys.append(('id', False))
+        return keys
+
+    def parse_cursor(self, value, keys):
+        if not value:
+            return None
+        if keys == [('id', False)]:
+            after = self.cursor_value('id', int(value))
+            if after < 0:
+                raise ValueError('after must not be negative')
+            return [after]
+        values = decode_cursor(value)
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError('malformed cursor')
+        return [self.cursor_value(field, value)
+                for (field, _), value in zip(keys, values)]
+
+    def cursor_value(self, field, value):
+        '''
+        the value of a cursor for field, of the python type of its column,
+        a tampered cursor must not reach the query
+        raises ValueError on a value of another type or out of range
+        '''
+        python_type = self.columns[field].type.python_type
+        # dates travel as iso strings in the cursor
+        if python_type is date:
+            if not isinstance(value, str):
+                raise ValueError('malformed cursor')
+            return parse_date(value)
+        # bool is an int too
+        if not isinstance(value, python_type) or isinstance(value, bool):
+            raise ValueError('malformed cursor')
+        if python_type is int and not -2 ** 63 <= value < 2 ** 63:
+            raise ValueError('cursor value out of range')
+        return value
+
+    def keyset_filter(self, keys, values):
+        '''rows strictly after values in the (possibly mixed) key order'''
+        clauses = []
+        for index, (field, descending) in enumerate(keys):
+            column = self.columns[field]
+            equal = [self.columns[previous] == values[position]
+                     for position, (previous, _) in enumerate(keys[:index])]
+            after = column < values[index] if descending \
+                else column > values[index]
+            clauses.append(and_(*equal, after))
+        return or_(*clauses)
+
+    def filter_clauses(self, args):
+        '''
+        filter_clauses(request.args)
+            the conditions of the filter parameters present in args
+            raises ValueError on malformed values
+        '''
+        clauses = []
+        for parameter, (field, operator, parse) in self.filters.items():
+            value = args.get(parameter)
+            if value is not None:
+                clauses.append(self.OPERATORS[operator](self.columns[field],
+                                                        parse(value)))
+        return clauses
+
+    def page(self, args):
+        '''
+        page(request.args)
+            runs the filtered, sorted and projected keyset query described
+            by the query parameters, only the selected columns are read
+            returns the serialized rows and the cursor of the next page
+            raises ValueError on malformed parameters
+        '''
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        limit = min(limit, MAX_PAGE_SIZE)
+        fields = self.parse_fields(args.get('fields'))
+        keys = self.parse_sort(args.get('sort'))
+        cursor = self.parse_cursor(args.get('after'), keys)
+        includes = self.parse_includes(args.get('include'))
+
+        selected = list(dict.fromkeys(fields + [field for field, _ in keys]))
+        query = self.model.query.with_entities(
+            *[self.columns[field] for field in selected]).filter(
+            *self.filter_clauses(args))
+        if cursor is not None:
+            query = query.filter(self.keyset_filter(keys, cursor))
+        order = [self.columns[field].desc() if descending
+                 else self.columns[field] for field, descending in keys]
+        rows = query.order_by(*order).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            if keys == [('id', False)]:
+                next_cursor = last.id
+            else:
+                next_cursor = encode_cursor(
+                    [getattr(last, field) for field, _ in keys])
+        page = [self.serialize(row, fields) for row in rows]
+        for name in includes:
+            # one batched query for the whole page, not one per row
+            related = self.includes[name]([row.id for row in rows])
+            for row, result in zip(rows, page):
+                result[name] = related[row.id]
+        return page, next_cursor
+
+    def serialize(self, row, fields):
+        result = {}
+        for field in fields:
+            value = getattr(row, field)
+            formatter = self.formatters.get(field)
+            result[field] = formatter(value) if formatter else value
+        return result
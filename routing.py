@@ -0,0 +1,173 @@
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm
+
+from changes import table_changes
+from metrics import registry
+
+# comma separated urls of read replicas of DATABASE_URL, empty for none
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '')
+    .split(',') if url.strip()]
+# seconds a replica may lag behind the primary, reads of a table written
+# more recently, or by a client that wrote more recently, use the primary
+REPLICA_MAX_LAG = int(os.environ.get('REPLICA_MAX_LAG', 5))
+# seconds before a replica that failed is tried again
+REPLICA_RETRY_INTERVAL = int(os.environ.get('REPLICA_RETRY_INTERVAL', 30))
+# set on the responses of writes so the next reads of the client go to
+# the primary (read your writes)
+READ_PRIMARY_COOKIE = 'read_primary'
+
+replica_reads = registry.counter(
+    'db_replica_reads_total', 'Read only requests served by a replica')
+primary_reads = registry.counter(
+    'db_primary_reads_total', 'Read only requests kept on the primary')
+
+
+class ReplicaSet:
+    '''
+    ReplicaSet
+    Engines of the read replicas, handed out in turn. A replica is checked
+    before its first use and marked down when it fails, it is checked again
+    after REPLICA_RETRY_INTERVAL, meanwhile the others (or the primary)
+    serve its reads.
+    '''
+
+    def __init__(self, urls=(), engine_options=None,
+                 retry_interval=REPLICA_RETRY_INTERVAL):
+        self.configure(urls, engine_options)
+        self.retry_interval = retry_interval
+
+    def configure(self, urls, engine_options=None):
+        '''engine_options(url) gives the create_engine arguments'''
+        self.urls = list(urls)
+        self.engine_options = engine_options or (lambda url: {})
+        self.engines = [None] * len(self.urls)
+        # unchecked replicas count as down since forever, so checked now
+        self.down_since = {index: float('-inf')
+                           for index in range(len(self.urls))}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.urls)
+
+    def engine(self, index):
+        with self._lock:
+            if self.engines[index] is None:
+                url = self.urls[index]
+                engine = create_engine(url, **self.engine_options(url))
+
+                @event.listens_for(engine, 'handle_error')
+                def mark_down_on_disconnect(context):
+                    if context.is_disconnect or context.connection is None:
+                        self.mark_down(index)
+                self.engines[index] = engine
+            return self.engines[index]
+
+    def mark_down(self, index):
+        self.down_since[index] = time.monotonic()
+
+    def check(self, index):
+        '''runs a trivial query on the replica, returns whether it is up'''
+        try:
+            with self.engine(index).connect() as connection:
+                connection.execute('SELECT 1')
+        except exc.SQLAlchemyError:
+            self.mark_down(index)
+            return False
+        self.down_since.pop(index, None)
+        return True
+
+    def choose(self):
+        '''the next healthy replica engine, None when they are all down'''
+        for _ in range(len(self.urls)):
+            index = next(self._turn) % len(self.urls)
+            down_since = self.down_since.get(index)
+            if down_since is not None and (
+                    time.monotonic() - down_since < self.retry_interval or
+                    not self.check(index)):
+                continue
+            return self.engine(index)
+        return None
+
+    def dispose(self):
+        for engine in self.engines:
+            if engine is not None:
+                engine.dispose()
+
+
+replicas = ReplicaSet()
+
+
+class RoutingSession(SignallingSession):
+    '''
+    RoutingSession
+    Session reading from the replica chosen for the request by read_only,
+    flushes (writes) always go to the primary
+    '''
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and not self._flushing:
+            engine = g.get('read_engine')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def wrote_recently(tables):
+    '''
+    whether the client or anyone wrote tables within REPLICA_MAX_LAG,
+    as told by the write counters of the primary, whatever the cache
+    '''
+    if request.cookies.get(READ_PRIMARY_COOKIE):
+        return True
+    last_write = max(modified_at for _, modified_at
+                     in table_changes(tables).values())
+    return time.time() - last_write < REPLICA_MAX_LAG
+
+
+def read_only(*tables):
+    '''
+    read_only('movies', 'casting', 'actors')
+        decorator of a view that only reads tables, its queries go to a
+        replica when DATABASE_REPLICA_URLS is set and none of the tables
+        was written within REPLICA_MAX_LAG
+        put it below response_cache.cached so cache hits skip it
+    '''
+    def read_only_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if replicas:
+                g.read_engine = None if wrote_recently(tables) \
+                    else replicas.choose()
+                if g.read_engine is None:
+                    primary_reads.inc()
+                else:
+                    replica_reads.inc()
+            return f(*args, **kwargs)
+
+        return wrapper
+    return read_only_decorator
+
+
+def stick_to_primary(response):
+    '''after request hook, the next reads of a client that wrote go to
+    the primary'''
+    if replicas and request.method in ('POST', 'PATCH', 'DELETE') and \
+            response.status_code < 400:
+        response.set_cookie(READ_PRIMARY_COOKIE, '1',
+                            max_age=REPLICA_MAX_LAG, httponly=True)
+    return response
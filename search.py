@@ -0,0 +1,220 @@
+import os
+import re
+import threading
+import heapq
+from bisect import bisect_left
+from collections import defaultdict
+
+from changes import table_changes
+from models import db, Movies, Actor
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+# words of a query, longer queries are cut
+MAX_QUERY_TERMS = int(os.environ.get('MAX_QUERY_TERMS', 8))
+# deepest row a client can page to, ranked pages are read with an offset
+MAX_SEARCH_OFFSET = int(os.environ.get('MAX_SEARCH_OFFSET', 1000))
+# a shorter last word only matches whole words, 'a' would match most rows
+SEARCH_MIN_PREFIX = int(os.environ.get('SEARCH_MIN_PREFIX', 2))
+# matching rows per table ranked on postgresql, a broader query ranks the
+# SEARCH_MAX_CANDIDATES of them with the lowest ids and says it is truncated
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 5000))
+
+# type of a result: (model, searched column)
+SEARCH_TYPES = {
+    'movie': (Movies, 'title'),
+    'actor': (Actor, 'name'),
+}
+SEARCH_TABLES = ('movies', 'actors')
+
+
+def tokenize(text):
+    '''lower case words, the same split is used for documents and queries'''
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def parse_query(args):
+    '''
+    parse_query(request.args)
+        returns (terms, types, limit, offset)
+        raises ValueError on a missing query or malformed parameters
+    '''
+    terms = list(dict.fromkeys(tokenize(args.get('q'))))[:MAX_QUERY_TERMS]
+    if not terms:
+        raise ValueError('q is required')
+    types = args.get('type')
+    types = [types] if types else list(SEARCH_TYPES)
+    if any(kind not in SEARCH_TYPES for kind in types):
+        raise ValueError('unknown type')
+    limit = min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    offset = int(args.get('after', 0))
+    if limit < 1 or not 0 <= offset <= MAX_SEARCH_OFFSET:
+        raise ValueError('limit or after out of range')
+    return terms, types, limit, offset
+
+
+def is_prefix(term):
+    '''whether the last term of a query also matches the longer words'''
+    return len(term) >= SEARCH_MIN_PREFIX
+
+
+def postgres_search(terms, types, limit, offset):
+    '''
+    ranks the rows whose search_vector column (a tsvector kept by a
+    trigger and backed by a GIN index, see the search migration) matches
+    every term, the last term of the query matching as a prefix as the
+    user may still be typing
+    returns (rows, truncated), truncated when a table has more than
+    SEARCH_MAX_CANDIDATES matches
+    '''
+    # terms are \w+ only, they can not carry tsquery operators
+    last = terms[-1] + (':*' if is_prefix(terms[-1]) else '')
+    query = ' & '.join(terms[:-1] + [last])
+    # ts_rank scores a prefix match like a whole word, the rank of the
+    # whole words query puts the rows where the last term is complete first
+    # only the SEARCH_MAX_CANDIDATES matches with the lowest ids are ranked,
+    # the same ones on every page; reading one more match than that tells
+    # whether some were left out
+    selects = [
+        f"SELECT '{kind}' AS type, id, label, rank, truncated FROM ("
+        f"SELECT id, {column} AS label, "
+        f"ts_rank(search_vector, query) + "
+        f"ts_rank(search_vector, exact) AS rank, "
+        f"row_number() OVER (ORDER BY id) AS position, "
+        f"count(*) OVER () > :candidates AS truncated "
+        f"FROM (SELECT id, {column}, search_vector "
+        f"FROM {model.__tablename__} "
+        f"WHERE search_vector @@ to_tsquery('simple', :query) "
+        f"ORDER BY id LIMIT :candidates + 1) candidates, "
+        f"to_tsquery('simple', :query) query, "
+        f"to_tsquery('simple', :exact) exact"
+        f") ranked WHERE position <= :candidates"
+        for kind, (model, column) in SEARCH_TYPES.items() if kind in types]
+    rows = db.session.execute(
+        ' UNION ALL '.join(selects) +
+        ' ORDER BY rank DESC, type, id LIMIT :limit OFFSET :offset',
+        {'query': query, 'exact': ' & '.join(terms), 'limit': limit,
+         'offset': offset, 'candidates': SEARCH_MAX_CANDIDATES}).fetchall()
+    return [(row.type, row.id, row.label, row.rank) for row in rows], \
+        any(row.truncated for row in rows)
+
+
+class SearchIndex:
+    '''
+    SearchIndex
+    In-process inverted index of the movie titles and actor names, the
+    fallback of the databases without full text search (sqlite).
+    It is rebuilt on the first search after a write to the tables, told
+    by their write counters whichever process wrote.
+    '''
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.tokens = []
+        self.labels = {}
+        self.key = None
+        self._lock = threading.Lock()
+
+    def current_key(self):
+        # the write counters of the tables, see changes.py
+        return tuple(version for version, _ in
+                     table_changes(SEARCH_TABLES).values())
+
+    def build(self):
+        # postings hold {document: 1 / number of words of the document},
+        # shorter labels rank first among equal matches, like ts_rank
+        postings = defaultdict(dict)
+        labels = {}
+        for kind, (model, column) in SEARCH_TYPES.items():
+            for row_id, label in model.query.with_entities(
+                    model.id, getattr(model, column)):
+                words = tokenize(label)
+                labels[(kind, row_id)] = label
+                for word in words:
+                    postings[word][(kind, row_id)] = 1 / len(words)
+        self.postings = postings
+        self.labels = labels
+        self.tokens = sorted(postings)
+
+    def refresh(self):
+        key = self.current_key()
+        if key == self.key:
+            return
+        with self._lock:
+            if key != self.key:
+                self.build()
+                self.key = key
+
+    def matches(self, term, prefix):
+        '''{document: score} of the documents holding term'''
+        if not prefix:
+            return self.postings.get(term, {})
+        scores = {}
+        # the tokens starting with term are contiguous in sorted order
+        index = bisect_left(self.tokens, term)
+        while index < len(self.tokens) and \
+                self.tokens[index].startswith(term):
+            token = self.tokens[index]
+            # a whole word beats a longer word it is the start of
+            factor = len(term) / len(token)
+            if not scores:
+                scores = {document: weight * factor for document, weight
+                          in self.postings[token].items()}
+            else:
+                for document, weight in self.postings[token].items():
+                    score = weight * factor
+                    if score > scores.get(document, 0):
+                        scores[document] = score
+            index += 1
+        return scores
+
+    def search(self, terms, types, limit, offset):
+        self.refresh()
+        scores = None
+        for position, term in enumerate(terms):
+            found = self.matches(term, prefix=position == len(terms) - 1
+                                 and is_prefix(term))
+            if scores is None:
+                scores = found if len(types) == len(SEARCH_TYPES) else \
+                    {document: score for document, score in found.items()
+                     if document[0] in types}
+            else:
+                scores = {document: scores[document] + found[document]
+                          for document in scores if document in found}
+            if not scores:
+                return []
+        # plain tuples compare in C, only the rows up to the page are ordered
+        ranked = heapq.nsmallest(
+            offset + limit,
+            [(-score, kind, row_id)
+             for (kind, row_id), score in scores.items()])
+        return [(kind, row_id, self.labels[(kind, row_id)], -score)
+                for score, kind, row_id in ranked[offset:]]
+
+
+search_index = SearchIndex()
+
+
+def search(args):
+    '''
+    search(request.args)
+        returns a page of ranked results, each {"type": "movie", "id": id,
+        "title": title, "rank": rank} or {"type": "actor", "id": id,
+        "name": name, "rank": rank}, the cursor of the next page and
+        whether only part of the matches were ranked
+        raises ValueError on malformed parameters
+    '''
+    terms, types, limit, offset = parse_query(args)
+    if db.engine.dialect.name == 'postgresql':
+        rows, truncated = postgres_search(terms, types, limit + 1, offset)
+    else:
+        rows, truncated = search_index.search(terms, types, limit + 1,
+                                              offset), False
+    next_cursor = offset + limit if len(rows) > limit and \
+        offset + limit <= MAX_SEARCH_OFFSET else None
+    results = [{
+        'type': kind,
+        'id': row_id,
+        SEARCH_TYPES[kind][1]: label,
+        'rank': round(float(rank), 4),
+    } for kind, row_id, label, rank in rows[:limit]]
+    return results, next_cursor, truncated
@@ -2,18 +2,68 @@
 import os
 import unittest
 import json
+import uuid
+import tempfile
+import runpy
+import tracemalloc
+import asyncio
+from unittest import mock
+from datetime import date
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, upgrade
+from sqlalchemy import event, create_engine, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.orm.exc import StaleDataError
+from uvicorn.middleware.wsgi import WSGIMiddleware
 
 from app import create_app
-from models import Movies, Actor, setup_db
+from models import Movies, Actor, Casting, setup_db, db, \
+    engine_options, TimedQueuePool, pool_status, pool_wait, pool_timeouts
+from metrics import Registry
+from asgi import Lifespan, server_port_as_str
+from auth import auth
+from auth.auth import StaticJWKS
+from auth.issuer import LocalIssuer
+from routing import ReplicaSet, replicas, READ_PRIMARY_COOKIE
+import routing
+from export import export_rows
+from importer import import_file
+from cache import LRUBackend, LocalRedis, RedisBackend, response_cache
+from pagination import MAX_PAGE_SIZE, encode_cursor
+from search import search_index
+import jsonutil
+import bulk
+import models
 
 DB_PATH = os.getenv('DATABASE_URL',
                     "postgresql://postgres@localhost:5432/casting_agency")
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'migrations')
 
 
-EXECUTIVE_PRODUCER_TOKEN = os.getgetenv("TOKEN")
+# tokens signed by a local key, verified without auth0
+issuer = LocalIssuer(bits=1024)
+EXECUTIVE_PRODUCER_TOKEN = issuer.mint('producer', ttl=24 * 3600)
+CASTING_ASSISTANT_TOKEN = issuer.mint('assistant', ttl=24 * 3600)
 
 headers = {'Authorization': f'Bearer {EXECUTIVE_PRODUCER_TOKEN}'}
+key_provider = mock.patch.object(auth, 'key_provider',
+                                 StaticJWKS(issuer.jwks()))
+
+
+def setUpModule():
+    key_provider.start()
+    # the schema of the migrations, as manage.py init_db makes it
+    app = create_app()
+    setup_db(app, DB_PATH)
+    Migrate(app, db, directory=MIGRATIONS)
+    with app.app_context():
+        upgrade(directory=MIGRATIONS)
+
+
+def tearDownModule():
+    key_provider.stop()
 
 
 class CastingTestCase(unittest.TestCase):
@@ -61,6 +111,87 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['movie']))
 
+    def test_200_create_movie_returns_created_only(self):
+        """Test create movie answers with the new movie only"""
+        movie = dict(self.movie, title=f'Created movie {uuid.uuid4()}')
+        res = self.client().post('/movies', json=movie, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movie']), 1)
+        self.assertEqual(data['movie'][0]['id'], data['created'])
+        self.assertEqual(data['movie'][0]['title'], movie['title'])
+
+    def test_200_create_movie_full_list(self):
+        """Test create movie with the legacy full list response"""
+        movie = dict(self.movie, title=f'Created movie {uuid.uuid4()}')
+        res = self.client().post('/movies?full_list=true', json=movie,
+                                 headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movie']), Movies.query.count())
+        self.assertIn(data['created'],
+                      [movie['id'] for movie in data['movie']])
+
+    def test_200_create_movies_bulk(self):
+        """Test bulk create movies reports every record"""
+        title = f'Bulk movie {uuid.uuid4()}'
+        movies = [dict(self.movie, title=title),
+                  dict(self.movie, title=f'Bulk movie {uuid.uuid4()}'),
+                  dict(self.movie, title=title),
+                  {"title": "No duration", "release_year": 1999}]
+        res = self.client().post('/movies/bulk', json=movies,
+                                 headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual(Movies.query.get(data['results'][0]['id']).title,
+                         title)
+        self.assertIn('id', data['results'][1])
+        self.assertEqual(data['results'][2]['error'],
+                         'duplicate title in request')
+        self.assertEqual(data['results'][3]['error'], 'duration is required')
+
+    def test_200_create_movies_bulk_existing_title(self):
+        """Test bulk create movies reports title conflicts"""
+        title = f'Bulk movie {uuid.uuid4()}'
+        Movies(title=title, duration=90, release_year=2000).insert()
+        res = self.client().post('/movies/bulk',
+                                 json=[dict(self.movie, title=title)],
+                                 headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['error'], 'title already exists')
+
+    def test_400_create_movies_bulk_not_a_list(self):
+        """Test bulk create movies with a malformed body"""
+        res = self.client().post('/movies/bulk', json=self.movie,
+                                 headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_401_create_movies_bulk_noheader(self):
+        """Test bulk create movies without header """
+        res = self.client().post('/movies/bulk', json=[self.movie])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['message'], 'authorization_header_missing')
+
+    def test_200_export_movies(self):
+        """Test export movies streams one json line per movie"""
+        Movies(title=f'Exported movie {uuid.uuid4()}', duration=90,
+               release_year=2000).insert()
+        res = self.client().get('/movies/export', headers=headers)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), Movies.query.count())
+        self.assertIn('title', json.loads(lines[0]))
+
+    def test_401_export_movies_noheader(self):
+        """Test export movies without header """
+        res = self.client().get('/movies/export')
+        self.assertEqual(res.status_code, 401)
+
     def test_200_get_movies_noheader(self):
         """Test get movies without header since it does not require a header"""
         res = self.client().get('/movies')
@@ -77,6 +208,91 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['movie']))
 
+    def test_200_get_movies_paginated(self):
+        """Test walking the movies pages with the next cursor"""
+        for year in range(3):
+            Movies(title=f'Paged movie {uuid.uuid4()}', duration=90,
+                   release_year=2000 + year).insert()
+        ids, after = [], 0
+        while after is not None:
+            res = self.client().get(f'/movies?limit=2&after={after}')
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(data['movie']), 2)
+            ids += [movie['id'] for movie in data['movie']]
+            after = data['next_cursor']
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(len(ids), Movies.query.count())
+
+    def test_200_get_movies_limit_is_capped(self):
+        """Test the page size can not exceed the server maximum"""
+        res = self.client().get('/movies?limit=100000')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data['movie']), MAX_PAGE_SIZE)
+
+    def test_400_get_movies_invalid_limit(self):
+        """Test get movies with a malformed page size"""
+        res = self.client().get('/movies?limit=zero')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_200_get_movies_filtered_and_sorted(self):
+        """Test the release year and title filters with a sort"""
+        prefix = f'Filtered {uuid.uuid4()}'
+        for year in (1990, 1995, 2000, 2005):
+            Movies(title=f'{prefix} {year}', duration=90,
+                   release_year=year).insert()
+        res = self.client().get(
+            f'/movies?title_prefix={prefix}&release_year_min=1995'
+            '&release_year_max=2005&sort=-release_year&fields=title')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], [{'title': f'{prefix} 2005'},
+                                         {'title': f'{prefix} 2000'},
+                                         {'title': f'{prefix} 1995'}])
+
+    def test_200_get_movies_sorted_pages(self):
+        """Test the cursor of a sorted listing walks every row once"""
+        marker = str(uuid.uuid4())
+        for year in (2001, 1999, 2001, 2000, 1999):
+            Movies(title=f'Sorted {uuid.uuid4()} {marker}', duration=90,
+                   release_year=year).insert()
+        years, after = [], ''
+        while after is not None:
+            res = self.client().get(
+                f'/movies?title_contains={marker}&sort=-release_year'
+                f'&limit=2&after={after}')
+            data = json.loads(res.data)
+            years += [movie['release_year'] for movie in data['movie']]
+            after = data['next_cursor']
+        self.assertEqual(years, [2001, 2001, 2000, 1999, 1999])
+
+    def test_400_get_movies_tampered_cursor(self):
+        """Test a cursor whose values do not fit the sort columns"""
+        for values in ([{'a': 1}, 1], ['x', 1], [2000, 'x'], [True, 1],
+                       [2000, 10 ** 30], [2000.5, 1]):
+            res = self.client().get(
+                '/movies?sort=-release_year&after=' +
+                encode_cursor(values))
+            self.assertEqual(res.status_code, 400, values)
+        for after in ('!!', encode_cursor([1]), str(10 ** 30)):
+            res = self.client().get(f'/movies?after={after}')
+            self.assertEqual(res.status_code, 400, after)
+        res = self.client().get('/actors?sort=date_of_birth&after=' +
+                                encode_cursor([19500301, 1]),
+                                headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_get_movies_unknown_field(self):
+        """Test get movies with a field that does not exist"""
+        res = self.client().get('/movies?fields=budget')
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/movies?sort=budget')
+        self.assertEqual(res.status_code, 400)
+
     def test_404_get_movie_id_header(self):
         """Test get movies by ID that is not found """
         res = self.client().get('/movies/290', headers=headers)
@@ -134,6 +350,24 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['movie']))
 
+    def test_400_patch_movie_without_values(self):
+        """Test patch movies with only empty fields changes nothing"""
+        movie_id = Movies.query.all()[0].id
+        version = Movies.version_of(movie_id)
+        res = self.client().patch(f'/movies/{movie_id}',
+                                  json={"title": ""}, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'no field to update')
+        self.assertEqual(Movies.version_of(movie_id), version)
+
+    def test_404_patch_movie_empty_body(self):
+        """Test patch movies for a non found movie without fields"""
+        for data in ({}, {"title": ""}, {"rating": 5}):
+            res = self.client().patch('/movies/290', json=data,
+                                      headers=headers)
+            self.assertEqual(res.status_code, 404)
+
     def test_404_delete_movie_id_header(self):
         """Test get movies by ID that is not found """
         res = self.client().delete('/movies/20', headers=headers)
@@ -175,6 +409,19 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['actor']))
 
+    def test_200_create_actors_bulk(self):
+        """Test bulk create actors reports every record"""
+        actors = [self.actor, dict(self.actor, date_of_birth='03/09/1950')]
+        res = self.client().post('/actors/bulk', json=actors,
+                                 headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(Actor.query.get(data['results'][0]['id']).name,
+                         self.actor['name'])
+        self.assertEqual(data['results'][1]['error'],
+                         'date_of_birth is invalid')
+
     def test_404_get_actor_id_header(self):
         """Test get actors by ID that is not found """
         res = self.client().get('/actors/100', headers=headers)
@@ -210,6 +457,37 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['actor']))
 
+    def test_200_get_actors_paginated(self):
+        """Test get actors returns a bounded page and its cursor"""
+        for _ in range(2):
+            Actor(name='Paged actor', gender='F',
+                  date_of_birth=date(1980, 1, 1)).insert()
+        res = self.client().get('/actors?limit=1')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actor']), 1)
+        self.assertEqual(data['next_cursor'], data['actor'][0]['id'])
+
+    def test_200_get_actors_filtered(self):
+        """Test the gender and date of birth filters"""
+        gender = f'X-{uuid.uuid4()}'
+        for year in (1960, 1970, 1980):
+            Actor(name=f'Filtered actor {year}', gender=gender,
+                  date_of_birth=date(year, 6, 1)).insert()
+        res = self.client().get(
+            f'/actors?gender={gender}&date_of_birth_min=1965-01-01'
+            '&date_of_birth_max=1975-12-31')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actor']],
+                         ['Filtered actor 1970'])
+        self.assertEqual(data['actor'][0]['date_of_birth'], 'June 01, 1970')
+
+    def test_400_get_actors_invalid_date(self):
+        """Test get actors with a malformed date filter"""
+        res = self.client().get('/actors?date_of_birth_min=yesterday')
+        self.assertEqual(res.status_code, 400)
+
     def test_200_get_actors_header(self):
         """Test get actors with header """
         res = self.client().get('/actors', headers=headers)
@@ -250,6 +528,28 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['actor']))
 
+    def test_400_patch_actor_without_values(self):
+        """Test patch actors with only empty fields changes nothing"""
+        actor_id = Actor.query.all()[0].id
+        version = Actor.version_of(actor_id)
+        res = self.client().patch(f'/actors/{actor_id}',
+                                  json={"name": "", "gender": None},
+                                  headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'no field to update')
+        self.assertEqual(Actor.version_of(actor_id), version)
+        res = self.client().patch(f'/actors/{actor_id}', json={},
+                                  headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+    def test_404_patch_actor_empty_body(self):
+        """Test patch actors for a non found actor without fields"""
+        for data in ({}, {"name": ""}):
+            res = self.client().patch('/actors/100', json=data,
+                                      headers=headers)
+            self.assertEqual(res.status_code, 404)
+
     def test_404_delete_actor_id_header(self):
         """Test get actors by ID that is not found """
         res = self.client().delete('/actors/100', headers=headers)
@@ -276,6 +576,1227 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
 
 
+class QueryCounter:
+    """Records the SQL statements sent while it is active
+
+    listens on every engine by default, the session may still be bound to
+    the engine of an earlier app's setup_db
+    """
+
+    def __init__(self, engine=Engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class CastingRelationTestCase(unittest.TestCase):
+    """This class represents the movie actor casting test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, DB_PATH)
+        self.marker = str(uuid.uuid4())
+
+    def create_cast_movie(self, actors=2):
+        movie = Movies(title=f'Cast movie {uuid.uuid4()} {self.marker}',
+                       duration=90, release_year=2000)
+        movie.insert()
+        movie_id = movie.id
+        for order in range(actors):
+            actor = Actor(name=f'Cast actor {order}', gender='F',
+                          date_of_birth=date(1980, 1, 1))
+            actor.insert()
+            Casting(movie_id=movie_id, actor_id=actor.id,
+                    role=f'Role {order}', billing_order=order).insert()
+        return movie_id
+
+    def test_delete_removes_casting_rows(self):
+        """Test deleting a cast movie or actor deletes their casting rows"""
+        movie_id = self.create_cast_movie(actors=2)
+        actor_ids = [casting.actor_id for casting in
+                     Casting.query.filter_by(movie_id=movie_id)]
+        other_movie = self.create_cast_movie(actors=0)
+        Casting(movie_id=other_movie, actor_id=actor_ids[0]).insert()
+        res = self.client().delete(f'/movies/{movie_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Casting.query.filter_by(movie_id=movie_id).count(),
+                         0)
+        res = self.client().delete('/actors', json={'ids': actor_ids[:1]},
+                                   headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Casting.query.filter_by(
+            actor_id=actor_ids[0]).count(), 0)
+
+    def test_200_cast_and_uncast_actor(self):
+        """Test casting an actor then removing them from the cast"""
+        movie_id = self.create_cast_movie(actors=0)
+        actor = Actor(name='New cast member', gender='M',
+                      date_of_birth=date(1975, 2, 3))
+        actor.insert()
+        actor_id = actor.id
+        res = self.client().post(f'/movies/{movie_id}/actors', json={
+            'actor_id': actor_id, 'role': 'Lead', 'billing_order': 1
+        }, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['casting']['role'], 'Lead')
+
+        res = self.client().post(f'/movies/{movie_id}/actors',
+                                 json={'actor_id': actor_id},
+                                 headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+        res = self.client().delete(f'/movies/{movie_id}/actors/{actor_id}',
+                                   headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(Casting.query.get((movie_id, actor_id)))
+
+    def test_404_cast_unknown_actor(self):
+        """Test casting an actor that does not exist"""
+        movie_id = self.create_cast_movie(actors=0)
+        res = self.client().post(f'/movies/{movie_id}/actors',
+                                 json={'actor_id': 999999}, headers=headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_401_cast_actor_noheader(self):
+        """Test casting an actor without header"""
+        res = self.client().post('/movies/1/actors', json={'actor_id': 1})
+        self.assertEqual(res.status_code, 401)
+
+    def test_200_get_movie_include_actors(self):
+        """Test the cast of a movie is embedded in billing order"""
+        movie_id = self.create_cast_movie()
+        res = self.client().get(f'/movies/{movie_id}?include=actors',
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['role'] for actor in data['movie']['actors']],
+                         ['Role 0', 'Role 1'])
+
+    def test_200_get_actor_include_movies(self):
+        """Test the movies of an actor are embedded"""
+        movie_id = self.create_cast_movie(actors=1)
+        actor_id = Casting.query.filter_by(movie_id=movie_id).one().actor_id
+        res = self.client().get(f'/actors/{actor_id}?include=movies',
+                                headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['movies'][0]['id'], movie_id)
+
+    def test_400_get_movie_unknown_include(self):
+        """Test including a relation that does not exist"""
+        movie_id = self.create_cast_movie(actors=0)
+        res = self.client().get(f'/movies/{movie_id}?include=crew',
+                                headers=headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_include_actors_query_count(self):
+        """Test a page of movies with casts costs a constant query count"""
+        for _ in range(10):
+            self.create_cast_movie()
+        counts = []
+        for limit in (2, 10):
+            with QueryCounter() as counter:
+                res = self.client().get(
+                    f'/movies?title_contains={self.marker}&limit={limit}'
+                    '&include=actors')
+            data = json.loads(res.data)
+            self.assertEqual(len(data['movie']), limit)
+            self.assertTrue(all(len(movie['actors']) == 2
+                                for movie in data['movie']))
+            counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+
+
+class SearchTestCase(unittest.TestCase):
+    """This class represents the full text search test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, DB_PATH)
+        # a word no other row holds
+        self.word = 'w' + uuid.uuid4().hex[:12]
+
+    def add_movie(self, title):
+        movie = Movies(title=title, duration=90, release_year=2000)
+        movie.insert()
+        return movie.id
+
+    def search(self, query):
+        res = self.client().get(f'/search?{query}')
+        return res.status_code, json.loads(res.data)
+
+    def test_200_search_movies_and_actors(self):
+        """Test a word is found in titles and names"""
+        movie_id = self.add_movie(f'The {self.word} story')
+        Actor(name=f'Anna {self.word}', gender='F',
+              date_of_birth=date(1980, 1, 1)).insert()
+        status, data = self.search(f'q={self.word}')
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(result['type'] for result in data['results']),
+                         ['actor', 'movie'])
+        movie = [result for result in data['results']
+                 if result['type'] == 'movie'][0]
+        self.assertEqual(movie['id'], movie_id)
+
+        status, data = self.search(f'q={self.word}&type=actor')
+        self.assertEqual([result['name'] for result in data['results']],
+                         [f'Anna {self.word}'])
+
+    def test_200_search_prefix_ranks_whole_words_first(self):
+        """Test the last word matches as a prefix, exact words first"""
+        longer = self.add_movie(f'{self.word}ing night')
+        exact = self.add_movie(f'{self.word} night')
+        status, data = self.search(f'q=night {self.word}')
+        self.assertEqual(status, 200)
+        self.assertEqual([result['id'] for result in data['results']],
+                         [exact, longer])
+
+        status, data = self.search(f'q={self.word[:6]}ZZ')
+        self.assertEqual(data['results'], [])
+
+    def test_200_search_sees_new_rows(self):
+        """Test the index follows the writes"""
+        self.add_movie(f'{self.word} one')
+        self.assertEqual(len(self.search(f'q={self.word}')[1]['results']), 1)
+        self.add_movie(f'{self.word} two')
+        self.assertEqual(len(self.search(f'q={self.word}')[1]['results']), 2)
+
+    def test_200_search_pages(self):
+        """Test walking the ranked results page by page"""
+        ids = {self.add_movie(f'{self.word} part {part}')
+               for part in range(5)}
+        found = []
+        after = 0
+        while after is not None:
+            status, data = self.search(f'q={self.word}&limit=2&after={after}')
+            self.assertEqual(status, 200)
+            self.assertLessEqual(len(data['results']), 2)
+            found += [result['id'] for result in data['results']]
+            after = data['next_cursor']
+        self.assertEqual(sorted(found), sorted(ids))
+
+    def test_200_search_ranks_the_same_candidates_on_every_page(self):
+        """Test a broad query ranks the lowest ids and says so"""
+        ids = sorted(self.add_movie(f'{self.word} part {part}')
+                     for part in range(3))
+        truncated = db.engine.dialect.name == 'postgresql'
+        found = []
+        with mock.patch('search.SEARCH_MAX_CANDIDATES', 2):
+            for after in range(3):
+                status, data = self.search(
+                    f'q={self.word}&limit=1&after={after}')
+                self.assertEqual(data['truncated'], truncated and
+                                 bool(data['results']))
+                found += [result['id'] for result in data['results']]
+        self.assertEqual(sorted(found), ids[:2] if truncated else ids)
+
+    def test_400_search_without_query(self):
+        """Test a search without words"""
+        self.assertEqual(self.search('q=%20-')[0], 400)
+        self.assertEqual(self.search(f'q={self.word}&type=crew')[0], 400)
+        self.assertEqual(self.search(f'q={self.word}&after=-1')[0], 400)
+
+    def test_200_search_short_last_word_is_no_prefix(self):
+        """Test a one letter last word only matches whole words"""
+        self.add_movie(f'{self.word} night')
+        self.assertEqual(self.search(f'q={self.word} n')[1]['results'], [])
+        self.assertEqual(len(self.search(f'q={self.word} ni')[1]['results']),
+                         1)
+
+    def test_search_index_is_not_rebuilt_without_writes(self):
+        """Test the sqlite fallback index is reused between searches"""
+        if db.engine.dialect.name == 'postgresql':
+            self.skipTest('postgresql searches its tsvector columns')
+        self.add_movie(f'{self.word} cached')
+        # the freshness of the index does not depend on the response cache
+        with mock.patch.object(response_cache, 'backend', None):
+            self.search(f'q={self.word}')
+            index = search_index.postings
+            self.search(f'q={self.word}&limit=3')
+        self.assertIs(search_index.postings, index)
+
+    def test_search_index_sees_a_reused_id(self):
+        """Test a row deleted then replaced under its id is searched"""
+        if db.engine.dialect.name == 'postgresql':
+            self.skipTest('postgresql searches its tsvector columns')
+        alpha = self.add_movie(f'{self.word} alpha')
+        self.search(f'q={self.word}')
+        Movies.query.get(alpha).delete()
+        # sqlite gives the highest id again, the row count is back too
+        beta = self.add_movie(f'{self.word} beta')
+        status, data = self.search(f'q={self.word} beta')
+        self.assertEqual([result['id'] for result in data['results']],
+                         [beta])
+        self.assertEqual(self.search(f'q={self.word} alpha')[1]['results'],
+                         [])
+
+    def test_search_index_sees_writes_of_other_processes(self):
+        """Test a write that did not go through this app is found"""
+        if db.engine.dialect.name == 'postgresql':
+            self.skipTest('postgresql searches its tsvector columns')
+        movie_id = self.add_movie(f'{self.word} before')
+        with self.app.app_context():
+            search_index.search([self.word], ['movie'], 10, 0)
+            # no response cache invalidation, as from another worker
+            db.session.execute(Movies.__table__.update().where(
+                Movies.id == movie_id).values(
+                title=f'{self.word} after', version=Movies.version + 1))
+            db.session.commit()
+            results = search_index.search([self.word], ['movie'], 10, 0)
+        self.assertEqual([label for _, _, label, _ in results],
+                         [f'{self.word} after'])
+
+
+class PoolTestCase(unittest.TestCase):
+    """This class represents the connection pool test case"""
+
+    def make_engine(self):
+        # a single connection, so a second checkout has to wait
+        return create_engine(
+            'sqlite:///' + tempfile.mktemp(suffix='.db'),
+            poolclass=TimedQueuePool, pool_size=1, max_overflow=0,
+            pool_timeout=0.1,
+            connect_args={'check_same_thread': False})
+
+    def test_engine_options(self):
+        """Test the pool settings apply to server databases only"""
+        options = engine_options('postgresql://localhost/casting')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIn('pool_recycle', options)
+        self.assertEqual(engine_options('sqlite:////tmp/casting.db'), {})
+
+    def test_checkout_wait_is_recorded(self):
+        """Test checkouts and their timeouts are counted"""
+        engine = self.make_engine()
+        count, timeouts = pool_wait.count, pool_timeouts.value
+        connection = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+        connection.close()
+        engine.connect().close()
+        self.assertEqual(pool_wait.count, count + 3)
+        self.assertEqual(pool_timeouts.value, timeouts + 1)
+        self.assertEqual(engine.pool.checkedout(), 0)
+
+    def test_200_metrics(self):
+        """Test the pool metrics are served"""
+        app = create_app()
+        setup_db(app, DB_PATH)
+        res = app.test_client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'db_pool_checkout_wait_seconds_count', res.data)
+
+    def test_pool_status_of_other_pools(self):
+        """Test the pool gauges skip pools without the QueuePool api"""
+        engine = create_engine('sqlite://', poolclass=SingletonThreadPool)
+        with mock.patch.object(db, 'get_engine', return_value=engine):
+            self.assertIsNone(pool_status('size')())
+            self.assertIsNone(pool_status('checkedout')())
+
+    def test_registry_renders_prometheus_text(self):
+        """Test the text format of the metrics"""
+        registry = Registry()
+        registry.counter('requests_total', 'Requests').inc(2)
+        registry.gauge('in_use', 'In use', lambda: 3)
+        registry.histogram('wait_seconds', 'Wait', buckets=(0.1, 1)) \
+            .observe(0.5)
+        text = registry.render()
+        self.assertIn('# TYPE requests_total counter\nrequests_total 2', text)
+        self.assertIn('in_use 3', text)
+        self.assertIn('wait_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('wait_seconds_bucket{le="1"} 1', text)
+        self.assertIn('wait_seconds_count 1', text)
+
+    def test_registry_renders_labels(self):
+        """Test labeled metrics render one series per label values"""
+        registry = Registry()
+        latency = registry.histogram('latency_seconds', 'Latency',
+                                     buckets=(1,), labelnames=('endpoint',))
+        latency.labels('get_movies').observe(0.5)
+        latency.labels('get_actors').observe(2)
+        text = registry.render()
+        self.assertIn('latency_seconds_bucket{endpoint="get_movies",le="1"} 1',
+                      text)
+        self.assertIn('latency_seconds_bucket{endpoint="get_actors",le="1"} 0',
+                      text)
+        self.assertEqual(text.count('# TYPE latency_seconds histogram'), 1)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        """Run the app on a primary and a replica sqlite database"""
+        self.primary = 'sqlite:///' + tempfile.mktemp(suffix='.db')
+        self.replica = 'sqlite:///' + tempfile.mktemp(suffix='.db')
+        self.replica_engine = create_engine(self.replica)
+        db.Model.metadata.create_all(self.replica_engine)
+        self.app = create_app()
+        setup_db(self.app, self.primary, replica_urls=[self.replica])
+        db.create_all()
+
+    def tearDown(self):
+        """Back to the shared test database, without replicas"""
+        self.replica_engine.dispose()
+        setup_db(self.app, DB_PATH, replica_urls=[])
+
+    def add_movie(self):
+        """a movie of the primary, replicated under another title"""
+        movie = Movies(title=f'primary {uuid.uuid4()}', duration=90,
+                       release_year=2000)
+        movie.insert()
+        self.replica_engine.execute(Movies.__table__.insert(), {
+            'id': movie.id, 'title': f'replica {uuid.uuid4()}',
+            'duration': 90, 'release_year': 2000})
+        return movie.id
+
+    def get_title(self, client, movie_id):
+        res = client.get(f'/movies/{movie_id}', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['movie']['title']
+
+    def test_reads_go_to_the_replica(self):
+        """Test a read only view reads from the replica"""
+        movie_id = self.add_movie()
+        with mock.patch.object(routing, 'REPLICA_MAX_LAG', 0):
+            title = self.get_title(self.app.test_client(), movie_id)
+        self.assertTrue(title.startswith('replica'))
+
+    def test_reads_after_a_recent_write_use_the_primary(self):
+        """Test a table written within the replica lag is read on the
+        primary"""
+        movie_id = self.add_movie()
+        title = self.get_title(self.app.test_client(), movie_id)
+        self.assertTrue(title.startswith('primary'))
+
+    def test_client_reads_its_own_writes(self):
+        """Test the writes go to the primary and the next reads of the
+        client too"""
+        client = self.app.test_client()
+        res = client.post('/movies', json={
+            'title': f'written {uuid.uuid4()}', 'duration': 90,
+            'release_year': 2000}, headers=headers)
+        movie_id = json.loads(res.data)['created']
+        self.assertIn(READ_PRIMARY_COOKIE, res.headers['Set-Cookie'])
+        self.assertIsNone(self.replica_engine.execute(
+            'SELECT id FROM movies WHERE id = ?', movie_id).first())
+        # only the cookie keeps the client on the primary
+        with mock.patch.object(routing, 'REPLICA_MAX_LAG', 0):
+            self.assertTrue(
+                self.get_title(client, movie_id).startswith('written'))
+
+    def test_down_replica_falls_back_to_the_primary(self):
+        """Test reads use the primary while the replica is down"""
+        setup_db(self.app, self.primary,
+                 replica_urls=['sqlite:////missing/directory/replica.db'])
+        movie_id = self.add_movie()
+        with mock.patch.object(routing, 'REPLICA_MAX_LAG', 0):
+            title = self.get_title(self.app.test_client(), movie_id)
+        self.assertTrue(title.startswith('primary'))
+        self.assertIn(0, replicas.down_since)
+
+    def test_replicas_are_used_in_turn(self):
+        """Test round robin over the healthy replicas"""
+        replica_set = ReplicaSet([self.replica, self.replica])
+        first, second, third = (replica_set.choose() for _ in range(3))
+        self.assertIsNot(first, second)
+        self.assertIs(first, third)
+        replica_set.mark_down(1)
+        self.assertIs(replica_set.choose(), first)
+        self.assertIs(replica_set.choose(), first)
+        replica_set.dispose()
+
+
+class AsgiTestCase(unittest.TestCase):
+    """This class represents the asgi entry point test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        setup_db(self.app, DB_PATH)
+        self.asgi_app = Lifespan(WSGIMiddleware(
+            server_port_as_str(self.app), workers=2))
+
+    def call(self, method, path, query=b'', body=b'', headers=None):
+        """runs an http request through the asgi app, returns the messages
+        it sent"""
+        messages = []
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': query, 'http_version': '1.1', 'root_path': '',
+            'scheme': 'http', 'server': ('testserver', 80),
+            'client': ('127.0.0.1', 5000),
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in headers.items()],
+        }
+        requests = [{'type': 'http.request', 'body': body,
+                     'more_body': False}]
+
+        async def receive():
+            return requests.pop(0)
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+        return messages
+
+    def test_200_get_movies(self):
+        """Test the routes of create_app answer through asgi"""
+        messages = self.call('GET', '/movies', query=b'limit=1')
+        self.assertEqual(messages[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in messages)
+        self.assertTrue(json.loads(body)['success'])
+
+    def test_401_error_handlers(self):
+        """Test the error handlers of create_app answer through asgi"""
+        messages = self.call('POST', '/movies', body=b'{}')
+        self.assertEqual(messages[0]['status'], 401)
+        self.assertEqual(json.loads(messages[1]['body'])['message'],
+                         'authorization_header_missing')
+
+    def test_200_export_is_streamed(self):
+        """Test a streamed response is sent chunk by chunk"""
+        for _ in range(3):
+            Movies(title=f'asgi {uuid.uuid4()}', duration=90,
+                   release_year=2000).insert()
+        messages = self.call('GET', '/movies/export', headers=headers)
+        self.assertEqual(messages[0]['status'], 200)
+        chunks = [message for message in messages[1:]
+                  if message.get('more_body')]
+        self.assertGreaterEqual(len(chunks), 3)
+        self.assertEqual(messages[-1], {'type': 'http.response.body',
+                                        'body': b''})
+
+    def test_lifespan_refreshes_jwks_in_background(self):
+        """Test startup starts the jwks refresh and shutdown stops it"""
+        messages = []
+        events = [{'type': 'lifespan.startup'},
+                  {'type': 'lifespan.shutdown'}]
+
+        async def receive():
+            # let the refresh task run before shutting down
+            await asyncio.sleep(0.05)
+            return events.pop(0)
+
+        async def send(message):
+            messages.append(message['type'])
+
+        with mock.patch.object(auth.key_provider, 'refresh') as refresh:
+            asyncio.run(self.asgi_app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(messages, ['lifespan.startup.complete',
+                                    'lifespan.shutdown.complete'])
+        refresh.assert_called_with(auth.key_provider.ttl / 2)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    """This class represents the per request metrics test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, DB_PATH)
+
+    def timings(self, res):
+        """the Server-Timing header as {name: (duration, description)}"""
+        timings = {}
+        for timing in res.headers['Server-Timing'].split(', '):
+            name, *params = timing.split(';')
+            params = dict(param.split('=', 1) for param in params)
+            timings[name] = (float(params['dur']),
+                             params.get('desc', '').strip('"'))
+        return timings
+
+    def test_server_timing_counts_statements(self):
+        """Test the db statements of a request are counted and timed"""
+        url = f'/movies?limit=3&title_contains={uuid.uuid4()}'
+        res = self.client().get(url)
+        timings = self.timings(res)
+        # the write counters of the table, then the page
+        self.assertEqual(timings['db'][1], '2 statements')
+        self.assertGreater(timings['total'][0], 0)
+        # served from the response cache, only the counters are read
+        res = self.client().get(url)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(self.timings(res)['db'][1], '1 statements')
+
+    def test_failed_statement_is_finished(self):
+        """Test a statement that raises leaves no start time behind"""
+        engine = create_engine('sqlite://')
+        with engine.connect() as connection:
+            with self.assertRaises(exc.OperationalError):
+                connection.execute('SELECT * FROM missing_table')
+            self.assertEqual(connection.info['statement_started'], [])
+            connection.execute('SELECT 1')
+            self.assertEqual(connection.info['statement_started'], [])
+
+    def test_server_timing_reports_auth(self):
+        """Test the token verification time is reported"""
+        res = self.client().get('/movies/export', headers=headers)
+        self.assertIn('auth', self.timings(res))
+        res = self.client().post('/movies', json={})
+        self.assertEqual(res.status_code, 401)
+        self.assertIn('auth', self.timings(res))
+
+    def test_metrics_per_endpoint(self):
+        """Test the request metrics are served per endpoint"""
+        self.client().get(f'/movies?title_prefix={uuid.uuid4()}')
+        self.client().get('/missing')
+        text = self.client().get('/metrics').data.decode()
+        for line in (
+                'http_request_duration_seconds_count'
+                '{method="GET",endpoint="get_movies"}',
+                'http_requests_total'
+                '{method="GET",endpoint="unmatched",status="404"}',
+                'http_request_db_statements_bucket'
+                '{method="GET",endpoint="get_movies",le="1"}',
+                'http_request_db_seconds_sum'
+                '{method="GET",endpoint="get_movies"}',
+                'http_response_size_bytes_count'
+                '{method="GET",endpoint="get_movies"}'):
+            self.assertIn(line, text)
+
+
+class ExportTestCase(unittest.TestCase):
+    """This class represents the streaming export test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        setup_db(self.app, DB_PATH)
+        self.marker = f'Synthetic movie {uuid.uuid4()}'
+
+    def tearDown(self):
+        """Remove the seeded movies, the other tests count on small tables"""
+        Movies.delete_many([movie_id for movie_id, in db.session.query(
+            Movies.id).filter(Movies.title.startswith(self.marker))])
+
+    def seed(self, count):
+        db.session.execute(Movies.__table__.insert(), [
+            {'title': f'{self.marker} {uuid.uuid4()}', 'duration': 90,
+             'release_year': 2000} for _ in range(count)])
+        db.session.commit()
+
+    def export_peak_memory(self):
+        tracemalloc.start()
+        lines = sum(1 for _ in export_rows(Movies, fetch_size=500))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(lines, Movies.query.count())
+        return peak
+
+    def test_export_memory_is_flat(self):
+        """Test exporting a 10 times larger table uses as much memory"""
+        self.seed(2000)
+        small_peak = self.export_peak_memory()
+        self.seed(20000)
+        large_peak = self.export_peak_memory()
+        self.assertLess(large_peak, small_peak * 1.5)
+
+
+class ImportTestCase(unittest.TestCase):
+    """This class represents the streaming import test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        setup_db(self.app, DB_PATH)
+        self.title = f'Imported movie {uuid.uuid4()}'
+
+    def write_file(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w') as import_file:
+            import_file.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_csv_skips_duplicates(self):
+        """Test invalid rows and duplicate titles are reported"""
+        path = self.write_file('.csv', 'title,duration,release_year\n'
+                               f'{self.title},100,1999\n'
+                               f'{self.title},120,2001\n'
+                               'Broken movie,long,2001\n')
+        report = import_file(Movies, path, chunk_size=2)
+        self.assertEqual(report['read'], 3)
+        self.assertEqual(report['written'], 1)
+        self.assertEqual(report['skipped'], 1)
+        self.assertEqual(report['errors'], [{'line': 4, 'error':
+                                             'duration is invalid'}])
+        self.assertEqual(Movies.query.filter_by(title=self.title)
+                         .one().duration, 100)
+        self.assertIn('rows_per_second', report)
+        self.assertIn('peak_rss_mb', report)
+
+    def test_import_ndjson_upserts_titles(self):
+        """Test the upsert policy updates existing titles"""
+        Movies(title=self.title, duration=100, release_year=1999).insert()
+        path = self.write_file('.ndjson', json.dumps({
+            'title': self.title, 'duration': 150, 'release_year': 2000
+        }) + '\nnot json\n')
+        report = import_file(Movies, path, on_conflict='upsert')
+        self.assertEqual(report['written'], 1)
+        self.assertEqual(report['invalid'], 1)
+        db.session.expire_all()
+        movie = Movies.query.filter_by(title=self.title).one()
+        self.assertEqual(movie.duration, 150)
+        self.assertEqual(movie.version, 2)
+
+    def test_import_actors(self):
+        """Test actors are imported from csv"""
+        before = Actor.query.count()
+        path = self.write_file('.csv', 'name,gender,date_of_birth\n'
+                               'Imported actor,F,1970-05-2\n')
+        report = import_file(Actor, path)
+        self.assertEqual(report['written'], 1)
+        self.assertEqual(Actor.query.count(), before + 1)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, DB_PATH)
+
+    def test_get_movies_is_served_from_cache(self):
+        """Test the second identical request does not hit the database"""
+        first = self.client().get('/movies?limit=5')
+        second = self.client().get('/movies?limit=5')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+
+    def test_insert_invalidates_cached_movies(self):
+        """Test a committed insert is visible on the next request"""
+        self.client().get('/movies?limit=100')
+        movie = Movies(title=f'Cached movie {uuid.uuid4()}', duration=90,
+                       release_year=2000)
+        movie.insert()
+        res = self.client().get('/movies?limit=100&after=' +
+                                str(movie.id - 1))
+        data = json.loads(res.data)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['movie'][0]['id'], movie.id)
+
+    def test_update_and_delete_invalidate_cached_actor(self):
+        """Test cached actor responses are dropped on update and delete"""
+        actor = Actor(name='Cached actor', gender='F',
+                      date_of_birth=date(1980, 1, 1))
+        actor.insert()
+        actor_id = actor.id
+        url = f'/actors?after={actor_id - 1}&limit=1'
+        self.client().get(url)
+        actor = Actor.query.get(actor_id)
+        actor.name = 'Renamed actor'
+        actor.update()
+        data = json.loads(self.client().get(url).data)
+        self.assertEqual(data['actor'][0]['name'], 'Renamed actor')
+        Actor.query.get(actor_id).delete()
+        data = json.loads(self.client().get(url).data)
+        self.assertNotIn(actor_id, [row['id'] for row in data['actor']])
+
+    def test_304_get_movies_if_none_match(self):
+        """Test an unchanged list is answered with not modified"""
+        res = self.client().get('/movies')
+        etag = res.headers['ETag']
+        res = self.client().get('/movies', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_200_get_movies_if_none_match_after_insert(self):
+        """Test a write changes the etag of the table"""
+        etag = self.client().get('/movies').headers['ETag']
+        Movies(title=f'Etag movie {uuid.uuid4()}', duration=90,
+               release_year=2000).insert()
+        res = self.client().get('/movies', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_etag_depends_on_the_query(self):
+        """Test two pages of the same table have different etags"""
+        first = self.client().get('/movies?limit=1').headers['ETag']
+        second = self.client().get('/movies?limit=2').headers['ETag']
+        self.assertNotEqual(first, second)
+
+    def test_304_get_actors_if_modified_since(self):
+        """Test the last modified date of the table"""
+        res = self.client().get('/actors')
+        last_modified = res.headers['Last-Modified']
+        res = self.client().get('/actors', headers={
+            'If-Modified-Since': last_modified})
+        self.assertEqual(res.status_code, 304)
+
+    def test_404_get_missing_movie_if_modified_since(self):
+        """Test a missing row is not answered with not modified"""
+        res = self.client().get('/movies/999999', headers=dict(
+            headers, **{'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}))
+        self.assertEqual(res.status_code, 404)
+
+    def test_304_from_another_worker(self):
+        """Test a worker with its own memory cache answers not modified"""
+        with mock.patch.object(response_cache, 'backend', LRUBackend()):
+            etag = self.client().get('/movies').headers['ETag']
+        with mock.patch.object(response_cache, 'backend', LRUBackend()):
+            res = self.client().get('/movies',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 304)
+            # a write that went through neither worker
+            with self.app.app_context():
+                db.session.execute(Movies.__table__.insert().values(
+                    title=f'Raw movie {uuid.uuid4()}', duration=90,
+                    release_year=2000))
+                db.session.commit()
+            res = self.client().get('/movies',
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_memory_caches_see_the_writes_of_other_workers(self):
+        """Test a per worker cache misses after a write of another worker"""
+        worker, other_worker = LRUBackend(), LRUBackend()
+        with mock.patch.object(response_cache, 'backend', worker):
+            self.client().get('/movies?limit=1&sort=-id')
+        with mock.patch.object(response_cache, 'backend', other_worker):
+            res = self.client().post('/movies', json={
+                'title': f'Other worker {uuid.uuid4()}', 'duration': 90,
+                'release_year': 2000}, headers=headers)
+            movie_id = json.loads(res.data)['created']
+        with mock.patch.object(response_cache, 'backend', worker):
+            res = self.client().get('/movies?limit=1&sort=-id')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(res.data)['movie'][0]['id'], movie_id)
+
+    def test_errors_are_not_cached(self):
+        """Test only successful responses are stored"""
+        self.client().get('/movies?limit=zero')
+        res = self.client().get('/movies?limit=zero')
+        self.assertEqual(res.status_code, 400)
+
+    def test_backends_share_the_interface(self):
+        """Test the lru and the shared backend behave the same"""
+        for backend in (LRUBackend(max_entries=2),
+                        RedisBackend(LocalRedis())):
+            backend.set('key', b'body', 60)
+            self.assertEqual(backend.get('key'), b'body')
+            backend.set('expired', b'body', -1)
+            self.assertIsNone(backend.get('expired'))
+
+    def test_lru_backend_is_bounded(self):
+        """Test the in process backend evicts the oldest entries"""
+        backend = LRUBackend(max_entries=2)
+        for key in ('first', 'second', 'third'):
+            backend.set(key, b'body')
+        self.assertIsNone(backend.get('first'))
+        self.assertEqual(backend.get('third'), b'body')
+
+
+class JsonTestCase(unittest.TestCase):
+    """This class represents the fast json responses test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, DB_PATH)
+        self.data = {'success': True, 'title': 'Amélie', 'count': 3,
+                     'ratio': 1.5, 'next_cursor': None,
+                     'released': date(2001, 4, 25)}
+
+    def test_every_backend_encodes_alike(self):
+        """Test each installed encoder matches the stdlib one"""
+        expected = jsonutil.make_dumps('json')(self.data)
+        for name in ('orjson', 'ujson'):
+            try:
+                dumps = jsonutil.make_dumps(name)
+            except ImportError:
+                continue
+            self.assertEqual(json.loads(dumps(self.data)),
+                             json.loads(expected), name)
+
+    def test_dates_are_encoded_like_flask(self):
+        """Test a raw date is sent as the flask http date"""
+        with self.app.app_context():
+            response = jsonutil.jsonify(self.data)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.get_json()['released'],
+                         'Wed, 25 Apr 2001 00:00:00 GMT')
+
+    def test_format_date_is_cached(self):
+        """Test each distinct date is formatted once"""
+        jsonutil.format_date.cache_clear()
+        for _ in range(3):
+            self.assertEqual(jsonutil.format_date(date(1950, 3, 9)),
+                             'March 09, 1950')
+        info = jsonutil.format_date.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 2))
+
+    def test_include_rows_match_model_serialization(self):
+        """Test the cast read from tuples matches Actor.long()"""
+        with self.app.app_context():
+            movie = Movies(title=f'Json {uuid.uuid4().hex}', duration=90,
+                           release_year=2000)
+            movie.insert()
+            actor = Actor(name='Json actor', gender='F',
+                          date_of_birth=date(1980, 1, 2))
+            actor.insert()
+            Casting(movie_id=movie.id, actor_id=actor.id, role='lead',
+                    billing_order=1).insert()
+            expected = dict(actor.long(), role='lead', billing_order=1)
+            movie_id = movie.id
+        res = self.client().get(f'/movies/{movie_id}?include=actors',
+                                headers=headers)
+        self.assertEqual(res.get_json()['movie']['actors'], [expected])
+
+
+class VersionTestCase(unittest.TestCase):
+    """This class represents the optimistic locking test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, DB_PATH)
+        self.title = f'Versioned movie {uuid.uuid4()}'
+        movie = Movies(title=self.title, duration=90, release_year=2000)
+        movie.insert()
+        self.movie_id = movie.id
+        actor = Actor(name='Versioned actor', gender='F',
+                      date_of_birth=date(1980, 1, 1))
+        actor.insert()
+        self.actor_id = actor.id
+
+    def patch(self, path, data, if_match=None):
+        extra = {} if if_match is None else {'If-Match': if_match}
+        return self.client().patch(path, json=data,
+                                   headers=dict(headers, **extra))
+
+    def test_patch_bumps_the_version(self):
+        """Test a PATCH returns the next version in the body and ETag"""
+        res = self.patch(f'/movies/{self.movie_id}', {'duration': 100},
+                         '"1"')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['version'], 2)
+        self.assertEqual(res.headers['ETag'], '"2"')
+
+        res = self.patch(f'/movies/{self.movie_id}', {'duration': 110})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"3"')
+
+    def test_412_patch_stale_version(self):
+        """Test a PATCH of a version someone else updated is refused"""
+        path = f'/movies/{self.movie_id}'
+        self.assertEqual(self.patch(path, {'duration': 100}, '"1"')
+                         .status_code, 200)
+        res = self.patch(path, {'duration': 120}, '"1"')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['message'], 'precondition failed')
+        self.assertEqual(Movies.query.get(self.movie_id).duration, 100)
+
+        path = f'/actors/{self.actor_id}'
+        res = self.patch(path, {'name': 'Stale'}, '"7"')
+        self.assertEqual(res.status_code, 412)
+        res = self.patch(path, {'name': 'Fresh'}, '*')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"2"')
+
+    def test_patch_and_delete_with_the_etag_of_a_get(self):
+        """Test the ETag of a GET by id is accepted as If-Match"""
+        path = f'/movies/{self.movie_id}'
+        etag = self.client().get(path, headers=headers).headers['ETag']
+        res = self.patch(path, {'duration': 100}, etag)
+        self.assertEqual(res.status_code, 200)
+        # the etag of the read before the PATCH is stale now
+        self.assertEqual(self.patch(path, {'duration': 110}, etag)
+                         .status_code, 412)
+        res = self.client().get(path, headers=headers)
+        self.assertTrue(res.headers['ETag'].startswith('"2-'))
+
+        path = f'/actors/{self.actor_id}'
+        etag = self.client().get(path + '?include=movies',
+                                 headers=headers).headers['ETag']
+        res = self.client().delete(path, headers=dict(
+            headers, **{'If-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+
+    def test_412_delete_stale_version(self):
+        """Test a DELETE only goes through on the current version"""
+        res = self.client().delete(f'/actors/{self.actor_id}', headers=dict(
+            headers, **{'If-Match': '"2"'}))
+        self.assertEqual(res.status_code, 412)
+        self.assertIsNotNone(Actor.query.get(self.actor_id))
+        res = self.client().delete(f'/actors/{self.actor_id}', headers=dict(
+            headers, **{'If-Match': '"1"'}))
+        self.assertEqual(res.status_code, 200)
+
+    def test_update_checks_the_version_it_read(self):
+        """Test the UPDATE matches the row at its read version only"""
+        with self.app.app_context():
+            movie = Movies.query.get(self.movie_id)
+            with QueryCounter() as counter:
+                # another editor commits between the read and the write
+                db.session.execute(Movies.__table__.update().where(
+                    Movies.id == self.movie_id).values(
+                    version=Movies.version + 1))
+                movie.duration = 130
+                with self.assertRaises(StaleDataError):
+                    movie.update()
+                db.session.rollback()
+        update = [statement for statement in counter.statements
+                  if statement.startswith('UPDATE movies SET duration')]
+        self.assertEqual(len(update), 1)
+        self.assertIn('movies.version = ', update[0])
+
+    def statements(self, call):
+        """the response of call and the SQL statements it ran"""
+        with QueryCounter() as counter:
+            res = call()
+        return res, counter.statements
+
+    def test_patch_and_delete_run_one_statement(self):
+        """Test a PATCH or DELETE writes without reading the row first"""
+        returning = db.get_engine(self.app).dialect.name == 'postgresql'
+        res, statements = self.statements(lambda: self.patch(
+            f'/movies/{self.movie_id}', {'duration': 140}, '"1"'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['movie'], {
+            'id': self.movie_id, 'title': self.title,
+            'duration': 140, 'release_year': 2000, 'version': 2})
+        self.assertTrue(statements[0].startswith('UPDATE movies'))
+        # other databases read the row back, without RETURNING
+        self.assertEqual(len(statements), 1 if returning else 2)
+
+        res, statements = self.statements(lambda: self.patch(
+            f'/actors/{self.actor_id}', {'date_of_birth': '1981-02-03'}))
+        self.assertEqual(res.get_json()['actor']['date_of_birth'],
+                         'February 03, 1981')
+        self.assertEqual(len(statements), 1 if returning else 2)
+
+        res, statements = self.statements(lambda: self.client().delete(
+            f'/actors/{self.actor_id}', headers=headers))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('DELETE FROM actors'))
+
+    def test_missing_row_is_one_statement_and_404(self):
+        """Test a write of a missing row is a 404 without another query"""
+        res, statements = self.statements(lambda: self.patch(
+            '/movies/999999', {'duration': 100}))
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(len(statements), 1)
+        res, statements = self.statements(lambda: self.client().delete(
+            '/movies/999999', headers=headers))
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(len(statements), 1)
+        # with If-Match a stale row is told from a missing one
+        res = self.client().delete('/movies/999999', headers=dict(
+            headers, **{'If-Match': '"1"'}))
+        self.assertEqual(res.status_code, 404)
+
+
+class BulkWriteTestCase(unittest.TestCase):
+    """This class represents the bulk update and delete test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, DB_PATH)
+        self.marker = f'Bulk {uuid.uuid4().hex}'
+        self.movie_ids = Movies.insert_many([
+            {'title': f'{self.marker} {number}', 'duration': 90,
+             'release_year': 2000} for number in range(5)])
+
+    def test_200_patch_movies_reports_every_id(self):
+        """Test a bulk update applies the valid records only"""
+        first, second, third, fourth, fifth = self.movie_ids
+        with QueryCounter() as counter:
+            with mock.patch.object(models, 'WRITE_BATCH_SIZE', 2):
+                res = self.client().patch('/movies', json=[
+                    {'id': first, 'fields': {'duration': 100}},
+                    {'id': second, 'fields': {'title': f'{self.marker} new',
+                                              'release_year': 1990},
+                     'version': 1},
+                    {'id': third, 'fields': {'duration': 100},
+                     'version': 5},
+                    {'id': fourth, 'fields': {'duration': -1}},
+                    {'id': fifth, 'fields': {'title': f'{self.marker} 0'}},
+                    {'id': 999999, 'fields': {'duration': 100}},
+                ], headers=headers)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['updated'], data['failed']), (2, 4))
+        self.assertEqual(data['results'], {
+            str(first): {'version': 2},
+            str(second): {'version': 2},
+            str(third): {'error': 'version conflict'},
+            str(fourth): {'error': 'duration is invalid'},
+            str(fifth): {'error': 'title already exists'},
+            '999999': {'error': 'not found'},
+        })
+        # set-based: one UPDATE per WRITE_BATCH_SIZE rows, not per row
+        self.assertEqual(len([statement for statement in counter.statements
+                              if statement.startswith('UPDATE movies')]), 2)
+        movie = Movies.query.get(second)
+        self.assertEqual((movie.title, movie.release_year, movie.version),
+                         (f'{self.marker} new', 1990, 2))
+        self.assertEqual(Movies.query.get(first).duration, 100)
+        self.assertEqual(Movies.query.get(third).duration, 90)
+
+    def test_200_patch_actors(self):
+        """Test a bulk update of actors"""
+        actor_ids = Actor.insert_many([
+            {'name': 'Bulk actor', 'gender': 'F',
+             'date_of_birth': date(1980, 1, 1)} for _ in range(2)])
+        res = self.client().patch('/actors', json=[
+            {'id': actor_ids[0], 'fields': {'date_of_birth': '1981-2-3'}},
+            {'id': actor_ids[1], 'fields': {}},
+        ], headers=headers)
+        self.assertEqual(res.get_json()['results'], {
+            str(actor_ids[0]): {'version': 2},
+            str(actor_ids[1]): {'error': 'no field to update'},
+        })
+        self.assertEqual(Actor.query.get(actor_ids[0]).date_of_birth,
+                         date(1981, 2, 3))
+
+    def test_400_patch_movies_malformed(self):
+        """Test a bulk update needs a distinct id for every record"""
+        for body in ({'id': self.movie_ids[0]}, [],
+                     [{'fields': {'duration': 100}}],
+                     [{'id': self.movie_ids[0], 'fields': {'duration': 1}},
+                      {'id': self.movie_ids[0], 'fields': {'duration': 2}}]):
+            res = self.client().patch('/movies', json=body, headers=headers)
+            self.assertEqual(res.status_code, 400, body)
+
+    def test_401_bulk_writes_check_permissions(self):
+        """Test the bulk writes need the permissions of the single ones"""
+        assistant = {'Authorization': f'Bearer {CASTING_ASSISTANT_TOKEN}'}
+        res = self.client().patch('/movies', json=[
+            {'id': self.movie_ids[0], 'fields': {'duration': 100}}],
+            headers=assistant)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.get_json()['message'], 'unauthorized')
+        res = self.client().delete('/movies', json={
+            'ids': self.movie_ids}, headers=assistant)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(Movies.query.filter(
+            Movies.id.in_(self.movie_ids)).count(), 5)
+
+    def test_200_delete_movies_by_ids(self):
+        """Test a bulk delete of ids reports the missing ones"""
+        res = self.client().delete('/movies', json={
+            'ids': self.movie_ids[:2] + [999999]}, headers=headers)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['deleted'], data['failed']), (2, 1))
+        self.assertEqual(data['results'], {
+            str(self.movie_ids[0]): {'deleted': True},
+            str(self.movie_ids[1]): {'deleted': True},
+            '999999': {'error': 'not found'},
+        })
+        self.assertEqual(Movies.query.filter(
+            Movies.id.in_(self.movie_ids)).count(), 3)
+
+    def test_200_delete_movies_by_filter(self):
+        """Test a bulk delete of the movies matching list filters"""
+        res = self.client().delete('/movies', json={
+            'filter': {'title_prefix': self.marker}}, headers=headers)
+        self.assertEqual(res.get_json(), {
+            'success': True, 'dry_run': True, 'matched': 5})
+        res = self.client().delete('/movies', json={
+            'filter': {'title_prefix': self.marker}, 'confirm': 4},
+            headers=headers)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(res.get_json()['matched'], 5)
+        self.assertEqual(Movies.query.filter(
+            Movies.id.in_(self.movie_ids)).count(), 5)
+        res = self.client().delete('/movies', json={
+            'filter': {'title_prefix': self.marker}, 'confirm': 5},
+            headers=headers)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(map(int, data['results'])), self.movie_ids)
+        self.assertEqual(Movies.query.filter(
+            Movies.id.in_(self.movie_ids)).count(), 0)
+
+    def test_400_delete_movies_malformed(self):
+        """Test a bulk delete needs ids or a selective filter"""
+        for body in (None, {}, {'filter': {}},
+                     {'filter': {'title_prefix': None}},
+                     {'filter': {'director': 'x'}},
+                     {'filter': {'release_year_min': 'x'}},
+                     {'filter': {'title_contains': ''}, 'confirm': 5},
+                     {'filter': {'title_prefix': ' '}, 'confirm': 5},
+                     {'filter': {'title_prefix': self.marker},
+                      'confirm': True},
+                     {'ids': [1], 'filter': {'title_prefix': 'x'}},
+                     {'ids': []}, {'ids': ['x']}):
+            res = self.client().delete('/movies', json=body,
+                                       headers=headers)
+            self.assertEqual(res.status_code, 400, body)
+        with mock.patch.object(bulk, 'BULK_MAX_RECORDS', 4):
+            res = self.client().delete('/movies', json={
+                'filter': {'title_prefix': self.marker}, 'confirm': 5},
+                headers=headers)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(Movies.query.filter(
+            Movies.id.in_(self.movie_ids)).count(), 5)
+
+
+class StartupTestCase(unittest.TestCase):
+    """This class represents the worker start up test case"""
+
+    def test_setup_db_does_not_connect(self):
+        """Test binding the app opens no connection until a query"""
+        path = tempfile.mktemp(suffix='.db')
+        app = create_app()
+        try:
+            setup_db(app, 'sqlite:///' + path)
+            self.assertFalse(os.path.exists(path))
+            with app.app_context():
+                db.create_all()
+            self.assertTrue(os.path.exists(path))
+        finally:
+            setup_db(app, DB_PATH)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_workers_keep_the_response_cache(self):
+        """Test several workers run with the configured response cache"""
+        with mock.patch.dict(os.environ, WEB_CONCURRENCY='4',
+                             RESPONSE_CACHE_URL='memory://'):
+            settings = runpy.run_path(os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                'gunicorn.conf.py'))
+            self.assertEqual(settings['workers'], 4)
+            self.assertEqual(os.environ['RESPONSE_CACHE_URL'], 'memory://')
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,366 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import rsa
+from flask import Flask, jsonify
+
+from auth import auth
+from auth.auth import AuthError, JWKSCache, Requirement, StaticJWKS, \
+    TokenCache, check_permissions, make_key_provider, requires_auth
+from auth.issuer import CASTING_ASSISTANT, LocalIssuer
+
+JWKS = {
+    'keys': [{
+        'kty': 'RSA',
+        'kid': 'first-key',
+        'use': 'sig',
+        'n': 'sXch',
+        'e': 'AQAB'
+    }]
+}
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the jwks key store test case"""
+
+    def setUp(self):
+        """Write a local jwks file for the cache to read"""
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.write_jwks(JWKS)
+        self.url = f'file://{self.path}'
+
+    def tearDown(self):
+        """Executed after reach test"""
+        os.remove(self.path)
+
+    def write_jwks(self, jwks):
+        with open(self.path, 'w') as jwks_file:
+            json.dump(jwks, jwks_file)
+
+    def test_keys_are_fetched_once_within_ttl(self):
+        """Test the jwks is only downloaded once while fresh"""
+        cache = JWKSCache(self.url, ttl=60)
+        for _ in range(100):
+            self.assertEqual(cache.get_key('first-key')['kid'], 'first-key')
+        self.assertEqual(cache.fetch_count, 1)
+
+    def test_keys_are_refetched_after_ttl(self):
+        """Test expired keys are downloaded again"""
+        cache = JWKSCache(self.url, ttl=0)
+        cache.get_key('first-key')
+        cache.get_key('first-key')
+        self.assertEqual(cache.fetch_count, 2)
+
+    def test_unknown_kid_triggers_refresh(self):
+        """Test a rotated key is picked up without waiting for the ttl"""
+        cache = JWKSCache(self.url, ttl=60, min_refresh_interval=0)
+        cache.get_key('first-key')
+        rotated = {'keys': JWKS['keys'] + [dict(JWKS['keys'][0],
+                                                kid='second-key')]}
+        self.write_jwks(rotated)
+        self.assertEqual(cache.get_key('second-key')['kid'], 'second-key')
+        self.assertEqual(cache.fetch_count, 2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        """Test random kids can not force a download on every request"""
+        cache = JWKSCache(self.url, ttl=60, min_refresh_interval=60)
+        cache.get_key('first-key')
+        for _ in range(10):
+            self.assertIsNone(cache.get_key('missing-key'))
+        self.assertEqual(cache.fetch_count, 1)
+
+    def test_stale_keys_are_served_when_fetch_fails(self):
+        """Test an auth0 outage does not take the api down"""
+        cache = JWKSCache(self.url, ttl=0, stale_ttl=60)
+        cache.get_key('first-key')
+        os.remove(self.path)
+        self.assertEqual(cache.get_key('first-key')['kid'], 'first-key')
+        self.write_jwks(JWKS)
+
+    def test_fetch_failure_without_keys_raises(self):
+        """Test a 503 auth error when no keys were ever fetched"""
+        cache = JWKSCache(f'file://{self.path}.missing')
+        with self.assertRaises(AuthError) as context:
+            cache.get_key('first-key')
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_concurrent_refresh_is_single_flight(self):
+        """Test a burst of requests triggers a single download"""
+        cache = JWKSCache(self.url, ttl=60)
+        fetch = cache.fetch
+
+        def slow_fetch():
+            time.sleep(0.05)
+            return fetch()
+        cache.fetch = slow_fetch
+
+        threads = [threading.Thread(target=cache.get_key, args=('first-key',))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.fetch_count, 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        """Define a payload valid for an hour"""
+        self.payload = {
+            'sub': 'auth0|producer',
+            'exp': time.time() + 3600,
+            'permissions': ['post:movies']
+        }
+
+    def test_cache_hit_and_miss(self):
+        """Test hit and miss counters"""
+        cache = TokenCache()
+        self.assertIsNone(cache.get('token'))
+        cache.put('token', self.payload)
+        self.assertEqual(cache.get('token'), self.payload)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_entry_expires_with_token(self):
+        """Test an entry is dropped once the token exp is reached"""
+        cache = TokenCache()
+        cache.put('token', dict(self.payload, exp=time.time() + 0.05))
+        self.assertIsNotNone(cache.get('token'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        """Test the cache stays within max entries"""
+        cache = TokenCache(max_entries=2)
+        cache.put('first', self.payload)
+        cache.put('second', self.payload)
+        cache.get('first')
+        cache.put('third', self.payload)
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('first'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_cache_stays_within_memory_cap(self):
+        """Test the cache stays within max bytes"""
+        cache = TokenCache(max_bytes=2000)
+        for index in range(100):
+            cache.put(f'token-{index}', self.payload)
+        self.assertLessEqual(cache.stats()['bytes'], 2000)
+        self.assertGreater(cache.stats()['entries'], 0)
+
+    def test_requires_auth_verifies_token_once(self):
+        """Test the token is decoded once but permissions always checked"""
+        app = Flask(__name__)
+
+        @app.errorhandler(AuthError)
+        def handle_auth_error(error):
+            return jsonify({'code': error.error['code']}), error.status_code
+
+        @app.route('/movies', methods=['POST'])
+        @requires_auth('post:movies')
+        def create_movie(jwt):
+            return jsonify({'success': True})
+
+        @app.route('/movies', methods=['DELETE'])
+        @requires_auth('delete:movies')
+        def delete_movie(jwt):
+            return jsonify({'success': True})
+
+        headers = {'Authorization': 'Bearer cached-token'}
+        with mock.patch.object(auth, 'token_cache', TokenCache()), \
+                mock.patch.object(auth, 'verify_decode_jwt',
+                                  return_value=self.payload) as verify:
+            client = app.test_client()
+            self.assertEqual(client.post('/movies', headers=headers)
+                             .status_code, 200)
+            self.assertEqual(client.post('/movies', headers=headers)
+                             .status_code, 200)
+            self.assertEqual(client.delete('/movies', headers=headers)
+                             .status_code, 401)
+            self.assertEqual(verify.call_count, 1)
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the compiled permissions test case"""
+
+    def allows(self, permissions, **requirement):
+        return Requirement(**requirement).allows(frozenset(permissions))
+
+    def test_exact_permission(self):
+        """Test a plain permission is granted only by itself"""
+        self.assertTrue(self.allows(['post:movies'], all_of=['post:movies']))
+        self.assertFalse(self.allows(['post:actors'],
+                                     all_of=['post:movies']))
+
+    def test_wildcards(self):
+        """Test action, resource and global wildcards"""
+        self.assertTrue(self.allows(['*:movies'], all_of=['delete:movies']))
+        self.assertTrue(self.allows(['delete:*'], all_of=['delete:movies']))
+        self.assertTrue(self.allows(['*'], all_of=['delete:movies']))
+        self.assertFalse(self.allows(['*:actors'],
+                                     all_of=['delete:movies']))
+
+    def test_parent_resource_grants_children(self):
+        """Test patch:movies covers patch:movies/casting but not back"""
+        self.assertTrue(self.allows(['patch:movies'],
+                                    all_of=['patch:movies/casting']))
+        self.assertFalse(self.allows(['patch:movies/casting'],
+                                     all_of=['patch:movies']))
+        self.assertFalse(self.allows(['patch:movies-id'],
+                                     all_of=['patch:movies']))
+
+    def test_all_of_and_any_of(self):
+        """Test all_of needs every permission and any_of one of them"""
+        granted = ['get:movies-id', 'patch:movies']
+        self.assertTrue(self.allows(granted, all_of=['get:movies-id',
+                                                     'patch:movies']))
+        self.assertFalse(self.allows(granted, all_of=['get:movies-id',
+                                                      'post:movies']))
+        self.assertTrue(self.allows(granted, any_of=['post:movies',
+                                                     'patch:movies']))
+        self.assertFalse(self.allows(granted, any_of=['post:movies',
+                                                      'delete:movies']))
+
+    def test_missing_claim_is_invalid(self):
+        """Test a token without permissions is refused as invalid"""
+        with self.assertRaises(AuthError) as raised:
+            check_permissions('get:movies-id', {'sub': 'someone'})
+        self.assertEqual(raised.exception.error['code'], 'invalid_claims')
+
+    def test_cached_token_keeps_compiled_permissions(self):
+        """Test the token cache hands back the permissions set"""
+        cache = TokenCache()
+        payload = {'exp': time.time() + 60, 'permissions': ['*:movies']}
+        cache.put('token', payload)
+        cached, permissions = cache.lookup('token')
+        self.assertIs(cached, payload)
+        self.assertEqual(permissions, frozenset(['*:movies']))
+
+    def test_requires_auth_any_of(self):
+        """Test a route accepting either of two permissions"""
+        app = Flask(__name__)
+
+        @app.errorhandler(AuthError)
+        def handle_auth_error(error):
+            return jsonify({'code': error.error['code']}), error.status_code
+
+        @app.route('/casting', methods=['POST'])
+        @requires_auth(any_of=['patch:movies', 'patch:actors'])
+        def cast(jwt):
+            return jsonify({'success': True})
+
+        def post(permissions):
+            payload = {'exp': time.time() + 60, 'permissions': permissions}
+            with mock.patch.object(auth, 'token_cache', TokenCache()), \
+                    mock.patch.object(auth, 'verify_decode_jwt',
+                                      return_value=payload):
+                return app.test_client().post('/casting', headers={
+                    'Authorization': 'Bearer token'}).status_code
+
+        self.assertEqual(post(['patch:actors']), 200)
+        self.assertEqual(post(['patch:*']), 200)
+        self.assertEqual(post(['get:movies-id']), 401)
+
+
+class LocalIssuerTestCase(unittest.TestCase):
+    """This class represents the local token issuer test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        # key generation is the slow part, one key for the whole case
+        cls.issuer = LocalIssuer(bits=1024)
+
+    def setUp(self):
+        """Serve the issuer jwks to a fresh key cache"""
+        handle, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.issuer.write_jwks(self.path)
+        self.cache = JWKSCache(f'file://{self.path}')
+
+    def tearDown(self):
+        """Executed after reach test"""
+        os.remove(self.path)
+
+    def test_minted_token_is_verified(self):
+        """Test a local token carries the permissions of its role"""
+        with mock.patch.object(auth, 'key_provider', self.cache):
+            payload = auth.verify_decode_jwt(self.issuer.mint('assistant'))
+        self.assertEqual(payload['permissions'], CASTING_ASSISTANT)
+
+    def test_expired_token_is_rejected(self):
+        """Test a local token past its ttl is refused"""
+        token = self.issuer.mint('producer', ttl=-60)
+        with mock.patch.object(auth, 'key_provider', self.cache), \
+                self.assertRaises(AuthError) as raised:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(raised.exception.error['code'], 'token_expired')
+
+    def test_token_of_another_key_is_rejected(self):
+        """Test a token signed by an unknown key is refused"""
+        token = LocalIssuer(kid='other-key', bits=1024).mint()
+        with mock.patch.object(auth, 'key_provider', self.cache), \
+                self.assertRaises(AuthError):
+            auth.verify_decode_jwt(token)
+
+    def test_static_jwks_file_provider(self):
+        """Test the jwks-file provider reads the keys once"""
+        with mock.patch.object(auth, 'JWKS_FILE', self.path):
+            provider = make_key_provider('jwks-file')
+        with open(self.path, 'w') as jwks_file:
+            json.dump(JWKS, jwks_file)
+        self.assertIsInstance(provider, StaticJWKS)
+        self.assertEqual(provider.get_key('local-key')['n'],
+                         self.issuer.jwks()['keys'][0]['n'])
+        self.assertIsNone(provider.get_key('first-key'))
+
+    def test_local_provider_shares_the_key_file(self):
+        """Test tokens minted from the key file pass the local provider"""
+        key_path = self.path + '.pem'
+        try:
+            token = LocalIssuer.from_key_file(key_path, bits=1024).mint(
+                'director')
+            with mock.patch.object(auth, 'LOCAL_ISSUER_KEY', key_path):
+                provider = make_key_provider('local')
+            with mock.patch.object(auth, 'key_provider', provider):
+                payload = auth.verify_decode_jwt(token)
+        finally:
+            os.remove(key_path)
+        self.assertIn('patch:movies', payload['permissions'])
+
+    def test_key_file_race_keeps_the_first_key(self):
+        """Test a worker that lost the race on the key file reads it"""
+        with tempfile.TemporaryDirectory() as directory:
+            key_path = os.path.join(directory, 'local.pem')
+            winner = LocalIssuer.from_key_file(key_path, bits=1024)
+            os.remove(key_path)
+            newkeys = rsa.newkeys
+
+            def other_worker_first(bits):
+                # the key file did not exist yet when this worker looked
+                with open(key_path, 'wb') as key_file:
+                    key_file.write(winner.private_key.save_pkcs1())
+                return newkeys(bits)
+
+            with mock.patch.object(rsa, 'newkeys', other_worker_first):
+                loser = LocalIssuer.from_key_file(key_path, bits=1024)
+            self.assertEqual(os.listdir(directory), ['local.pem'])
+        self.assertEqual(loser.private_key, winner.private_key)
+
+    def test_unknown_provider_is_refused(self):
+        """Test a misspelt AUTH_KEY_PROVIDER fails at startup"""
+        with self.assertRaises(ValueError):
+            make_key_provider('auth1')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import date
+
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from alembic.script import ScriptDirectory
+from flask import Flask
+from flask_migrate import Migrate, downgrade, upgrade
+
+from models import db
+from migrations.helpers import backfill, create_index_concurrently, \
+    drop_index_concurrently, set_not_null
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'migrations')
+# a scratch database, every table of it is dropped, defaults to a
+# temporary sqlite file
+MIGRATIONS_DATABASE_URL = os.getenv('MIGRATIONS_DATABASE_URL')
+# rows of movies and actors the migrations run over
+MIGRATIONS_TEST_ROWS = int(os.getenv('MIGRATIONS_TEST_ROWS', 10000))
+# seconds a revision may take over MIGRATIONS_TEST_ROWS rows
+MIGRATIONS_MAX_SECONDS = float(os.getenv('MIGRATIONS_MAX_SECONDS', 30))
+
+
+class MigrationsTestCase(unittest.TestCase):
+    """This class represents the alembic migrations test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.path = None
+        url = MIGRATIONS_DATABASE_URL
+        if not url:
+            cls.path = tempfile.mktemp(suffix='.db')
+            url = 'sqlite:///' + cls.path
+        cls.app = Flask(__name__)
+        cls.app.config['SQLALCHEMY_DATABASE_URI'] = url
+        cls.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(cls.app)
+        migrate = Migrate(cls.app, db, directory=MIGRATIONS)
+        cls.revisions = [script.revision for script in reversed(list(
+            ScriptDirectory.from_config(migrate.get_config(MIGRATIONS))
+            .walk_revisions()))]
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.path and os.path.exists(cls.path):
+            os.remove(cls.path)
+
+    def setUp(self):
+        """Start every test from an empty database"""
+        self.context = self.app.app_context()
+        self.context.push()
+        self.engine = db.get_engine(self.app)
+        metadata = sa.MetaData()
+        metadata.reflect(self.engine)
+        metadata.drop_all(self.engine)
+
+    def tearDown(self):
+        """Executed after reach test"""
+        db.session.remove()
+        self.engine.dispose()
+        self.context.pop()
+
+    def tables(self):
+        return set(sa.inspect(self.engine).get_table_names())
+
+    def seed(self, rows=MIGRATIONS_TEST_ROWS):
+        movies = sa.table('movies', sa.column('title'),
+                          sa.column('duration'), sa.column('release_year'))
+        actors = sa.table('actors', sa.column('name'), sa.column('gender'),
+                          sa.column('date_of_birth'))
+        with self.engine.begin() as connection:
+            connection.execute(movies.insert(), [
+                {'title': f'movie {number}', 'duration': 90,
+                 'release_year': 1950 + number % 70}
+                for number in range(rows)])
+            connection.execute(actors.insert(), [
+                {'name': f'actor {number}', 'gender': 'MF'[number % 2],
+                 'date_of_birth': date(1950 + number % 50, 1, 1)}
+                for number in range(rows)])
+
+    def operations(self, connection):
+        '''runs the migration helpers outside of an alembic revision'''
+        return Operations.context(MigrationContext.configure(connection))
+
+    def test_upgrade_seeded_database_step_by_step(self):
+        """Test each revision applies over seeded tables, and time it"""
+        upgrade(directory=MIGRATIONS, revision=self.revisions[0])
+        self.assertTrue({'movies', 'actors'} <= self.tables())
+        self.seed()
+        timings = []
+        for revision in self.revisions[1:]:
+            started = time.perf_counter()
+            upgrade(directory=MIGRATIONS, revision=revision)
+            timings.append((revision, time.perf_counter() - started))
+        for revision, seconds in timings:
+            self.assertLess(seconds, MIGRATIONS_MAX_SECONDS,
+                            f'{revision} over {MIGRATIONS_TEST_ROWS} rows')
+
+        inspector = sa.inspect(self.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column['name']
+                       for column in inspector.get_columns(table.name)}
+            self.assertTrue(set(table.columns.keys()) <= columns, table.name)
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(
+                'SELECT count(*) FROM movies').scalar(), MIGRATIONS_TEST_ROWS)
+            self.assertEqual(connection.execute(
+                'SELECT version_num FROM alembic_version').scalar(),
+                self.revisions[-1])
+
+    def test_downgrade_to_base_and_back(self):
+        """Test every revision can be undone"""
+        upgrade(directory=MIGRATIONS)
+        downgrade(directory=MIGRATIONS, revision='base')
+        self.assertFalse({'movies', 'actors', 'casting'} & self.tables())
+        upgrade(directory=MIGRATIONS)
+        self.assertTrue({'movies', 'actors', 'casting'} <= self.tables())
+
+    def test_batch_downgrade_keeps_casting_rows(self):
+        """Test a table copied by a batch operation keeps its references"""
+        upgrade(directory=MIGRATIONS)
+        self.seed(1)
+        with self.engine.begin() as connection:
+            connection.execute('INSERT INTO casting (movie_id, actor_id) '
+                               'SELECT movies.id, actors.id '
+                               'FROM movies, actors')
+        # 9d4e2b7c1a55 drops the version columns, a table copy on sqlite
+        downgrade(directory=MIGRATIONS, revision='2f7a6c4e9b13')
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(
+                'SELECT count(*) FROM casting').scalar(), 1)
+
+    @unittest.skipUnless((MIGRATIONS_DATABASE_URL or '').startswith(
+        'postgresql'), 'search vectors are postgresql only')
+    def test_search_vectors_are_backfilled(self):
+        """Test the rows before the search migration get a vector too"""
+        upgrade(directory=MIGRATIONS, revision='8c3d9e1f6a20')
+        self.seed(100)
+        upgrade(directory=MIGRATIONS)
+        with self.engine.begin() as connection:
+            connection.execute("INSERT INTO movies (title, duration, "
+                               "release_year) VALUES ('later', 90, 2000)")
+            connection.execute("UPDATE actors SET name = 'renamed' "
+                               "WHERE name = 'actor 0'")
+            self.assertEqual(connection.execute(
+                'SELECT count(*) FROM movies '
+                'WHERE search_vector IS NULL').scalar(), 0)
+            self.assertEqual(connection.execute(
+                "SELECT count(*) FROM movies WHERE search_vector @@ "
+                "to_tsquery('simple', 'later')").scalar(), 1)
+            self.assertEqual(connection.execute(
+                "SELECT count(*) FROM actors WHERE search_vector @@ "
+                "to_tsquery('simple', 'renamed')").scalar(), 1)
+
+    def test_writes_bump_the_table_changes(self):
+        """Test every write statement bumps the counter of its table"""
+        upgrade(directory=MIGRATIONS)
+        self.seed(2)
+
+        def versions(connection):
+            return {name: version for name, version in connection.execute(
+                'SELECT name, version FROM table_changes')}
+
+        with self.engine.begin() as connection:
+            before = versions(connection)
+            connection.execute("UPDATE actors SET name = name || ' 2'")
+            connection.execute('DELETE FROM movies')
+            after = versions(connection)
+        self.assertGreater(after['actors'], before['actors'])
+        self.assertGreater(after['movies'], before['movies'])
+
+    def test_database_made_by_create_all_is_adopted(self):
+        """Test the migrations run over tables db.create_all made"""
+        db.create_all()
+        self.seed(100)
+        upgrade(directory=MIGRATIONS)
+        with self.engine.connect() as connection:
+            self.assertEqual(connection.execute(
+                'SELECT count(*) FROM actors').scalar(), 100)
+
+    def test_backfill_runs_in_batches(self):
+        """Test a backfill updates every row, batch after batch"""
+        upgrade(directory=MIGRATIONS)
+        self.seed(1050)
+        statements = []
+        sa.event.listen(self.engine, 'before_cursor_execute',
+                        lambda *args: statements.append(args[2]))
+        with self.engine.connect() as connection, \
+                self.operations(connection) as op:
+            op.add_column('movies', sa.Column('slug', sa.String()))
+            updated = backfill('movies', 'slug = lower(title)',
+                               'slug IS NULL', batch_size=100)
+            set_not_null('movies', 'slug')
+            nulls = connection.execute(
+                'SELECT count(*) FROM movies WHERE slug IS NULL').scalar()
+        self.assertEqual(updated, 1050)
+        self.assertEqual(nulls, 0)
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('UPDATE movies')]),
+                         11)
+
+    def test_create_index_concurrently_is_idempotent(self):
+        """Test an existing index is kept and a dropped one goes away"""
+        upgrade(directory=MIGRATIONS)
+        self.seed(100)
+        with self.engine.connect() as connection, \
+                self.operations(connection):
+            create_index_concurrently('ix_movies_duration', 'movies',
+                                      ['duration'])
+            create_index_concurrently('ix_movies_duration', 'movies',
+                                      ['duration'])
+            names = [index['name'] for index in
+                     sa.inspect(connection).get_indexes('movies')]
+            self.assertEqual(names.count('ix_movies_duration'), 1)
+            drop_index_concurrently('ix_movies_duration', 'movies')
+            self.assertNotIn('ix_movies_duration', [
+                index['name'] for index in
+                sa.inspect(connection).get_indexes('movies')])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()